@@ -1,10 +1,24 @@
 ''' Anomaly scores used as unsupervised features '''
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
 from anomaly_scores.lof import *
 from anomaly_scores.ocsvm import *
 from anomaly_scores.isolation_forest import *
+from data_preprocessing.standardization import Standardizer, standardize_for_anomaly
+
+# (score column, classifier key) of each anomaly detection approach, in the order of methods_vec
+ANOMALY_METHODS = [("lof_score_all", "lof_all"),
+                   ("lof_score_majority", "lof_majority"),
+                   ("ocsvm_score_all", "ocsvm_all"),
+                   ("ocsvm_score_majority", "ocsvm_majority"),
+                   ("if_anomaly_score", "if_anomaly")]
 
 
-def add_anomaly_scores_seen(X_train, y_train, numerical_cols, methods_vec, standardization):
+def add_anomaly_scores_seen(X_train, y_train, numerical_cols, methods_vec, standardization, standardizer=None,
+                            n_jobs=1, lof_params=None, ocsvm_params=None, profiler=None, profile=None):
     """
     Calculates anomaly scores and adds them as unsupervised features to the training set.
 
@@ -19,60 +33,81 @@ def add_anomaly_scores_seen(X_train, y_train, numerical_cols, methods_vec, stand
                     3: One Class SVM - Trained only on negative labels of X_train
                     4: Isolation forest
         standardization: A flag indicating whether to standardize the anomaly scores' columns.
+        standardizer: A Standardizer that already standardized numerical_cols of X_train, if any.
+                      LOF and OCSVM share it, or a single Standardizer fitted here, instead of standardizing copies.
+        n_jobs: Number of detectors to fit concurrently (-1: one per CPU). The detectors share the training
+                matrix read-only, and the new columns are added in the order of methods_vec.
+        lof_params: Optional keyword arguments of local_outlier_factor (e.g. {'max_samples': 50000}).
+        ocsvm_params: Optional keyword arguments of one_class_svm (e.g. {'engine': 'linear'}).
+        profiler: Optional StageProfiler, recording a stage per detector (named by its classifier key).
+        profile: Optional ColumnProfile of X_train, for the standardization check (and fit) of the detectors' input.
 
     Returns:
         X_train: The training set containing the new columns.
-        standard_params: The standardization parameters, used for the test set standardization.
+        standard_params: The Standardizers of the detectors' input ("anomaly_input", None if not needed) and of the
+                         anomaly scores ("anomaly_scores"), used for the test set standardization.
         clf_dict: The anomaly classifiers, used for the test set anomaly detection.
     """
 
     num_of_methods = 5
     assert len(methods_vec) == num_of_methods, f"Error! the expected length of methods_vec is: {num_of_methods}."
 
-    train_scores, standard_params, clf_dict = {}, {}, {}
+    standard_params, clf_dict = {}, {}
+    lof_params = lof_params if lof_params is not None else {}
+    ocsvm_params = ocsvm_params if ocsvm_params is not None else {}
+
+    # LOF and OCSVM require standardized data. Standardize X_train once, shared by all of them.
+    X_standardized = X_train
+    standard_params["anomaly_input"] = None
+    if any(methods_vec[:4]):
+        X_standardized, _, standard_params["anomaly_input"] = standardize_for_anomaly(
+            X_train, numerical_cols, None, standardizer, "anomaly detection", profile)
+        if standard_params["anomaly_input"] is not None:
+            standardizer = standard_params["anomaly_input"]
+        elif standardizer is None or not standardizer.is_standardized(numerical_cols):
+            standardizer = Standardizer().mark_standardized(numerical_cols)  # checked to be already standardized
+        X_standardized = as_float_frame(X_standardized)
 
     # Generate majority training set - only "negative" training instances.
     if methods_vec[1] or methods_vec[3]:
         neg_indices = y_train[y_train == 0].index
-        majority_train = X_train[X_train.index.isin(neg_indices)]
+        majority_train = X_standardized[X_standardized.index.isin(neg_indices)]
     else:
         majority_train = None
 
-    # LOF
-    if methods_vec[0]:
-        train_scores["lof_score_all"], clf_dict["lof_all"], standard_params["lof_all"] = local_outlier_factor(
-            X_train.copy(), numerical_cols)
-
-    if methods_vec[1]:
-        train_scores["lof_score_majority"], clf_dict["lof_majority"], standard_params[
-            "lof_majority"] = local_outlier_factor(X_train.copy(), numerical_cols, majority_train=majority_train)
-
-    # One Class SVM
-    if methods_vec[2]:
-        train_scores["ocsvm_score_all"], clf_dict["ocsvm_all"], standard_params["ocsvm_all"] = one_class_svm(
-            X_train.copy(), numerical_cols)
-
-    if methods_vec[3]:
-        train_scores["ocsvm_score_majority"], clf_dict["ocsvm_majority"], standard_params[
-            "ocsvm_majority"] = one_class_svm(X_train.copy(), numerical_cols, majority_train=majority_train)
-
-    # Isolation forest anomaly
-    if methods_vec[4]:
-        train_scores["if_anomaly_score"], clf_dict["if_anomaly"] = calculate_IsolationForest_anomaly(X_train)
+    detectors = [
+        # LOF
+        lambda: local_outlier_factor(X_standardized, numerical_cols, standardizer=standardizer, y_train=y_train,
+                                     **lof_params)[:2],
+        lambda: local_outlier_factor(X_standardized, numerical_cols, majority_train=majority_train,
+                                     standardizer=standardizer, **lof_params)[:2],
+        # One Class SVM
+        lambda: one_class_svm(X_standardized, numerical_cols, standardizer=standardizer, **ocsvm_params)[:2],
+        lambda: one_class_svm(X_standardized, numerical_cols, majority_train=majority_train,
+                              standardizer=standardizer, **ocsvm_params)[:2],
+        # Isolation forest anomaly
+        lambda: calculate_IsolationForest_anomaly(X_train)]
+    detectors = profiled_detectors(detectors, X_train, profiler)
+    results = run_detectors([detector for detector, run in zip(detectors, methods_vec) if run], n_jobs)
 
     # Add anomaly scores to X_train
-    anomaly_cols = train_scores.keys()
-    for col_name in anomaly_cols:
-        X_train[col_name] = train_scores[col_name]
+    anomaly_cols = []
+    methods = [method for method, run in zip(ANOMALY_METHODS, methods_vec) if run]
+    for (col_name, clf_name), (score, clf) in zip(methods, results):
+        X_train[col_name] = score
+        clf_dict[clf_name] = clf
+        anomaly_cols.append(col_name)
 
     # Standardize the anomaly columns
     if standardization:
-        X_train, standard_params["anomaly_scores"] = standardize_data(X_train, anomaly_cols)
+        standard_params["anomaly_scores"] = Standardizer()
+        X_train = standard_params["anomaly_scores"].fit_transform(X_train, anomaly_cols, inplace=True)
 
     return X_train, standard_params, clf_dict
 
 
-def add_anomaly_scores_unseen(X_test, numerical_cols, methods_vec, standard_params, clf_dict, standardization):
+def add_anomaly_scores_unseen(X_test, numerical_cols, methods_vec, standard_params, clf_dict, standardization,
+                              n_jobs=1, lof_params=None, ocsvm_params=None, profiler=None):
     """
     Calculates anomaly scores and adds them as unsupervised features to the test set.
 
@@ -85,9 +120,12 @@ def add_anomaly_scores_unseen(X_test, numerical_cols, methods_vec, standard_para
                     2: One Class SVM - Trained on the entire X_train
                     3: One Class SVM - Trained only on negative labels of X_train
                     4: Isolation forest
-        standard_params: The standardization parameters of the numerical columns of the training set.
+        standard_params: The Standardizers returned by add_anomaly_scores_seen.
         clf_dict: The anomaly classifiers, trained on the training set.
         standardization: A flag indicating whether to standardize the anomaly scores' columns.
+        n_jobs: Number of detectors to apply concurrently (-1: one per CPU).
+        lof_params: The keyword arguments of local_outlier_factor, given to add_anomaly_scores_seen.
+        profiler: Optional StageProfiler, recording a stage per detector (named by its classifier key).
 
     Returns: The test set with the new columns.
     """
@@ -95,39 +133,65 @@ def add_anomaly_scores_unseen(X_test, numerical_cols, methods_vec, standard_para
     num_of_methods = 5
     assert len(methods_vec) == num_of_methods, f"Error! the expected length of methods_vec is: {num_of_methods}."
 
-    test_scores = {}
+    lof_batch_size = (lof_params or {}).get('batch_size')
+
+    # Standardize X_test once for LOF and OCSVM, as done for the training set
+    X_standardized = X_test
+    if any(methods_vec[:4]):
+        if standard_params["anomaly_input"] is not None:
+            X_standardized = standard_params["anomaly_input"].transform(X_test, numerical_cols)
+        X_standardized = as_float_frame(X_standardized)
+
+    detectors = [
+        # LOF
+        lambda: local_outlier_factor_unseen(X_standardized, clf_dict["lof_all"], numerical_cols, None,
+                                            batch_size=lof_batch_size),
+        lambda: local_outlier_factor_unseen(X_standardized, clf_dict["lof_majority"], numerical_cols, None,
+                                            batch_size=lof_batch_size),
+        # One Class SVM
+        lambda: one_class_svm_unseen(X_standardized, clf_dict["ocsvm_all"], numerical_cols, None),
+        lambda: one_class_svm_unseen(X_standardized, clf_dict["ocsvm_majority"], numerical_cols, None),
+        # isolation forrest anomaly
+        lambda: predict_unseen_IsolationForest_anomaly(X_test, clf_dict["if_anomaly"])]
+    detectors = profiled_detectors(detectors, X_test, profiler)
+    scores = run_detectors([detector for detector, run in zip(detectors, methods_vec) if run], n_jobs)
+
+    # add anomaly scores to X_test
+    anomaly_cols = [col_name for (col_name, _), run in zip(ANOMALY_METHODS, methods_vec) if run]
+    for col_name, score in zip(anomaly_cols, scores):
+        X_test[col_name] = score
 
-    # LOF
-    if methods_vec[0]:
-        test_scores["lof_score_all"] = local_outlier_factor_unseen(X_test.copy(), clf_dict["lof_all"],
-                                                                   numerical_cols, standard_params["lof_all"])
+    # standardize the anomaly columns
+    if standardization:
+        X_test = standard_params["anomaly_scores"].transform(X_test, anomaly_cols, inplace=True)
 
-    if methods_vec[1]:
-        test_scores["lof_score_majority"] = local_outlier_factor_unseen(X_test.copy(), clf_dict["lof_majority"],
-                                                                        numerical_cols,
-                                                                        standard_params["lof_majority"])
+    return X_test
 
-    # One Class SVM
-    if methods_vec[2]:
-        test_scores["ocsvm_score_all"] = one_class_svm_unseen(X_test.copy(), clf_dict["ocsvm_all"], numerical_cols,
-                                                              standard_params["ocsvm_all"])
 
-    if methods_vec[3]:
-        test_scores["ocsvm_score_majority"] = one_class_svm_unseen(X_test.copy(), clf_dict["ocsvm_majority"],
-                                                                   numerical_cols,
-                                                                   standard_params["ocsvm_majority"])
+def run_detectors(detectors, n_jobs=1):
+    """
+    Runs the given detectors (functions without arguments), concurrently if n_jobs != 1.
+    Threads are used, so the detectors share the (read-only) data without copying it. The heavy parts of
+    the detectors (neighbors queries, libsvm, trees) run in compiled code that releases the GIL.
 
-    # isolation forrest anomaly
-    if methods_vec[4]:
-        test_scores["if_anomaly_score"] = predict_unseen_IsolationForest_anomaly(X_test, clf_dict["if_anomaly"])
+    Returns: The results of the detectors, in their given order.
+    """
+    n_jobs = os.cpu_count() if n_jobs == -1 else n_jobs
+    if n_jobs == 1 or len(detectors) <= 1:
+        return [detector() for detector in detectors]
 
-    # add anomaly scores to X_train
-    anomaly_cols = test_scores.keys()
-    for col_name in anomaly_cols:
-        X_test[col_name] = test_scores[col_name]
+    with ThreadPoolExecutor(max_workers=min(n_jobs, len(detectors))) as executor:
+        futures = [executor.submit(detector) for detector in detectors]
+        return [future.result() for future in futures]
 
-    # standardize the anomaly columns
-    if standardization:
-        X_test = standardize_unseen_data(X_test, anomaly_cols, standard_params["anomaly_scores"])
 
-    return X_test
+def profiled_detectors(detectors, X, profiler=None):
+    """ The detectors (in the order of ANOMALY_METHODS), each run in a stage of profiler, if given """
+    if profiler is None:
+        return detectors
+    return [profiler.wrap(clf_name, detector, X) for (_, clf_name), detector in zip(ANOMALY_METHODS, detectors)]
+
+
+def as_float_frame(df):
+    """ A copy of df as a single float block, which the detectors use without converting it again """
+    return pd.DataFrame(df.to_numpy(dtype=float), index=df.index, columns=df.columns)
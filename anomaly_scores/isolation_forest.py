@@ -1,5 +1,5 @@
 ''' Isolation Forest - anomaly detection '''
-from sklearn.ensemble import IsolationForest
+
 
 def calculate_IsolationForest_anomaly(X_train):
     """
@@ -12,6 +12,8 @@ def calculate_IsolationForest_anomaly(X_train):
         anomaly_score: The IsolationForest scores.
         clf: The IsolationForest classifier.
     """
+    from sklearn.ensemble import IsolationForest
+
     clf = IsolationForest()
     clf.fit(X_train)
     anomaly_score = clf.decision_function(X_train)
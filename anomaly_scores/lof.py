@@ -1,42 +1,65 @@
 ''' Local outlier factor - anomaly detection '''
-from data_preprocessing.standardization import standardize_data, standardize_unseen_data, is_data_standardized
-from sklearn.neighbors import LocalOutlierFactor
+import numpy as np
+from data_preprocessing.standardization import standardize_for_anomaly
 
 
-def local_outlier_factor(X_train, standardized_features, majority_train=None):
+def local_outlier_factor(X_train, standardized_features, majority_train=None, standardizer=None, y_train=None,
+                         n_neighbors=20, algorithm='auto', leaf_size=30, n_components=None, max_samples=None,
+                         batch_size=None, random_state=0):
     """
     Trains a Local Outlier Factor on the training set to generate anomaly features.
     Performs standardization (required).
+    For large training sets, the neighbors search can be approximated (random projection, tree parameters),
+    the model can be fitted on a stratified subsample, and the scores computed in batches with bounded memory.
 
     Args:
         X_train: Training set.
         standardized_features: A list of feature names to standardized.
         majority_train: A DF that, if given, X_train is replaced with. Contains negative examples only.
+        standardizer: A shared Standardizer. If it already standardized the features, the data is used as is.
+        y_train: Training labels, used to stratify the subsample (max_samples).
+        n_neighbors: Number of neighbors of LOF.
+        algorithm: Neighbors search algorithm ('auto', 'ball_tree', 'kd_tree' or 'brute').
+        leaf_size: Leaf size of the search trees (speed / memory trade-off).
+        n_components: If given, the data is projected to n_components random dimensions before the neighbors search.
+        max_samples: If given, LOF is fitted on a subsample of this size (int) or fraction (float).
+        batch_size: If given, the scores are computed in batches of batch_size rows.
+        random_state: Seed of the random projection and of the subsample.
 
     Returns:
         lof_score: lof scores.
         lof_clf: lof classifier, to be passed to local_outlier_factor_unseen.
-        standard_params: The standardization parameters of X_train (mean, SD).
+        standardizer: The Standardizer fitted on X_train, or None if the data was already standardized.
     """
+    from sklearn.model_selection import train_test_split
+    from sklearn.neighbors import LocalOutlierFactor
+    from sklearn.pipeline import make_pipeline
+    from sklearn.random_projection import GaussianRandomProjection
+
     # Check if data is already standardized
-    standard_params = []
-    if not is_data_standardized(X_train, standardized_features):
-        print("Performs standardization for LOF")
-        X_train, standard_params = standardize_data(X_train, standardized_features)
+    X_train, majority_train, standardizer = standardize_for_anomaly(X_train, standardized_features, majority_train,
+                                                                    standardizer, "LOF")
 
     # Fit model to majority_train or to X_train
-    lof_clf = LocalOutlierFactor(novelty=True)
-    if majority_train is None:
-        lof_clf.fit(X_train)
-    else:
-        lof_clf.fit(majority_train)
+    fit_data, fit_labels = (X_train, y_train) if majority_train is None else (majority_train, None)
+    if max_samples is not None and max_samples < (1 if isinstance(max_samples, float) else len(fit_data)):
+        if fit_labels is not None:
+            fit_labels = fit_labels.loc[fit_data.index]
+        fit_data = train_test_split(fit_data, train_size=max_samples, stratify=fit_labels,
+                                    random_state=random_state)[0]
+
+    lof_clf = LocalOutlierFactor(novelty=True, n_neighbors=n_neighbors, algorithm=algorithm, leaf_size=leaf_size)
+    if n_components is not None:
+        lof_clf = make_pipeline(GaussianRandomProjection(n_components=n_components, random_state=random_state),
+                                lof_clf)
+    lof_clf.fit(fit_data)
 
-    lof_score = lof_clf.score_samples(X_train)
+    lof_score = score_samples_in_batches(lof_clf, X_train, batch_size)
 
-    return lof_score, lof_clf, standard_params
+    return lof_score, lof_clf, standardizer
 
 
-def local_outlier_factor_unseen(X_test, lof_clf, standardized_features, standard_params):
+def local_outlier_factor_unseen(X_test, lof_clf, standardized_features, standardizer, batch_size=None):
     """
     Applies trained Local Outlier Factor on the test set.
 
@@ -44,13 +67,22 @@ def local_outlier_factor_unseen(X_test, lof_clf, standardized_features, standard
         X_test: Test set
         lof_clf: Trained lof classifier.
         standardized_features: A list of numerical features to standardize.
-        standard_params: The standardization parameters of X_train.
+        standardizer: The Standardizer returned by local_outlier_factor (None if no standardization is needed).
+        batch_size: If given, the scores are computed in batches of batch_size rows.
 
     Returns: The lof scores for the test set.
     """
     # Check if data is already standardized
-    if standard_params:
-        X_test = standardize_unseen_data(X_test, standardized_features, standard_params)
+    if standardizer is not None:
+        X_test = standardizer.transform(X_test, standardized_features)
 
-    lof_score = lof_clf.score_samples(X_test)
+    lof_score = score_samples_in_batches(lof_clf, X_test, batch_size)
     return lof_score
+
+
+def score_samples_in_batches(clf, X, batch_size=None):
+    """ clf.score_samples(X), computed in batches of batch_size rows to bound the memory of the neighbors search """
+    if batch_size is None or len(X) <= batch_size:
+        return clf.score_samples(X)
+    return np.concatenate([clf.score_samples(X.iloc[start:start + batch_size])
+                           for start in range(0, len(X), batch_size)])
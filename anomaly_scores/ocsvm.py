@@ -1,9 +1,10 @@
 ''' Anomaly scores used as unsupervised features '''
-from data_preprocessing.standardization import standardize_data, standardize_unseen_data, is_data_standardized
-from sklearn.svm import OneClassSVM
+import numpy as np
+from data_preprocessing.standardization import standardize_for_anomaly
 
 
-def one_class_svm(X_train, standardized_features, majority_train=None):
+def one_class_svm(X_train, standardized_features, majority_train=None, standardizer=None, engine='kernel',
+                  **engine_params):
     """
     Trains a one class SVM on the training set to generate anomaly features.
     Performs standardization (required).
@@ -12,20 +13,26 @@ def one_class_svm(X_train, standardized_features, majority_train=None):
         X_train: Training set.
         standardized_features:A list of feature names to standardized.
         majority_train: A DF that, if given, X_train is replaced with. Contains negative examples only.
+        standardizer: A shared Standardizer. If it already standardized the features, the data is used as is.
+        engine: 'kernel' - sklearn's OneClassSVM (super-linear in the number of rows).
+                'linear' - ApproximateOneClassSVM, linear in the number of rows (for large training sets).
+        engine_params: Keyword arguments of ApproximateOneClassSVM (engine='linear').
 
     Returns:
         ocsvm_score: OCSVM scores.
         ocsvm_clf: OCSVM classifier.
-        features_params: The standardization parameters for X_train (mean, SD).
+        standardizer: The Standardizer fitted on X_train, or None if the data was already standardized.
     """
     # Check if data is already standardized
-    standard_params = []
-    if not is_data_standardized(X_train, standardized_features):
-        print("Perform standardization for one class svm")
-        X_train, standard_params = standardize_data(X_train, standardized_features)
+    X_train, majority_train, standardizer = standardize_for_anomaly(X_train, standardized_features, majority_train,
+                                                                    standardizer, "one class svm")
 
     # Fit classifier on majority_train or on X_train
-    ocsvm_clf = OneClassSVM()
+    if engine == 'kernel':
+        from sklearn.svm import OneClassSVM
+        ocsvm_clf = OneClassSVM()
+    else:
+        ocsvm_clf = ApproximateOneClassSVM(**engine_params)
     if majority_train is None:
         ocsvm_clf.fit(X_train)
     else:
@@ -33,10 +40,10 @@ def one_class_svm(X_train, standardized_features, majority_train=None):
 
     ocsvm_score = ocsvm_clf.score_samples(X_train)
 
-    return ocsvm_score, ocsvm_clf, standard_params
+    return ocsvm_score, ocsvm_clf, standardizer
 
 
-def one_class_svm_unseen(X_test, ocsvm_clf, standardized_features, features_params):
+def one_class_svm_unseen(X_test, ocsvm_clf, standardized_features, standardizer):
     """
     Applies one class SVM on the test set.
 
@@ -44,14 +51,77 @@ def one_class_svm_unseen(X_test, ocsvm_clf, standardized_features, features_para
         X_test: Test set
         ocsvm_clf: Trained OCSVM classifier.
         standardized_features:  A list of numerical features to standardize.
-        features_params: The standardization parameters of X_train
+        standardizer: The Standardizer returned by one_class_svm (None if no standardization is needed).
 
     Returns: The OCSVM scores for the test set.
     """
     # Check if data is already standardized
-    if features_params:
-        X_test = standardize_unseen_data(X_test, standardized_features, features_params)
+    if standardizer is not None:
+        X_test = standardizer.transform(X_test, standardized_features)
 
     ocsvm_score = ocsvm_clf.score_samples(X_test)
 
     return ocsvm_score
+
+
+class ApproximateOneClassSVM:
+    """
+    A linear-time approximation of an RBF One Class SVM: the data is mapped by an approximate kernel feature map
+    (Nystroem or random Fourier features), and a linear One Class SVM is trained on the mapped data with SGD,
+    in batches (partial_fit).
+    """
+
+    def __init__(self, kernel_approximation='nystroem', n_components=100, gamma='scale', nu=0.5, batch_size=10000,
+                 n_epochs=5, random_state=0):
+        """
+        Args:
+            kernel_approximation: 'nystroem' or 'rff' (random Fourier features).
+            n_components: Dimension of the approximate feature map.
+            gamma: RBF kernel coefficient. 'scale' (as OneClassSVM) uses 1 / (n_features * X.var()).
+            nu: An upper bound on the fraction of training errors (as OneClassSVM).
+            batch_size: Number of rows in each partial_fit / score batch.
+            n_epochs: Number of passes over the training data.
+            random_state: Seed of the feature map and of the SGD.
+        """
+        self.kernel_approximation = kernel_approximation
+        self.n_components = n_components
+        self.gamma = gamma
+        self.nu = nu
+        self.batch_size = batch_size
+        self.n_epochs = n_epochs
+        self.random_state = random_state
+        self.feature_map = None
+        self.clf = None
+
+    def fit(self, X):
+        """ Fits the feature map, then trains the linear One Class SVM over shuffled batches """
+        from sklearn.kernel_approximation import Nystroem, RBFSampler
+        from sklearn.linear_model import SGDOneClassSVM
+
+        X = np.asarray(X, dtype=float)
+        gamma = 1.0 / (X.shape[1] * X.var()) if self.gamma == 'scale' else self.gamma
+        if self.kernel_approximation == 'nystroem':
+            self.feature_map = Nystroem(gamma=gamma, n_components=min(self.n_components, len(X)),
+                                        random_state=self.random_state)
+        else:
+            self.feature_map = RBFSampler(gamma=gamma, n_components=self.n_components, random_state=self.random_state)
+        self.feature_map.fit(X)
+        self.clf = SGDOneClassSVM(nu=self.nu, random_state=self.random_state)
+
+        rng = np.random.default_rng(self.random_state)
+        for _ in range(self.n_epochs):
+            order = rng.permutation(len(X))
+            for start in range(0, len(X), self.batch_size):
+                self.partial_fit(X[order[start:start + self.batch_size]])
+        return self
+
+    def partial_fit(self, X):
+        """ Updates the linear One Class SVM with a batch of rows (the feature map must already be fitted) """
+        self.clf.partial_fit(self.feature_map.transform(np.asarray(X, dtype=float)))
+        return self
+
+    def score_samples(self, X):
+        """ The (unshifted) scoring function of the samples, computed in batches """
+        X = np.asarray(X, dtype=float)
+        return np.concatenate([self.clf.score_samples(self.feature_map.transform(X[start:start + self.batch_size]))
+                               for start in range(0, len(X), self.batch_size)] or [np.array([])])
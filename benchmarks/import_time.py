@@ -0,0 +1,62 @@
+''' Import time benchmark - startup cost of each entry point, and the heavy backends it loads '''
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pandas as pd
+
+ENTRY_POINTS = ['data_preprocessing.data_preprocessing',
+                'feature_generation.feature_generation',
+                'ml_models.ml_models',
+                'ml_models.regression_models',
+                'ml_models.decision_trees_models',
+                'ml_models.svm',
+                'ml_models.cross_validation',
+                'ml_models.hyperparameter_search']
+
+# Backends that an entry point should load only when they are used
+HEAVY_MODULES = ['sklearn', 'scipy', 'xgboost', 'catboost', 'tqdm']
+
+IMPORT_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+print(json.dumps({{'seconds': time.perf_counter() - start,
+                  'loaded': [name for name in {heavy} if name in sys.modules]}}))
+"""
+
+
+def measure_import(module, repeats=5):
+    """ Imports module in fresh interpreters. Returns the median import time and the heavy modules it loaded. """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    runs = []
+    for _ in range(repeats):
+        output = subprocess.run([sys.executable, '-c', IMPORT_SCRIPT.format(module=module, heavy=HEAVY_MODULES)],
+                                cwd=root, capture_output=True, text=True, check=True).stdout
+        runs.append(json.loads(output.splitlines()[-1]))
+
+    return np.median([run['seconds'] for run in runs]), runs[-1]['loaded']
+
+
+def run_benchmark(entry_points=ENTRY_POINTS, repeats=5):
+    """ Returns: A dataframe with the median import time and the heavy modules loaded by each entry point. """
+    results = []
+    for module in entry_points:
+        seconds, loaded = measure_import(module, repeats)
+        results.append({'entry_point': module, 'import_sec': seconds, 'heavy_modules': ' '.join(loaded)})
+
+    return pd.DataFrame(results)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--json', help='Also write the results to this JSON file (for comparison across commits)')
+    args = parser.parse_args()
+    results = run_benchmark(repeats=args.repeats)
+    print(results.to_string(index=False))
+    if args.json:
+        results.to_json(args.json, orient='records', indent=2)
@@ -0,0 +1,75 @@
+''' LOF benchmark - accuracy / speed trade-off of the scalable LOF options against the exact scores '''
+import argparse
+import time
+import warnings
+
+import numpy as np
+import pandas as pd
+from scipy.stats import spearmanr
+
+from anomaly_scores.lof import local_outlier_factor, local_outlier_factor_unseen
+from data_preprocessing.standardization import Standardizer
+
+# name: keyword arguments of local_outlier_factor
+LOF_CONFIGS = {
+    'exact': {'algorithm': 'brute'},
+    'ball_tree': {'algorithm': 'ball_tree', 'leaf_size': 100},
+    'projection_16': {'n_components': 16},
+    'projection_32': {'n_components': 32},
+    'subsample_20%': {'max_samples': 0.2},
+    'subsample_20%_projection_32': {'max_samples': 0.2, 'n_components': 32},
+    'batches_10k': {'batch_size': 10000},
+}
+
+
+def make_data(n_rows, n_dims, outlier_rate=0.05, seed=0):
+    """ Gaussian clusters with a fraction of uniform outliers, and a binary label (outlier) """
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(scale=3, size=(5, n_dims))
+    X = centers[rng.integers(0, len(centers), n_rows)] + rng.normal(size=(n_rows, n_dims))
+    outliers = rng.random(n_rows) < outlier_rate
+    X[outliers] = rng.uniform(X.min(), X.max(), size=(outliers.sum(), n_dims))
+    columns = ['f%d' % i for i in range(n_dims)]
+    return pd.DataFrame(X, columns=columns), pd.Series(outliers.astype(int))
+
+
+def run_benchmark(n_train, n_test, n_dims, configs=LOF_CONFIGS):
+    """
+    Fits LOF with each configuration and compares its test scores to the exact ones.
+
+    Returns: A dataframe with the fit / score times, the Spearman correlation with the exact scores and the
+             overlap of the top 1% outliers.
+    """
+    X, y = make_data(n_train + n_test, n_dims)
+    features = list(X.columns)
+    standardizer = Standardizer()
+    X_train, y_train = standardizer.fit_transform(X.iloc[:n_train], features), y.iloc[:n_train]
+    X_test = standardizer.transform(X.iloc[n_train:])
+
+    results, exact_scores = [], None
+    for name, params in configs.items():
+        start = time.perf_counter()
+        _, lof_clf, _ = local_outlier_factor(X_train, features, standardizer=standardizer, y_train=y_train, **params)
+        fit_time = time.perf_counter() - start
+        start = time.perf_counter()
+        scores = local_outlier_factor_unseen(X_test, lof_clf, features, None, batch_size=params.get('batch_size'))
+        score_time = time.perf_counter() - start
+
+        if exact_scores is None:
+            exact_scores = scores
+        top_k = max(1, len(scores) // 100)
+        top_overlap = len(np.intersect1d(np.argsort(scores)[:top_k], np.argsort(exact_scores)[:top_k])) / top_k
+        results.append({'config': name, 'fit_sec': fit_time, 'score_sec': score_time,
+                        'spearman': spearmanr(scores, exact_scores)[0], 'top1%_overlap': top_overlap})
+
+    return pd.DataFrame(results)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--n-train', type=int, default=50000)
+    parser.add_argument('--n-test', type=int, default=10000)
+    parser.add_argument('--n-dims', type=int, default=100)
+    args = parser.parse_args()
+    warnings.filterwarnings('ignore', message='X does not have valid feature names')
+    print(run_benchmark(args.n_train, args.n_test, args.n_dims).to_string(index=False))
@@ -0,0 +1,181 @@
+''' Pipeline benchmark - time and peak memory of each stage, on a synthetic cohort (see synthetic_cohort.py) '''
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import time
+import tracemalloc
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from anomaly_scores.isolation_forest import calculate_IsolationForest_anomaly
+from anomaly_scores.lof import local_outlier_factor
+from anomaly_scores.ocsvm import one_class_svm
+from benchmarks.synthetic_cohort import VITAL_SIGNS, LAB_TESTS, make_cohort
+from data_preprocessing.data_preprocessing import create_time_series_data, create_time_grid
+from feature_generation.feature_generation import summary_statistics_features, add_lr_slope, features_ratio
+from feature_selection.feature_selection import feature_selection_corr, feature_selection_xgb
+from outlier_removal.outlier_removal import remove_out_of_range_values
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RANGES_PATH = os.path.join(ROOT, 'outlier_removal', 'feature_ranges.json')
+
+# name: (model class path, constructor keyword arguments)
+# (IterativeImputer over all the generated columns is slow, and may diverge on them)
+MODEL_CONFIGS = {
+    'LogRegModel': ('ml_models.regression_models.LogRegModel',
+                    {'penalty': 'l2', 'imputation_params': {'method': 'iterative_subset'}}),
+    'XgboostModel': ('ml_models.decision_trees_models.XgboostModel',
+                     {'n_estimators': 100, 'imputation_params': {'method': 'iterative_subset'}}),
+}
+
+
+def measure(results, stage, function, *args, trace_memory=True, **kwargs):
+    """
+    Runs function(*args, **kwargs) and appends its wall time, CPU time, peak traced memory (MB) and output shape to
+    results. The stage's prints are suppressed. Returns the function's output.
+    """
+    if trace_memory:
+        tracemalloc.start()
+    start, start_cpu = time.perf_counter(), time.process_time()
+    with contextlib.redirect_stdout(io.StringIO()):
+        output = function(*args, **kwargs)
+    seconds, cpu_seconds = time.perf_counter() - start, time.process_time() - start_cpu
+    peak = np.nan
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        tracemalloc.stop()
+
+    first = output[0] if isinstance(output, tuple) else output
+    shape = 'x'.join(str(size) for size in np.shape(first)) if hasattr(first, '__len__') else ''
+    results.append({'stage': stage, 'sec': seconds, 'cpu_sec': cpu_seconds, 'peak_mb': peak, 'output_shape': shape})
+    print(f"{stage}: {seconds:.3f} sec")
+    return output
+
+
+def run_benchmark(n_patients=1000, mean_stay_hours=96, missing_rate=0.2, anomaly_rows=5000, n_features=30,
+                  models=MODEL_CONFIGS, trace_memory=True, seed=0):
+    """
+    Runs the pipeline stages in order on a synthetic cohort: outlier removal in long format (timed only, the pipeline
+    continues with the wide format), time-series format, outlier removal, time grid, feature generation, anomaly
+    detectors trained on all the rows and on the negative ("majority") rows (on a sample of anomaly_rows imputed
+    training rows), feature selectors and the models' fit / evaluation (train / test split by patient).
+    With trace_memory, the times include the tracemalloc overhead (use trace_memory=False for clean timings).
+
+    Returns: A dataframe with the wall / CPU time, peak memory and output shape of each stage.
+    """
+    results = []
+
+    def run(stage, function, *args, **kwargs):
+        return measure(results, stage, function, *args, trace_memory=trace_memory, **kwargs)
+
+    baseline_df, vit_df, labs_df, outcome = make_cohort(n_patients, mean_stay_hours, missing_rate=missing_rate,
+                                                        seed=seed)
+
+    # Preprocessing
+    run('remove_out_of_range_values_long', remove_longitudinal_out_of_range_values, vit_df, labs_df)
+    df = run('create_time_series_data', create_time_series_data, baseline_df, vit_df, labs_df)
+    df, _ = run('remove_out_of_range_values', remove_out_of_range_values, df, RANGES_PATH)
+    df = run('create_time_grid', create_time_grid, df)
+
+    # Feature generation
+    df['DateTime'] = df['datetime']
+    df['time_since_admission'] = (df['datetime'] - df['admission_datetime']) / pd.Timedelta(hours=1)
+    vitals = [feature for feature in VITAL_SIGNS if feature in df.columns]
+    labs = [feature for feature in LAB_TESTS if feature in df.columns]
+    df = run('summary_statistics_features', summary_statistics_features, df, vitals + labs)
+    df = run('add_lr_slope', add_lr_slope, df, vitals + labs)
+    df = run('features_ratio', features_ratio, df, vitals)
+
+    # Model inputs: a train / test split by patient
+    y = df['patient_id'].map(outcome).astype(int)
+    X = df.drop(columns=['patient_id', 'datetime', 'admission_datetime', 'DateTime'])
+    train = df['patient_id'].isin(outcome.index[:int(0.8 * len(outcome))]).to_numpy()
+    X_train, y_train = X[train].reset_index(drop=True), y[train].reset_index(drop=True)
+    X_test, y_test = X[~train].reset_index(drop=True), y[~train].reset_index(drop=True)
+
+    # Anomaly detectors
+    numerical_cols = [col for col in X_train.columns if X_train[col].dtype != bool]
+    sample = X_train[numerical_cols].sample(min(anomaly_rows, len(X_train)), random_state=seed)
+    sample = sample.fillna(sample.median()).fillna(0)
+    majority = sample[(y_train.loc[sample.index] == 0).to_numpy()]  # the training set of the "majority" detectors
+    run('local_outlier_factor', local_outlier_factor, sample.copy(), numerical_cols)
+    run('local_outlier_factor_majority', local_outlier_factor, sample.copy(), numerical_cols,
+        majority_train=majority.copy())
+    run('one_class_svm', one_class_svm, sample.copy(), numerical_cols)
+    run('one_class_svm_majority', one_class_svm, sample.copy(), numerical_cols, majority_train=majority.copy())
+    run('one_class_svm_linear', one_class_svm, sample.copy(), numerical_cols, engine='linear')
+    run('one_class_svm_linear_majority', one_class_svm, sample.copy(), numerical_cols,
+        majority_train=majority.copy(), engine='linear')
+    run('isolation_forest', calculate_IsolationForest_anomaly, sample)
+
+    # Feature selectors
+    run('feature_selection_corr', feature_selection_corr, X_train, y_train, n_features)
+    run('feature_selection_corr_redundancy', feature_selection_corr, X_train, y_train, n_features,
+        redundancy_threshold=0.9)
+    run('feature_selection_xgb', feature_selection_xgb, X_train, y_train, n_features, use_cache=False)
+
+    # Models
+    for name, (class_path, params) in models.items():
+        module_name, class_name = class_path.rsplit('.', 1)
+        model = getattr(__import__(module_name, fromlist=[class_name]), class_name)(
+            selection_metric='Correlation', n_features=n_features, **params)
+        run(name + '.fit', model.fit, X_train.copy(), y_train)
+        run(name + '.evaluation', model.evaluation, X_test.copy(), y_test)
+
+    return pd.DataFrame(results)
+
+
+def remove_longitudinal_out_of_range_values(vit_df, labs_df):
+    """ The long-format mode of remove_out_of_range_values, on the vital signs and the lab tests """
+    return tuple(remove_out_of_range_values(df, RANGES_PATH, long_format=True)[0] for df in [vit_df, labs_df])
+
+
+def git_commit():
+    """ The current commit of the repository, if available """
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_results(results, baseline_path):
+    """ The ratio of each stage's time and peak memory to a previous run (a JSON file written by this benchmark) """
+    with open(baseline_path) as f:
+        baseline = pd.DataFrame(json.load(f)['results'])
+    compared = results.merge(baseline, on='stage', how='left', suffixes=('', '_baseline'))
+    compared['sec_ratio'] = compared['sec'] / compared['sec_baseline']
+    compared['peak_mb_ratio'] = compared['peak_mb'] / compared['peak_mb_baseline']
+    return compared[['stage', 'sec', 'sec_baseline', 'sec_ratio', 'peak_mb', 'peak_mb_baseline', 'peak_mb_ratio']]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--n-patients', type=int, default=1000)
+    parser.add_argument('--mean-stay-hours', type=float, default=96)
+    parser.add_argument('--missing-rate', type=float, default=0.2)
+    parser.add_argument('--anomaly-rows', type=int, default=5000)
+    parser.add_argument('--n-features', type=int, default=30)
+    parser.add_argument('--no-memory', action='store_true', help="Don't trace memory (clean timings)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='Also write the results to this JSON file (for comparison across commits)')
+    parser.add_argument('--compare', help='A JSON file of a previous run, to compare the results with')
+    args = parser.parse_args()
+    warnings.filterwarnings('ignore')
+
+    results = run_benchmark(args.n_patients, args.mean_stay_hours, args.missing_rate, args.anomaly_rows,
+                            args.n_features, trace_memory=not args.no_memory, seed=args.seed)
+    print(results.to_string(index=False))
+    if args.compare:
+        print(compare_results(results, args.compare).to_string(index=False))
+    if args.json:
+        config = {key: value for key, value in vars(args).items() if key not in ['json', 'compare']}
+        with open(args.json, 'w') as f:
+            json.dump({'commit': git_commit(), 'python': platform.python_version(), 'config': config,
+                       'results': results.to_dict(orient='records')}, f, indent=2)
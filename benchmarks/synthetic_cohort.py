@@ -0,0 +1,86 @@
+''' Synthetic cohort - baseline, vital signs and lab tests dataframes in the documented (parsed data) schema '''
+import numpy as np
+import pandas as pd
+
+# feature: (mean, sd) of the measured values. The names follow outlier_removal/feature_ranges.json
+VITAL_SIGNS = {'PUL': (85, 15), 'SBP': (125, 20), 'DBP': (75, 12), 'TMP': (37, 0.7), 'SPO2R': (93, 2),
+               'RRP': (18, 4), 'FIO2': (40, 8)}
+LAB_TESTS = {'CRP': (60, 30), 'WBC': (8, 3), 'HGB': (13, 1.8), 'PLT': (230, 70), 'SOD': (138, 4), 'POT': (4.2, 0.5),
+             'CRT': (1.1, 0.4), 'BUN': (20, 8), 'GLU': (130, 35), 'LDH': (300, 100), 'ALB': (3.8, 0.5),
+             'DDM': (1.5, 0.8), 'FER': (500, 200), 'LYM(%)': (20, 8), 'NEU(%)': (70, 10)}
+BACKGROUND_DISEASES = {'Diabetes': 0.25, 'Hypertension': 0.4, 'CHF': 0.08, 'CKD': 0.1}
+
+
+def make_cohort(n_patients=1000, mean_stay_hours=96, vital_rate=1.0, lab_rate=1 / 12, missing_rate=0.2,
+                outlier_rate=0.005, deterioration_rate=0.15, start='2020-03-01', days=365, seed=0):
+    """
+    Generates a synthetic cohort: admissions spread over days, exponential stay lengths, measurement rounds at random
+    times of the stay (a Poisson number per patient), per-patient offsets and a drift of the deteriorating patients.
+
+    Args:
+        n_patients: Number of patients.
+        mean_stay_hours: Mean length of stay, in hours.
+        vital_rate: Vital signs measurement rounds per hour.
+        lab_rate: Lab tests rounds per hour.
+        missing_rate: Fraction of the features missing from each measurement round.
+        outlier_rate: Fraction of out-of-range (x100) values, removed by remove_out_of_range_values.
+        deterioration_rate: Fraction of deteriorating patients.
+        start: The first admission date.
+        days: Admissions are uniform over this number of days.
+        seed: Random seed.
+
+    Returns:
+        baseline_df: patient_id, admission_datetime, Gender, Age and the background diseases.
+        vit_df, labs_df: patient_id, datetime, Feature, Value, sorted by patient and datetime.
+        outcome: The deterioration label of each patient (indexed by patient_id).
+    """
+    rng = np.random.default_rng(seed)
+    patients = np.array(['P%07d' % i for i in range(n_patients)], dtype=object)
+    admission = pd.Timestamp(start) + pd.to_timedelta(rng.random(n_patients) * days * 24 * 60, unit='min').floor('min')
+    stay_hours = np.maximum(2.0, rng.exponential(mean_stay_hours, n_patients))
+    deterioration = rng.random(n_patients) < deterioration_rate
+
+    baseline_df = pd.DataFrame({'patient_id': patients,
+                                'admission_datetime': admission,
+                                'Gender': rng.random(n_patients) < 0.5,
+                                'Age': np.clip(rng.normal(65, 15, n_patients), 18, 100).round()})
+    for disease, prevalence in BACKGROUND_DISEASES.items():
+        baseline_df[disease] = rng.random(n_patients) < prevalence
+
+    vit_df, labs_df = [make_longitudinal(rng, patients, admission, stay_hours, deterioration, features, rate,
+                                         missing_rate, outlier_rate)
+                       for features, rate in [(VITAL_SIGNS, vital_rate), (LAB_TESTS, lab_rate)]]
+    outcome = pd.Series(deterioration.astype(int), index=pd.Index(patients, name='patient_id'), name='deterioration')
+    return baseline_df, vit_df, labs_df, outcome
+
+
+def make_longitudinal(rng, patients, admission, stay_hours, deterioration, features, rate, missing_rate,
+                      outlier_rate):
+    """ The measurements of features (a dict of (mean, sd)) of all the patients. An helper function of make_cohort() """
+    names = list(features)
+    means, sds = np.array([features[name] for name in names], dtype=float).T
+    direction = rng.choice([-1.0, 1.0], len(names))
+    offsets = rng.normal(scale=0.5, size=(len(patients), len(names)))
+
+    # Measurement rounds, then the recorded (round, feature) pairs
+    n_rounds = np.maximum(1, rng.poisson(stay_hours * rate))
+    round_patient = np.repeat(np.arange(len(patients)), n_rounds)
+    round_hours = rng.random(len(round_patient)) * stay_hours[round_patient]
+    row_round = np.repeat(np.arange(len(round_patient)), len(names))
+    row_feature = np.tile(np.arange(len(names)), len(round_patient))
+    recorded = rng.random(len(row_round)) >= missing_rate
+    row_round, row_feature = row_round[recorded], row_feature[recorded]
+    row_patient, row_hours = round_patient[row_round], round_hours[row_round]
+
+    # Deteriorating patients drift (by up to 2 SDs) towards the end of their stay
+    drift = 2.0 * deterioration[row_patient] * (row_hours / stay_hours[row_patient]) * direction[row_feature]
+    z_scores = offsets[row_patient, row_feature] + drift + rng.normal(size=len(row_patient))
+    values = np.abs(means[row_feature] + sds[row_feature] * z_scores)
+    outliers = rng.random(len(values)) < outlier_rate
+    values[outliers] *= 100
+
+    df = pd.DataFrame({'patient_id': patients[row_patient],
+                       'datetime': admission[row_patient] + pd.to_timedelta(row_hours * 60, unit='min').floor('min'),
+                       'Feature': np.array(names, dtype=object)[row_feature],
+                       'Value': values})
+    return df.sort_values(by=['patient_id', 'datetime'], kind='stable', ignore_index=True)
@@ -0,0 +1,163 @@
+''' Column profile - per-column statistics of a dataframe, computed in one vectorized (chunked) pass '''
+import numpy as np
+import pandas as pd
+
+# Numerical columns are processed in blocks of up to this number of values (rows x columns)
+MAX_BLOCK_VALUES = 2 ** 22
+
+
+class ColumnProfile:
+    """
+    The ColumnProfile object holds the statistics of each column, as Series indexed by the column names:
+    count (non-null values), missing_rate, mean, std (ddof=1), min, max, nunique (of the non-null values, capped
+    at max_unique) and mode (the smallest of the most frequent values, as pandas mode().iloc[0]).
+    Steps that need these statistics (constant columns, standardization parameters, the standardization check,
+    the bool columns mode, centering for correlations) read them from the profile instead of scanning the data.
+    """
+
+    def __init__(self, n_rows, count, mean, std, min, max, nunique, mode, max_unique=None):
+        self.n_rows = n_rows
+        self.count = count
+        self.missing_rate = 1 - count / n_rows if n_rows else count * np.nan
+        self.mean = mean
+        self.std = std
+        self.min = min
+        self.max = max
+        self.nunique = nunique
+        self.mode = mode
+        self.max_unique = max_unique
+
+    @property
+    def columns(self):
+        return list(self.count.index)
+
+    def constant_columns(self):
+        """ Columns with a single distinct (non-null) value - a lookup of min == max (or nunique for non-numeric) """
+        numerical = self.min.notna()
+        constant = np.where(numerical, self.min == self.max, self.nunique == 1)
+        return list(self.count.index[constant])
+
+    def is_standardized(self, features, epsilon=1e-10):
+        """ Whether the features have mean == 0 and std == 1, up to epsilon. Returns (flag, first failing feature). """
+        mean, std = self.mean[features].to_numpy(), self.std[features].to_numpy()
+        not_standardized = ~((np.abs(mean) <= epsilon) & (np.abs(std - 1) <= epsilon))
+        if not_standardized.any():
+            return False, features[np.flatnonzero(not_standardized)[0]]
+        return True, None
+
+    def standardized(self, standardizer):
+        """ The profile of the data after standardizer.transform (its features' statistics shifted and scaled) """
+        stats = {name: getattr(self, name).copy() for name in ['count', 'mean', 'std', 'min', 'max', 'nunique', 'mode']}
+        positions = [position for position, feature in enumerate(standardizer.features) if feature in self.count.index]
+        features = [standardizer.features[position] for position in positions]
+        mean, scale = standardizer.mean[positions], standardizer.scale[positions]
+        for name in ['mean', 'min', 'max']:
+            stats[name][features] = (stats[name][features].to_numpy(dtype=float) - mean) / scale
+        stats['std'][features] = stats['std'][features].to_numpy(dtype=float) / scale
+        stats['mode'][features] = (stats['mode'][features].to_numpy(dtype=float) - mean) / scale
+        return ColumnProfile(self.n_rows, max_unique=self.max_unique, **stats)
+
+    def with_columns(self, other):
+        """ The profile with the columns of other (a profile of the same rows), e.g. columns added to the data """
+        stats = {name: pd.concat([getattr(self, name).drop(other.count.index, errors='ignore'), getattr(other, name)])
+                 for name in ['count', 'mean', 'std', 'min', 'max', 'nunique', 'mode']}
+        return ColumnProfile(self.n_rows, max_unique=self.max_unique, **stats)
+
+    def to_frame(self):
+        """ The profile as a dataframe (columns x statistics) """
+        return pd.DataFrame({'count': self.count, 'missing_rate': self.missing_rate, 'mean': self.mean,
+                             'std': self.std, 'min': self.min, 'max': self.max, 'nunique': self.nunique,
+                             'mode': self.mode})
+
+
+def column_profile(df, columns=None, distinct=True, max_unique=1000):
+    """
+    Profiles the columns of df. Numerical (and bool) columns are processed together, in blocks of columns:
+    one pass for the moments, and with distinct=True one sort of the block for nunique and mode.
+    Other columns (strings, categories, dates) get count, nunique and mode by pandas, one at a time.
+
+    Args:
+        df: A dataframe.
+        columns: The profiled columns (default: all).
+        distinct: Whether to compute nunique and mode of the numerical columns (requires sorting them), or the
+                  numerical columns for which to compute them.
+        max_unique: nunique is reported up to this value (larger numbers of distinct values are reported as it).
+
+    Returns: A ColumnProfile.
+    """
+    columns = list(df.columns if columns is None else columns)
+    n_rows = len(df)
+    numerical = [col for col in columns if pd.api.types.is_numeric_dtype(df[col]) or
+                 pd.api.types.is_bool_dtype(df[col])]
+    index = pd.Index(columns)
+    stats = {name: pd.Series(np.nan, index=index, dtype=float) for name in ['count', 'mean', 'std', 'min', 'max']}
+    stats['nunique'] = pd.Series(0.0 if n_rows == 0 else np.nan, index=index)
+    stats['mode'] = pd.Series(np.nan, index=index, dtype=object)
+
+    distinct_cols = set(numerical if distinct is True else distinct or [])
+    block_size = max(1, MAX_BLOCK_VALUES // max(n_rows, 1))
+    for start in range(0, len(numerical), block_size):
+        block = numerical[start:start + block_size]
+        values = df[block].to_numpy(dtype=float, na_value=np.nan)
+        for name, block_values in moments(values).items():
+            stats[name][block] = block_values
+        positions = [position for position, col in enumerate(block) if col in distinct_cols]
+        if positions and n_rows:
+            distinct_block = [block[position] for position in positions]
+            stats['nunique'][distinct_block], stats['mode'][distinct_block] = distinct_values(
+                values[:, positions], stats['count'][distinct_block].to_numpy().astype(int))
+
+    numerical_set = set(numerical)
+    for col in [col for col in columns if col not in numerical_set]:
+        values = df[col].dropna()
+        stats['count'][col] = len(values)
+        stats['nunique'][col] = values.nunique()
+        stats['mode'][col] = values.mode().iloc[0] if len(values) else np.nan
+
+    if max_unique is not None:
+        stats['nunique'] = stats['nunique'].clip(upper=max_unique)
+    return ColumnProfile(n_rows, max_unique=max_unique, **stats)
+
+
+def moments(values):
+    """
+    count, mean, std (ddof=1), min and max of each column of a 2-D array, ignoring NaN.
+    An helper function of column_profile()
+    """
+    valid = ~np.isnan(values)
+    count = valid.sum(axis=0)
+    deviations = np.where(valid, values, 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = deviations.sum(axis=0) / count
+        np.subtract(deviations, mean, out=deviations)
+        deviations[~valid] = 0
+        std = np.sqrt(np.square(deviations, out=deviations).sum(axis=0) / np.where(count > 1, count - 1, np.nan))
+    min_values = np.fmin.reduce(values, axis=0, initial=np.nan)  # NaN ignored
+    max_values = np.fmax.reduce(values, axis=0, initial=np.nan)
+    return {'count': count, 'mean': mean, 'std': std, 'min': min_values, 'max': max_values}
+
+
+def distinct_values(values, count):
+    """
+    The number of distinct values and the mode of each column of a 2-D array, by sorting the columns (NaN last)
+    and measuring the runs of equal values. An helper function of column_profile()
+    """
+    n_rows, n_cols = values.shape
+    sorted_values = np.sort(values, axis=0).T.ravel()  # column after column
+    valid = (np.arange(n_rows)[None, :] < count[:, None]).ravel()
+    new_run = np.ones(len(sorted_values), dtype=bool)
+    new_run[1:] = sorted_values[1:] != sorted_values[:-1]
+    new_run[::n_rows] = True
+    new_run &= valid
+    nunique = new_run.reshape(n_cols, n_rows).sum(axis=1)
+
+    # The longest run of each column (the first one, i.e. the smallest value, on ties)
+    run_starts = np.flatnonzero(new_run)
+    run_lengths = np.diff(np.r_[run_starts, len(sorted_values)])
+    run_columns = run_starts // n_rows
+    run_lengths = np.minimum(run_lengths, (run_columns * n_rows + count[run_columns]) - run_starts)
+    order = np.lexsort((run_starts, -run_lengths, run_columns))
+    columns, first = np.unique(run_columns[order], return_index=True)
+    mode = np.full(n_cols, np.nan)
+    mode[columns] = sorted_values[run_starts[order[first]]]
+    return nunique, mode
@@ -1,9 +1,14 @@
 ''' Data preprocessing '''
 import pandas as pd
 import numpy as np
+from pandas.tseries.frequencies import to_offset
 
+from data_preprocessing.column_profile import column_profile
 
-def create_time_series_data(baseline_df, vit_df, labs_df):
+LONGITUDINAL_COLS = ['patient_id', 'datetime', 'Feature', 'Value']
+
+
+def create_time_series_data(baseline_df, vit_df, labs_df, dtype=np.float32):
     """
     Create time-series format containing both longitudinal and baseline features.
 
@@ -11,52 +16,113 @@ def create_time_series_data(baseline_df, vit_df, labs_df):
         baseline_df: Baseline dataframe, including demographics, background diseases etc.
         vit_df: Vital signs dataframe.
         labs_df: Lab test results dataframe.
+        dtype: The data type of the pivoted longitudinal features.
 
     Returns: dataframe in time-series format [columns: features, rows: patients' observations].
     """
-    # Merge longitudinal and baseline DFs
-    longitudinal_df = pd.concat([labs_df, vit_df])
-    long_data = pd.merge(longitudinal_df, baseline_df, on='patient_id', how='left')
-
-    # Pivot table
-    baseline_features = list(baseline_df.columns)  # these features are set as indices in the pivoted DF
-    pivot_df = pivot_data_frame(long_data, baseline_features)
-    pivot_df = pivot_df.sort_values(by=['admission_datetime', 'patient_id', 'datetime'],
-                                    ascending=True).reset_index(drop=True)
+    longitudinal_df = pd.concat([labs_df[LONGITUDINAL_COLS], vit_df[LONGITUDINAL_COLS]], ignore_index=True)
+    pivot_df = pivot_data_frame(longitudinal_df, baseline_df, dtype=dtype)
     return pivot_df
 
 
-def pivot_data_frame(df, baseline_features):
+def create_time_series_data_chunks(baseline_df, vit_df, labs_df, patients_per_chunk=1000, dtype=np.float32):
     """
-    Pivot the dataframe (T). Baseline features remains constant (indices of pivoted table)
+    Chunked version of create_time_series_data(), for cohorts whose time-series data doesn't fit in memory.
+    Yields the time-series data of consecutive groups of patients. All the chunks have the same columns, and their
+    concatenation equals the output of create_time_series_data().
+
+    Args:
+        baseline_df: Baseline dataframe, including demographics, background diseases etc.
+        vit_df: Vital signs dataframe.
+        labs_df: Lab test results dataframe.
+        patients_per_chunk: Number of patients in each chunk.
+        dtype: The data type of the pivoted longitudinal features.
+
+    Yields: dataframes in time-series format.
     """
-    # Nan values are deleted in the pivot operation.
-    # Temporary fill Nan
-    df[baseline_features] = df[baseline_features].fillna('dummy')
+    longitudinal_dfs = [labs_df, vit_df]
+    features = sorted(set().union(*[df.loc[df['Value'].notna(), 'Feature'].unique() for df in longitudinal_dfs]))
 
-    # Remove NULL values
-    df = df[~df.Value.isna()]
+    # Chunks follow the output order (admission time, patient), so their concatenation remains sorted
+    patients = pd.unique(pd.concat([df['patient_id'] for df in longitudinal_dfs]).dropna())
+    admission = baseline_df.set_index('patient_id')['admission_datetime'].reindex(patients).to_numpy()
+    patient_order = pd.DataFrame({'patient_id': patients, 'admission_datetime': admission}).sort_values(
+        by=['admission_datetime', 'patient_id'])
+    patient_chunk = pd.Series(np.arange(len(patients)) // patients_per_chunk, index=patient_order['patient_id'])
+
+    # Row positions of each chunk, computed once per longitudinal dataframe
+    chunks_rows = []
+    for df in longitudinal_dfs:
+        row_chunks = patient_chunk.reindex(df['patient_id']).to_numpy()
+        chunks_rows.append(pd.Series(row_chunks).groupby(row_chunks).indices)
 
-    # Define indices (constant columns that are not pivoted)
-    indices = baseline_features + ['datetime']
+    for chunk in range(int(np.ceil(len(patients) / patients_per_chunk))):
+        chunk_df = pd.concat([df[LONGITUDINAL_COLS].iloc[rows.get(chunk, [])]
+                              for df, rows in zip(longitudinal_dfs, chunks_rows)], ignore_index=True)
+        yield pivot_data_frame(chunk_df, baseline_df, features=features, dtype=dtype)
 
-    # Pivot table
-    pivoted_df = df.pivot_table(index=indices,
-                                columns='Feature',
-                                values='Value',
-                                aggfunc='first').reset_index().replace('dummy', np.nan)
-    return pivoted_df
 
+def pivot_data_frame(df, baseline_df, features=None, dtype=np.float32):
+    """
+    Pivot the longitudinal dataframe (T), and join the baseline features once per patient.
+    Values are scattered into a preallocated matrix, keyed by the codes of (patient, datetime) and Feature.
+    The first value is kept for duplicated measurements.
+
+    Args:
+        df: Longitudinal dataframe, containing "patient_id", "datetime", "Feature" and "Value".
+        baseline_df: Baseline dataframe, containing "patient_id" and "admission_datetime".
+        features: The pivoted features (columns). Default: all the features in df.
+        dtype: The data type of the pivoted values.
 
-def create_time_grid(df, time_freq='60T', agg_method='mean'):
+    Returns: dataframe in time-series format, sorted by admission time, patient and datetime.
+    """
+    # Remove NULL values
+    df = df[df['Value'].notna() & df['patient_id'].notna() & df['datetime'].notna()]
+    if features is None:
+        features = sorted(df['Feature'].unique())
+
+    patient_codes, patients = pd.factorize(df['patient_id'], sort=True)
+    feature_codes = pd.Categorical(df['Feature'], categories=features).codes
+    date_times = df['datetime'].to_numpy(dtype='datetime64[ns]')
+    values = df['Value'].to_numpy()
+
+    # Unique (patient, datetime) rows, in the output order
+    baseline_df = baseline_df.set_index('patient_id', drop=False).reindex(patients)
+    admission = baseline_df['admission_datetime'].to_numpy(dtype='datetime64[ns]')
+    order = np.lexsort((date_times, patient_codes, admission[patient_codes]))
+    sorted_patients, sorted_times = patient_codes[order], date_times[order]
+    new_row = np.r_[True, (sorted_patients[1:] != sorted_patients[:-1]) | (sorted_times[1:] != sorted_times[:-1])]
+    row_codes = np.empty(len(order), dtype=np.int64)
+    row_codes[order] = np.cumsum(new_row) - 1
+    row_patients, row_times = sorted_patients[new_row], sorted_times[new_row]
+
+    # Scatter the first value of each (row, feature) into the matrix
+    flat_index = row_codes * len(features) + feature_codes
+    valid = feature_codes >= 0
+    flat_index, first = np.unique(flat_index[valid], return_index=True)
+    pivoted_values = np.full((len(row_patients), len(features)), np.nan, dtype=dtype)
+    pivoted_values.ravel()[flat_index] = values[valid][first]
+
+    # Join baseline features
+    baseline_rows = baseline_df.iloc[row_patients].reset_index(drop=True)
+    baseline_rows['patient_id'] = patients[row_patients]  # also for patients missing from baseline_df
+    pivot_df = pd.concat([baseline_rows,
+                          pd.DataFrame({'datetime': row_times}),
+                          pd.DataFrame(pivoted_values, columns=pd.Index(features, name='Feature'))], axis=1)
+    return pivot_df
+
+
+def create_time_grid(df, time_freq='60min', agg_method='mean', agg_map=None):
     """
     Creates discrete time grid to time-series data, according to fixed frequency.
     Multiple numerical values (within the same time-window) are aggregated by mean. The remaining grouped by first.
-    For grouping the target outcome, one should consider agg_method='max'.
+    For grouping the target outcome, one should consider agg_method='max', or agg_map={<target>: 'max'}.
     Args:
         df: A dataframe in time-series format.
         time_freq: The grid resolution (default=hourly grid)
         agg_method: The aggregation method for numerical columns
+        agg_map: Optional aggregation methods per column (e.g. {'target': 'max', 'HR': 'last'}),
+                 overriding agg_method and "first".
 
     Returns: discretized dataframe.
     """
@@ -66,30 +132,43 @@ def create_time_grid(df, time_freq='60T', agg_method='mean'):
     non_numeric_cols = list(df.select_dtypes(exclude=np.number).columns)
     indices = ['patient_id', 'datetime']
 
-    df['datetime'] = pd.DatetimeIndex(df['datetime'])
-    df.set_index('datetime', inplace=True)
-    df = df.sort_values(by=indices)
+    agg_map = {} if agg_map is None else agg_map
+    aggregations = {col: agg_map.get(col, agg_method if col in numeric_cols else 'first')
+                    for col in df.columns if col not in indices}
+
+    df = df.sort_values(by=indices, kind='stable')  # "first" is the earliest value of the time window
 
-    # Perform discretization: numerical cols by agg_method, and non-numerical cols by "first"
-    grouper = [df['patient_id'], pd.Grouper(level='datetime', freq=time_freq)]
-    agg_method_df = pd.DataFrame(df.groupby(grouper).agg(agg_method).to_records())[indices + numeric_cols]
-    first_df = pd.DataFrame(df.groupby(grouper).agg('first').to_records())[non_numeric_cols]
-    out_df = pd.merge(first_df, agg_method_df, how='left', on=indices)
+    # Floor each timestamp to its time window. Windows start at midnight of the first day, like pd.Grouper.
+    date_times = pd.DatetimeIndex(df['datetime'])
+    origin = date_times.min().normalize()
+    freq = pd.Timedelta(to_offset(time_freq))
+    time_bins = origin + ((date_times - origin) // freq) * freq
+
+    # Perform discretization in a single groupby: numerical cols by agg_method, and non-numerical cols by "first"
+    out_df = df.groupby([df['patient_id'].to_numpy(), time_bins], sort=True).agg(aggregations)
+    out_df.index.names = indices
+    out_df = out_df.reset_index()[non_numeric_cols + numeric_cols]
 
     assert (sorted(out_df.columns) == sorted(original_cols)), "Error! At least one column was lost"
 
     return out_df
 
 
-def drop_indifferent_features(df):
-    """ Drops features with SD==0 """
-    features = df.columns
-    drop_list = []
-    for feature in features:
-        unique_values = df[~df[feature].isna()][feature].unique()
-        if len(unique_values) == 1:
-            print("%s has std=0" % feature)
-            drop_list.append(feature)
+def drop_indifferent_features(df, profile=None):
+    """
+    Drops features with SD==0 (a single distinct value), looked up in the column profile of df.
+
+    Args:
+        df: A dataframe.
+        profile: The ColumnProfile of df, if already computed (otherwise computed here, without distinct values).
+
+    Returns: df without the constant features.
+    """
+    if profile is None:
+        profile = column_profile(df, distinct=False)
+    drop_list = profile.constant_columns()
+    for feature in drop_list:
+        print("%s has std=0" % feature)
     df = df.drop(columns=drop_list)
 
     return df
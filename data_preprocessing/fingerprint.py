@@ -0,0 +1,31 @@
+''' Content fingerprints of data frames, used as cache keys '''
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+
+def data_fingerprint(*objects):
+    """
+    Returns a hex digest of the given objects' content.
+    DataFrames and Series are hashed by their values, index, columns and dtypes (hash_pandas_object),
+    arrays by their bytes, and other objects (parameters) by their repr.
+    Equal content gives an equal fingerprint, regardless of the objects' identity.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for obj in objects:
+        if isinstance(obj, (pd.DataFrame, pd.Series)):
+            digest.update(pd.util.hash_pandas_object(obj, index=True).to_numpy().tobytes())
+            columns = obj.columns if isinstance(obj, pd.DataFrame) else [obj.name]
+            dtypes = obj.dtypes if isinstance(obj, pd.DataFrame) else [obj.dtype]
+            digest.update(repr((list(columns), [str(dtype) for dtype in dtypes])).encode())
+        elif isinstance(obj, np.ndarray):
+            digest.update(repr((obj.shape, str(obj.dtype))).encode())
+            digest.update(np.ascontiguousarray(obj).tobytes())
+        elif isinstance(obj, dict):
+            digest.update(repr(sorted(obj.items())).encode())
+        else:
+            digest.update(repr(obj).encode())
+        digest.update(b'|')
+
+    return digest.hexdigest()
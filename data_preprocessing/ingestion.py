@@ -0,0 +1,152 @@
+''' Columnar ingestion of the parsed dataframes (baseline, vital signs, lab tests) as partitioned Parquet datasets '''
+import os
+
+import numpy as np
+import pandas as pd
+
+from data_preprocessing.data_preprocessing import LONGITUDINAL_COLS
+
+COHORT_DATASETS = ['baseline', 'vitals', 'labs']
+PARTITION_METHODS = ['admission_month', 'patient_hash']
+
+
+def compact_longitudinal_frame(df):
+    """
+    Compact dtypes of a longitudinal dataframe (vital signs / lab tests): categorical "patient_id" and "Feature",
+    datetime64 "datetime" and float32 "Value".
+    """
+    return pd.DataFrame({'patient_id': df['patient_id'].astype('category'),
+                         'datetime': pd.to_datetime(df['datetime']),
+                         'Feature': df['Feature'].astype('category'),
+                         'Value': pd.to_numeric(df['Value'], errors='coerce').astype(np.float32)}, index=df.index)
+
+
+def compact_baseline_frame(df):
+    """ Compact dtypes of the baseline dataframe: categorical strings (and "patient_id"), float32 numbers """
+    df = df.copy()
+    for col in df.columns:
+        if col == 'patient_id' or df[col].dtype == object:
+            df[col] = df[col].astype('category')
+        elif pd.api.types.is_float_dtype(df[col]):
+            df[col] = df[col].astype(np.float32)
+    return df
+
+
+def write_cohort(root, baseline_df, vit_df, labs_df, partition_by='admission_month', n_buckets=16):
+    """
+    Writes the three parsed dataframes as Parquet datasets under root ("baseline", "vitals", "labs"),
+    with compact dtypes, hive-partitioned by the patients' admission month ("admission_month=YYYY-MM")
+    or by a hash of the patient id ("patient_bucket=<0..n_buckets-1>").
+    """
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    assert partition_by in PARTITION_METHODS, f"Error! Invalid partition method, expected one of {PARTITION_METHODS}"
+    baseline_df = compact_baseline_frame(baseline_df)
+    patient_partition = patient_partitions(baseline_df, partition_by, n_buckets)
+
+    frames = {'baseline': baseline_df,
+              'vitals': compact_longitudinal_frame(vit_df[LONGITUDINAL_COLS]),
+              'labs': compact_longitudinal_frame(labs_df[LONGITUDINAL_COLS])}
+    for name, df in frames.items():
+        partition_col = patient_partition.name
+        patient_ids = df['patient_id'].astype(str)
+        if partition_by == 'patient_hash':
+            partition = patient_bucket(patient_ids, n_buckets)
+        else:
+            partition = patient_ids.map(patient_partition).fillna('unknown').to_numpy()
+        table = pa.Table.from_pandas(df.assign(**{partition_col: partition}), preserve_index=False)
+        ds.write_dataset(table, os.path.join(root, name), format='parquet', partitioning=[partition_col],
+                         partitioning_flavor='hive', existing_data_behavior='delete_matching')
+
+
+def read_cohort(root, start=None, end=None, features=None, patients=None):
+    """
+    Reads the datasets written by write_cohort, with compact dtypes. Filters are pushed down to the Parquet scan
+    (partitions and row groups that can't match are skipped).
+
+    Args:
+        root: Directory of the cohort datasets.
+        start: If given, only measurements at or after this time.
+        end: If given, only measurements before this time, and only patients admitted before it.
+        features: If given, only measurements of these features.
+        patients: If given, only these patients.
+
+    Returns: baseline_df, vit_df, labs_df (the inputs of create_time_series_data). The longitudinal dataframes share
+             the categories of "patient_id" and "Feature", so they are concatenated without converting them.
+    """
+    import pyarrow.dataset as ds
+
+    start = None if start is None else pd.Timestamp(start)
+    end = None if end is None else pd.Timestamp(end)
+    baseline_filter = None
+    if end is not None:
+        baseline_filter = ds.field('admission_datetime') < end
+    baseline_df = read_dataset(os.path.join(root, 'baseline'), baseline_filter, end, patients=patients)
+
+    longitudinal_filter = None
+    if start is not None:
+        longitudinal_filter = and_filters(longitudinal_filter, ds.field('datetime') >= start)
+    if end is not None:
+        longitudinal_filter = and_filters(longitudinal_filter, ds.field('datetime') < end)
+    if features is not None:
+        longitudinal_filter = and_filters(longitudinal_filter, ds.field('Feature').isin(list(features)))
+    vit_df, labs_df = [read_dataset(os.path.join(root, name), longitudinal_filter, end, LONGITUDINAL_COLS,
+                                    patients=patients)
+                       for name in ['vitals', 'labs']]
+
+    # Shared categories
+    for col in ['patient_id', 'Feature']:
+        categories = pd.api.types.union_categoricals([vit_df[col], labs_df[col]]).categories
+        vit_df[col] = vit_df[col].cat.set_categories(categories)
+        labs_df[col] = labs_df[col].cat.set_categories(categories)
+    return baseline_df, vit_df, labs_df
+
+
+def read_dataset(path, row_filter=None, end=None, columns=None, patients=None):
+    """
+    Reads a (hive-partitioned) Parquet dataset into a dataframe with compact dtypes.
+    If end is given and the dataset is partitioned by admission month, later months are pruned.
+    If patients are given, they are matched in the dataset's own "patient_id" type (e.g. integer ids).
+    An helper function of read_cohort()
+    """
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    dataset = ds.dataset(path, format='parquet', partitioning='hive')
+    if patients is not None:
+        id_type = dataset.schema.field('patient_id').type
+        if pa.types.is_dictionary(id_type):
+            id_type = id_type.value_type
+        patient_ids = pa.array([str(patient) for patient in patients]).cast(id_type)
+        row_filter = and_filters(row_filter, ds.field('patient_id').isin(patient_ids))
+    if end is not None and 'admission_month' in dataset.schema.names:
+        row_filter = and_filters(row_filter, (ds.field('admission_month') <= end.strftime('%Y-%m')) |
+                                 (ds.field('admission_month') == 'unknown'))
+    table = dataset.to_table(columns=columns, filter=row_filter)
+    df = table.to_pandas()
+    df = df.drop(columns=[col for col in ['admission_month', 'patient_bucket'] if col in df.columns])
+
+    if columns == LONGITUDINAL_COLS:
+        return compact_longitudinal_frame(df)
+    df['patient_id'] = df['patient_id'].astype('category')
+    return df
+
+
+def patient_partitions(baseline_df, partition_by, n_buckets):
+    """ The partition of each patient (by patient id), named as its partition column """
+    patient_ids = baseline_df['patient_id'].astype(str)
+    if partition_by == 'patient_hash':
+        return pd.Series(patient_bucket(patient_ids, n_buckets), index=patient_ids.to_numpy(), name='patient_bucket')
+
+    months = pd.to_datetime(baseline_df['admission_datetime']).dt.strftime('%Y-%m').fillna('unknown')
+    return pd.Series(months.to_numpy(), index=patient_ids.to_numpy(), name='admission_month')
+
+
+def patient_bucket(patient_ids, n_buckets):
+    """ A stable hash bucket of each patient id """
+    return (pd.util.hash_array(np.asarray(patient_ids, dtype=object)) % np.uint64(n_buckets)).astype(np.int32)
+
+
+def and_filters(left, right):
+    return right if left is None else left & right
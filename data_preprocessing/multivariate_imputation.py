@@ -1,10 +1,14 @@
-''' Data imputation - multivariate Iterative Imputation, inspired by MICE '''
-import sklearn
-from sklearn.experimental import enable_iterative_imputer
-from sklearn.impute import IterativeImputer
+''' Data imputation - multivariate Iterative Imputation, inspired by MICE, and faster alternative engines '''
+import time
 
+import numpy as np
+import pandas as pd
 
-def multivariate_imputation_seen(X_train, columns):
+IMPUTATION_METHODS = ['iterative', 'iterative_subset', 'knn', 'locf']
+
+
+def multivariate_imputation_seen(X_train, columns, method='iterative', add_indicator=False, groups=None,
+                                 **method_params):
     """
     Perform multivariate iterative imputation for SEEN data (training set).
     Should be done for train and test separately to avoid data leakage.
@@ -12,18 +16,31 @@ def multivariate_imputation_seen(X_train, columns):
     Args:
         X_train: Training set.
         columns: Numerical columns to be imputed
+        method: The imputation engine:
+                'iterative' - sklearn's IterativeImputer (round-robin over all the columns).
+                'iterative_subset' - Iterative imputation (as IterativeImputer) where each column is regressed
+                                     only on its n_nearest_features (default 10) most correlated columns
+                                     (absolute correlation on the training rows). See CorrelatedSubsetImputer.
+                'knn' - KNNImputer fitted on a single subsample (max_samples, default 10000 rows). Only the
+                        imputation (transform) is applied in batches of rows (batch_size, default 10000). Columns
+                        without values in the subsample are kept (keep_empty_features), imputed as 0.
+                'locf' - Per-patient last observation carried forward (requires groups), then training medians.
+        add_indicator: Whether to add "<column>_missing" indicator columns (for columns with missing values).
+        groups: Patient ids aligned with X_train (required by 'locf').
+        method_params: Additional keyword arguments of the imputation engine.
 
     Returns:
         X_train: Imputed training set.
         imputer: Fitted imputation model for test set imputation
     """
-    imputer = IterativeImputer()
-    X_train[columns] = imputer.fit_transform(X_train[columns])
+    imputer = Imputer(method, add_indicator, **method_params)
+    X_train = imputer.fit_transform(X_train, columns, groups)
+    print(f"{method} imputation was fitted in {imputer.fit_time:.2f} seconds")
 
     return X_train, imputer
 
 
-def multivariate_imputation_unseen(X_test, columns, imputer):
+def multivariate_imputation_unseen(X_test, columns, imputer, groups=None):
     """
     Perform multivariate iterative imputation for UNSEEN data (test set).
     Should be done for train and test separately to avoid data leakage.
@@ -32,10 +49,189 @@ def multivariate_imputation_unseen(X_test, columns, imputer):
         X_test: Test set.
         columns: Numerical columns to be imputed
         imputer: Fitted imputation model.
+        groups: Patient ids aligned with X_test (required by 'locf').
 
     Returns: X_test: Imputed training set.
     """
-    assert type(imputer) == sklearn.impute.IterativeImputer, "Error! Invalid imputer's type"
-    X_test[columns] = imputer.transform(X_test[columns])
+    assert isinstance(imputer, Imputer), "Error! Invalid imputer's type"
+    X_test = imputer.transform(X_test, columns, groups)
 
     return X_test
+
+
+class Imputer:
+    """
+    The Imputer object wraps the imputation engines behind a single fit_transform / transform API,
+    adds the optional missing-indicator columns and reports the fit time.
+    """
+
+    def __init__(self, method='iterative', add_indicator=False, **method_params):
+        assert method in IMPUTATION_METHODS, f"Error! Invalid imputation method, expected one of {IMPUTATION_METHODS}"
+        self.method = method
+        self.add_indicator = add_indicator
+        self.method_params = method_params
+        self.engine = None
+        self.medians = None
+        self.batch_size = 10000
+        self.indicator_cols = []
+        self.fit_time = 0
+
+    def fit_transform(self, df, columns, groups=None):
+        """ Fits the imputation engine on df (training set) and imputes it """
+        start = time.perf_counter()
+        columns = list(columns)
+        self.indicator_cols = [col for col in columns if df[col].isnull().any()] if self.add_indicator else []
+        indicators = df[self.indicator_cols].isnull()
+        params = dict(self.method_params)
+
+        if self.method == 'iterative':
+            from sklearn.experimental import enable_iterative_imputer
+            from sklearn.impute import IterativeImputer
+            self.engine = IterativeImputer(**params)
+            df[columns] = self.engine.fit_transform(df[columns])
+
+        elif self.method == 'iterative_subset':
+            self.engine = CorrelatedSubsetImputer(**params)
+            df[columns] = self.engine.fit_transform(df[columns].to_numpy(dtype=float))
+
+        elif self.method == 'knn':
+            from sklearn.impute import KNNImputer
+            max_samples = params.pop('max_samples', 10000)
+            self.batch_size = params.pop('batch_size', 10000)
+            params.setdefault('keep_empty_features', True)  # a sparse column may be empty in the subsample
+            fit_rows = np.random.default_rng(0).permutation(len(df))[:max_samples]
+            self.engine = KNNImputer(**params).fit(df[columns].iloc[np.sort(fit_rows)])
+            df[columns] = self.knn_transform(df[columns])
+
+        elif self.method == 'locf':
+            assert groups is not None, "Error! 'locf' imputation requires groups (patient ids)"
+            self.medians = df[columns].median()
+            df[columns] = self.locf_transform(df[columns], groups)
+
+        df = self.add_indicators(df, indicators)
+        self.fit_time = time.perf_counter() - start
+        return df
+
+    def transform(self, df, columns, groups=None):
+        """ Imputes df (test set) by the fitted imputation engine """
+        columns = list(columns)
+        indicators = df[self.indicator_cols].isnull()
+
+        if self.method == 'iterative':
+            df[columns] = self.engine.transform(df[columns])
+        elif self.method == 'iterative_subset':
+            df[columns] = self.engine.transform(df[columns].to_numpy(dtype=float))
+        elif self.method == 'knn':
+            df[columns] = self.knn_transform(df[columns])
+        elif self.method == 'locf':
+            assert groups is not None, "Error! 'locf' imputation requires groups (patient ids)"
+            df[columns] = self.locf_transform(df[columns], groups)
+
+        return self.add_indicators(df, indicators)
+
+    def knn_transform(self, df):
+        """ KNN imputation in batches of rows, to bound the memory of the distances matrix """
+        if len(df) == 0:
+            return np.empty(df.shape)
+        return np.vstack([self.engine.transform(df.iloc[start:start + self.batch_size])
+                          for start in range(0, len(df), self.batch_size)])
+
+    def locf_transform(self, df, groups):
+        """ Per-patient forward fill (rows are expected to be in chronological order), then training medians """
+        groups = pd.Series(np.asarray(groups), index=df.index)
+        return df.groupby(groups).ffill().fillna(self.medians)
+
+    def add_indicators(self, df, indicators):
+        """ Adds the missing-indicator columns (computed before the imputation) """
+        if self.indicator_cols:
+            df[[col + "_missing" for col in self.indicator_cols]] = indicators.to_numpy()
+        return df
+
+
+
+class CorrelatedSubsetImputer:
+    """
+    Iterative imputation as sklearn's IterativeImputer (mean initial fill, then rounds over the columns in ascending
+    order of missing values, each regressed on the current values of its predictors), where the predictors of each
+    column are its n_nearest_features most correlated columns - absolute pairwise-complete correlations, computed once
+    on the training rows. The fitted steps (imputation_sequence) are replayed on the test set by transform.
+    """
+
+    def __init__(self, n_nearest_features=10, max_iter=10, tol=1e-3, estimator=None):
+        self.n_nearest_features = n_nearest_features
+        self.max_iter = max_iter
+        self.tol = tol
+        self.estimator = estimator
+        self.initial_values = None
+        self.neighbor_feat_idx = []
+        self.imputation_sequence = []  # (feat_idx, neighbor_feat_idx, fitted estimator) of every step
+        self.n_iter = 0
+
+    def fit_transform(self, X):
+        """ Fits the imputation steps on X (a rows x columns array, NaN for missing values) and imputes it """
+        from sklearn.base import clone
+        from sklearn.linear_model import BayesianRidge
+
+        missing = np.isnan(X)
+        observed = ~missing.all(axis=0)
+        self.initial_values = np.zeros(X.shape[1])
+        self.initial_values[observed] = np.nanmean(X[:, observed], axis=0)
+        imputed = np.where(missing, self.initial_values, X)
+        self.neighbor_feat_idx = top_correlated_features(X, self.n_nearest_features)
+        self.imputation_sequence = []
+        self.n_iter = 0
+        if not missing.any() or X.shape[1] < 2:
+            return imputed
+
+        estimator = self.estimator if self.estimator is not None else BayesianRidge()
+        order = [feat_idx for feat_idx in np.argsort(missing.sum(axis=0), kind='stable') if observed[feat_idx]]
+        normalized_tol = self.tol * np.max(np.abs(X[~missing]), initial=0)
+        for self.n_iter in range(1, self.max_iter + 1):
+            previous = imputed.copy()
+            for feat_idx in order:
+                neighbor_idx = self.neighbor_feat_idx[feat_idx]
+                rows = ~missing[:, feat_idx]
+                fitted = clone(estimator).fit(imputed[np.ix_(rows, neighbor_idx)], X[rows, feat_idx])
+                if not rows.all():
+                    imputed[~rows, feat_idx] = fitted.predict(imputed[np.ix_(~rows, neighbor_idx)])
+                self.imputation_sequence.append((feat_idx, neighbor_idx, fitted))
+            if np.max(np.abs(imputed - previous)) < normalized_tol:
+                break
+
+        return imputed
+
+    def transform(self, X):
+        """ Imputes X (test set) by replaying the fitted imputation steps """
+        missing = np.isnan(X)
+        imputed = np.where(missing, self.initial_values, X)
+        if not missing.any():
+            return imputed
+
+        for feat_idx, neighbor_idx, fitted in self.imputation_sequence:
+            rows = missing[:, feat_idx]
+            if rows.any():
+                imputed[rows, feat_idx] = fitted.predict(imputed[np.ix_(rows, neighbor_idx)])
+        return imputed
+
+
+def top_correlated_features(X, k):
+    """
+    The k columns of X with the highest absolute (pairwise complete) correlation with each column, by masked matrix
+    products. An helper function of CorrelatedSubsetImputer
+    """
+    n_cols = X.shape[1]
+    valid = (~np.isnan(X)).astype(float)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        centered = np.where(valid > 0, X - np.nanmean(np.where(valid.any(axis=0), X, 0), axis=0), 0)
+        count = valid.T @ valid  # rows where both columns are observed
+        sums = centered.T @ valid  # sums[i, j] - sum of column i over the rows where j is observed
+        squares = (centered ** 2).T @ valid
+        covariance = centered.T @ centered - sums * sums.T / count
+        variance_i = squares - sums ** 2 / count
+        corr = np.abs(covariance / np.sqrt(variance_i * variance_i.T))
+    corr = np.nan_to_num(corr, nan=0.0)
+    np.fill_diagonal(corr, -1)  # never a predictor of itself
+
+    k = min(k, n_cols - 1)
+    top = np.argsort(-corr, axis=1, kind='stable')[:, :k]
+    return [np.sort(neighbors) for neighbors in top]
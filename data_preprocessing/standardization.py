@@ -1,46 +1,130 @@
 ''' Data standardization (mean=0, SD=1) '''
+import numpy as np
+
+from data_preprocessing.column_profile import column_profile
+
+
+class Standardizer:
+    """
+    The Standardizer object holds the standardization parameters (mean, SD) of a list of features, as vectors.
+    It remembers which features it has standardized on the seen data, so that steps sharing the same instance
+    (MLModel, LOF, OCSVM) don't check or standardize them again.
+    """
+
+    def __init__(self):
+        self.features = []
+        self.mean = np.array([])
+        self.scale = np.array([])
+        self.standardized_features = set()
+
+    def fit(self, df, features, profile=None):
+        """
+            Learn the standardization parameters of seen_data (TRAINING set), from the column profile of df
+            (computed here in one vectorized pass, unless given).
+        """
+        self.features = list(features)
+        if profile is None:
+            profile = column_profile(df, self.features, distinct=False)
+        mean = profile.mean[self.features].to_numpy(dtype=float)
+        std = profile.std[self.features].to_numpy(dtype=float)
+
+        # if the std is 0, change nothing
+        no_spread = std == 0
+        self.mean = np.where(no_spread, 0, mean)
+        self.scale = np.where(no_spread, 1, std)
+        self.standardized_features = set()
+        return self
+
+    def fit_transform(self, df, features, inplace=False, profile=None):
+        """
+            Standardize values of seen_data (TRAINING set).
+        """
+        df_out = self.fit(df, features, profile).transform(df, inplace=inplace)
+        self.standardized_features.update(self.features)
+        return df_out
+
+    def transform(self, df, features=None, inplace=False):
+        """
+            Standardize values of unseen_data (TEST set). Standardizes df itself if inplace=True, otherwise a copy.
+        """
+        features = self.features if features is None else list(features)
+        df_out = df if inplace else df.copy()
+        df_out[features] = self.transform_array(df_out[features].to_numpy(dtype=float), features)
+        return df_out
+
+    def transform_array(self, values, features=None, out=None):
+        """
+            Standardize a (rows x features) array, into out if given (may be values itself).
+        """
+        mean, scale = self.mean, self.scale
+        if features is not None and list(features) != self.features:
+            indices = [self.features.index(feature) for feature in features]
+            mean, scale = mean[indices], scale[indices]
+        out = np.subtract(values, mean, out=out)
+        return np.divide(out, scale, out=out)
+
+    def mark_standardized(self, features):
+        """ Mark features as already standardized (e.g. after checking the data with is_data_standardized) """
+        self.standardized_features.update(features)
+        return self
+
+    def is_standardized(self, features):
+        """ Check if the features were already standardized by this standardizer """
+        return len(self.standardized_features) > 0 and set(features) <= self.standardized_features
+
 
 def standardize_data(df, features):
     """
         Standardize values of seen_data (TRAINING set).
     """
-    df_out = df.copy()
-    features_params = {}
-    for feature in features:
-        std = df_out[feature].std()
-        mean = df_out[feature].mean()
-        if std == 0:  # if the std is 0, change nothing
-            features_params[feature] = {'mean': 0,
-                                        'std': 1}
-        else:
-            df_out[feature] = (df_out[feature] - mean) / std
-            features_params[feature] = {'mean': mean,
-                                        'std': std}
-    return df_out, features_params
+    standardizer = Standardizer()
+    df_out = standardizer.fit_transform(df, features)
+    return df_out, standardizer
 
 
-def standardize_unseen_data(df, features, train_params):
+def standardize_unseen_data(df, features, standardizer):
     """
         Standardize values of unseen_data (TEST set).
     """
-    df_out = df.copy()
-    for feature in features:
-        std = train_params[feature]['std']
-        mean = train_params[feature]['mean']
-        df_out[feature] = (df_out[feature] - mean) / std
-    return df_out
+    return standardizer.transform(df, features)
 
 
-def is_data_standardized(df, features):
-    """  Check if the data is already standardized """
+def is_data_standardized(df, features, profile=None):
+    """  Check if the data is already standardized (by the column profile of df, computed here unless given) """
     epsilon = 1e-10
-    for feature in features:
-        mean = df[feature].mean()
-        std = df[feature].std()
-        # Check if mean == 0 and std == 1, up to epsilon
-        if not ((0 - epsilon <= mean) and (mean <= 0 + epsilon) and
-                (1 - epsilon <= std) and (std <= 1 + epsilon)):
-            print("The values of %s are not standardized: mean=%.3f, std=%.3f, epsilon=%f" % (
-                feature, mean, std, epsilon))
-            return False
-    return True
\ No newline at end of file
+    features = list(features)
+    if not features:
+        return True
+    if profile is None:
+        profile = column_profile(df, features, distinct=False)
+
+    # Check if mean == 0 and std == 1, up to epsilon
+    standardized, feature = profile.is_standardized(features, epsilon)
+    if not standardized:
+        print("The values of %s are not standardized: mean=%.3f, std=%.3f, epsilon=%f" % (
+            feature, profile.mean[feature], profile.std[feature], epsilon))
+    return standardized
+
+
+def standardize_for_anomaly(X_train, standardized_features, majority_train, standardizer, method_name, profile=None):
+    """
+    Standardizes X_train (and majority_train) for a distance based anomaly detector, unless the shared
+    standardizer or a direct check shows that the data is already standardized.
+    Used by local_outlier_factor() and one_class_svm(). profile is the ColumnProfile of X_train, if already computed
+    (shared by the check and the fit).
+
+    Returns: X_train, majority_train and the fitted Standardizer (None if no standardization was performed).
+    """
+    if standardizer is not None and standardizer.is_standardized(standardized_features):
+        return X_train, majority_train, None
+    if profile is None:
+        profile = column_profile(X_train, standardized_features, distinct=False)
+    if is_data_standardized(X_train, standardized_features, profile):
+        return X_train, majority_train, None
+
+    print("Performs standardization for %s" % method_name)
+    standardizer = Standardizer()
+    X_train = standardizer.fit_transform(X_train, standardized_features, profile=profile)
+    if majority_train is not None:
+        majority_train = standardizer.transform(majority_train)
+    return X_train, majority_train, standardizer
@@ -1,29 +1,85 @@
 ''' feature generation module '''
 import numpy as np
 import pandas as pd
-from sklearn import linear_model
-from tqdm.notebook import tqdm
 
 
-def features_ratio(df, features):
-    """ Adds new features that are the ratio between numerical features """
-    new_cols = []
-    for numerator in range(len(features)):
-        for denominator in range(numerator + 1, len(features)):
-            # Generate ratios
-            col_name = features[numerator] + "_on_" + features[denominator]
-            df[col_name] = df[features[numerator]] / df[features[denominator]]
-            new_cols.append(col_name)
+def features_ratio(df, features, pairs=None, top_m=None, y=None, dtype=np.float64):
+    """
+    Adds new features that are the ratio between numerical features.
+    The ratios are computed as a single array and attached to df at once.
 
-    # replace invalid results to NaN
-    df[new_cols] = df[new_cols].replace([np.inf, -np.inf, float(0)], np.nan)
+    Args:
+        df: Dataframe containing the numerical features.
+        features: Numerical features, all the pairs of which are used (unless pairs is given).
+        pairs: Optional list of (numerator, denominator) features, restricting the generated ratios.
+        top_m: Optional number of ratios to keep, according to their absolute correlation with y (requires y).
+        y: Labels aligned with df, used for screening the ratios when top_m is given.
+        dtype: The data type of the ratios (e.g. np.float32).
+
+    Returns: df with the new features
+    """
+    if pairs is None:
+        pairs = [(features[numerator], features[denominator])
+                 for numerator in range(len(features)) for denominator in range(numerator + 1, len(features))]
+    if top_m is not None:
+        assert y is not None, "Error! y is required for screening the ratios (top_m)"
+        pairs = screen_ratio_pairs(df, pairs, y, top_m)
+
+    ratios = get_ratios(df, pairs).astype(dtype, copy=False)
+    new_cols = [numerator + "_on_" + denominator for numerator, denominator in pairs]
+    df = df.drop(columns=[col for col in new_cols if col in df.columns])
+    df = pd.concat([df, pd.DataFrame(ratios, columns=new_cols, index=df.index)], axis=1)
 
     return df
 
 
+def get_ratios(df, pairs):
+    """ Computes the ratios of the given pairs as a single array. An helper function of features_ratio() """
+    used_features = list(dict.fromkeys([feat_name for pair in pairs for feat_name in pair]))
+    feature_index = {feat_name: index for index, feat_name in enumerate(used_features)}
+    values = df[used_features].to_numpy(dtype=float)
+
+    numerators = values[:, [feature_index[numerator] for numerator, _ in pairs]]
+    denominators = values[:, [feature_index[denominator] for _, denominator in pairs]]
+    ratios = np.full(numerators.shape, np.nan)
+    with np.errstate(over='ignore'):
+        np.divide(numerators, denominators, out=ratios, where=(denominators != 0))
+
+    # replace invalid results to NaN
+    ratios[(ratios == 0) | np.isinf(ratios)] = np.nan
+    return ratios
+
+
+def screen_ratio_pairs(df, pairs, y, top_m, block_size=256):
+    """
+    Returns the top_m pairs whose ratios have the highest absolute correlation with y (NaN-aware).
+    The ratios are computed in blocks, so all of them are never materialized together.
+    An helper function of features_ratio()
+    """
+    y = np.asarray(y, dtype=float)
+    scores = np.empty(len(pairs))
+    for start in range(0, len(pairs), block_size):
+        ratios = get_ratios(df, pairs[start:start + block_size])
+        valid = ~np.isnan(ratios) & ~np.isnan(y)[:, None]
+        n = valid.sum(axis=0)
+        ratios = np.where(valid, ratios, 0)
+        y_block = np.where(valid, y[:, None], 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratios_centered = np.where(valid, ratios - ratios.sum(axis=0) / n, 0)
+            y_centered = np.where(valid, y_block - y_block.sum(axis=0) / n, 0)
+            corr = (ratios_centered * y_centered).sum(axis=0) / np.sqrt(
+                (ratios_centered ** 2).sum(axis=0) * (y_centered ** 2).sum(axis=0))
+        scores[start:start + block_size] = np.abs(corr)
+
+    selected = np.argsort(-np.nan_to_num(scores, nan=-1), kind='stable')[:top_m]
+    return [pairs[index] for index in sorted(selected)]
+
+
 def summary_statistics_features(df, features, ignore_last=False, full_history=False, horizons=[24, 72]):
     """
     Generates historical summary statistics features.
+    The data is sorted once, and every statistic of every feature is computed per horizon as a 2-D block:
+    mean and std from windowed sums and counts, min and max from a sparse table over the windows.
 
     Args:
         df: Dataframe containing "Patient ID", "DateTime" and numerical features.
@@ -34,84 +90,190 @@ def summary_statistics_features(df, features, ignore_last=False, full_history=Fa
 
     Returns: df with the new features
     """
+    features = list(features)
 
-    df.index = df.DateTime
-    stat_list = ['mean', 'min', 'max', 'std']  # desired statistics
+    # Sort once by patient and time. The statistics are scattered back to the original row order.
+    codes = pd.factorize(df['patient_id'])[0]
+    date_times = df['DateTime'].to_numpy(dtype='datetime64[ns]').astype(np.int64)
+    order = np.lexsort((date_times, codes))
+    codes = codes[order]
+    times = (date_times[order] - date_times.min()).astype(float)
+    values = df[features].to_numpy(dtype=float)[order]
+    group_starts = np.maximum.accumulate(np.where(np.r_[True, codes[1:] != codes[:-1]], np.arange(len(codes)), 0))
 
+    cum_count, cum_sum, cum_squares, shift = get_summary_sums(codes, values)
     if full_history:
-        horizon = df['patient_id'].value_counts().max() + 1
-        horizons = [horizon]
+        windows = [(-np.ones(len(codes), dtype=np.int64), '')]  # expanding window
+    else:
+        hour = 3600 * 10 ** 9
+        windows = [(get_window_previous_rows(codes, times, horizon * hour), "_" + str(horizon) + 'h')
+                   for horizon in horizons]
 
-    for horizon in horizons:
-        rolling_horizon = horizon if full_history else str(horizon) + 'h'
-        len_lamda, stat_lambdas = get_stat_lamdas(rolling_horizon)
+    new_cols = {}
+    for previous, suffix in windows:
+        count = get_window_sums(cum_count, previous)
+        sum_values = get_window_sums(cum_sum, previous)
+        sum_squares = get_window_sums(cum_squares, previous)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if ignore_last:
+                mean = np.where(count >= 2, (sum_values - (values - shift)) / (count - 1), np.nan) + shift
+            else:
+                mean = np.where(count >= 1, sum_values / count, np.nan) + shift
+            variance = np.where(count >= 2, (sum_squares - sum_values ** 2 / count) / (count - 1), np.nan)
+        win_min, win_max = get_window_extrema(values, np.maximum(previous + 1, group_starts))
+        variance[(win_min == win_max) & (count >= 2)] = 0  # constant windows, avoid rounding noise
+        stats = {'mean': mean, 'min': win_min, 'max': win_max, 'std': np.sqrt(np.maximum(variance, 0))}
 
-        for feat_name in tqdm(features):
-            for feat_index, feat_stat in enumerate(stat_list):
-                suffix = '' if full_history else ("_" + rolling_horizon)
-                col_name = feat_name + "_" + feat_stat + suffix
-                df[col_name] = df.groupby('patient_id')[feat_name].transform(stat_lambdas[feat_index])
+        # Remove statistics if feature value is null
+        null_values = np.isnan(values)
+        for stat in stats.values():
+            stat[null_values] = np.nan
 
+        for feat_index, feat_name in enumerate(features):
+            for feat_stat, stat in stats.items():
+                new_cols[feat_name + "_" + feat_stat + suffix] = stat[:, feat_index]
                 if feat_stat == 'mean':
-                    if ignore_last:
-                        df[col_name] = df[col_name].mul(df.groupby('patient_id')[feat_name].transform(len_lamda)).sub(
-                            df[feat_name])
-                        df[col_name] = df[col_name].div(df.groupby('patient_id')[feat_name].transform(len_lamda).sub(1))
+                    new_cols[feat_name + "_delta_mean" + suffix] = values[:, feat_index] - stat[:, feat_index]
 
-                    df[feat_name + "_delta_mean" + suffix] = df[feat_name] - df[col_name]
+    # Unsort and attach all the new columns at once
+    new_values = np.empty((len(order), len(new_cols)))
+    new_values[order] = np.column_stack(list(new_cols.values()))
+    new_df = pd.DataFrame(new_values, columns=list(new_cols.keys()))
+    df = df.drop(columns=[col for col in new_cols if col in df.columns]).reset_index(drop=True)
+    df = pd.concat([df, new_df], axis=1)
 
-                # Remove statistics if feature value is null
-                df.loc[df[feat_name].isnull(), (col_name)] = np.NaN
+    return df
 
-    df = df.reset_index(drop=True)
 
-    return df
+def get_summary_sums(codes, values):
+    """
+    Per-patient cumulative counts, sums and sums of squares of the non-null values (sorted by patient).
+    Values are shifted by the patient's first observation, for numerical stability.
+    An helper function of summary_statistics_features()
+    """
+    n_feat = values.shape[1]
+    valid = ~np.isnan(values)
+    shift = pd.DataFrame(values).groupby(codes).transform('first').to_numpy()
+    shifted = np.where(valid, values - shift, 0)
+
+    sums = np.hstack([valid.astype(float), shifted, shifted * shifted])
+    cum_sums = pd.DataFrame(sums).groupby(codes).cumsum().to_numpy()
+    cum_count, cum_sum, cum_squares = [cum_sums[:, i * n_feat:(i + 1) * n_feat] for i in range(3)]
+
+    return cum_count, cum_sum, cum_squares, np.nan_to_num(shift)
+
+
+def get_window_extrema(values, starts):
+    """
+    Min and max (ignoring NaN) of each window [start, row], using a sparse table of power-of-two windows.
+    An helper function of summary_statistics_features()
+    """
+    ends = np.arange(len(values))
+    levels = np.floor(np.log2(ends - starts + 1)).astype(int) if len(values) else ends
+    win_min, win_max = np.full(values.shape, np.nan), np.full(values.shape, np.nan)
 
+    # Table level l holds the extrema of the windows [j, j + 2^l - 1]. Only one level is kept in memory.
+    table_min, table_max = values.copy(), values.copy()
+    for level in range(levels.max() + 1 if len(values) else 0):
+        rows = np.flatnonzero(levels == level)
+        if rows.size:
+            left, right = starts[rows], ends[rows] - (1 << level) + 1
+            win_min[rows] = np.fmin(table_min[left], table_min[right])
+            win_max[rows] = np.fmax(table_max[left], table_max[right])
+        step = 1 << level
+        table_min[:-step] = np.fmin(table_min[:-step], table_min[step:])
+        table_max[:-step] = np.fmax(table_max[:-step], table_max[step:])
 
-def get_stat_lamdas(rolling_horizon):
-    """
-        Defines statistics calculations over historical longitudinal data.
-        An helper function of summary_statistics_features()
-    """
-    len_lamda = lambda x: x.rolling(rolling_horizon, min_periods=2).count()
-    stat_lambdas = [lambda x: x.rolling(rolling_horizon, min_periods=1).mean(),  # mean
-                    lambda x: x.rolling(rolling_horizon, min_periods=1).min(),  # min
-                    lambda x: x.rolling(rolling_horizon, min_periods=1).max(),  # max
-                    lambda x: x.rolling(rolling_horizon, min_periods=1).std()]  # std
-    return len_lamda, stat_lambdas
-
-
-def add_lr_slope(df, feat_list):
-    """ Adds the linear regression coef for each of the listed features, for each patient. """
-    regressor = linear_model.LinearRegression()
-    for feat_name in feat_list:
-        slopes_per_feature = []
-
-        for pid in df['patient_id'].unique():
-            # Create a df per patient
-            patient_df = df[df['patient_id'] == pid]
-            patient_df = patient_df[['time_since_admission', feat_name, 'patient_id']]
-            n_rows = len(patient_df)
-            if patient_df.size:
-                for row_index in range(n_rows):
-                    # If the value exists, calculate slope until this value.
-                    if not pd.isnull(patient_df.iloc[row_index, 1]):
-                        slope = get_slope(patient_df, row_index, regressor)
-                        slopes_per_feature.extend([slope])
-                    else:
-                        slopes_per_feature.extend([np.nan])
-            else:  # Otherwise, fill with nan.
-                slopes_per_feature.extend([np.nan] * n_rows)
-        df[feat_name + "_lr_slope"] = slopes_per_feature
+    return win_min, win_max
+
+
+def add_lr_slope(df, feat_list, window=None):
+    """
+    Adds the linear regression coef for each of the listed features, for each patient.
+    The slope of each row is fitted on the patient's non-null observations up to (and including) that row,
+    computed for all features at once from cumulative sums of t, x, t*x and t^2.
+
+    Args:
+        df: Dataframe containing "patient_id", "time_since_admission" and numerical features.
+            Rows are expected to be in chronological order within each patient.
+        feat_list: Numerical features on which to calculate the slopes.
+        window: Optional trailing window, in time_since_admission units (e.g. window=24 for the last 24 hours).
+                If given, only observations within the window are used, and "_<window>h" is added to the names.
+
+    Returns: df with the new features
+    """
+    feat_list = list(feat_list)
+    codes = pd.factorize(df['patient_id'])[0]
+    times = df['time_since_admission'].to_numpy(dtype=float)
+    values = df[feat_list].to_numpy(dtype=float)
+
+    sums = get_regression_sums(codes, times, values)
+    if window is not None:
+        previous = get_window_previous_rows(codes, times, window)
+        sums = [get_window_sums(cum_sum, previous) for cum_sum in sums]
+
+    slopes = get_slope(*sums)
+    slopes[np.isnan(values)] = np.nan  # The slope is calculated only for existing values
+
+    suffix = "_lr_slope" if window is None else "_lr_slope_" + str(window) + "h"
+    df[[feat_name + suffix for feat_name in feat_list]] = slopes
 
     return df
 
 
-def get_slope(patient_df, row_index, regressor):
-    """ helper function of add_lr_slope() """
-    slope_df = patient_df.iloc[:row_index + 1, :].dropna()
-    date_times = slope_df.iloc[:, :1].values
-    feat_values = slope_df.iloc[:, 1].values
-    regressor.fit(date_times, feat_values)
-    slope = regressor.coef_[0]
+def get_regression_sums(codes, times, values):
+    """
+    Per-patient cumulative sums of n, t, x, t*x and t^2 over the non-null (t, x) pairs.
+    Times and values are shifted by the patient's first observation, for numerical stability.
+    An helper function of add_lr_slope()
+    """
+    valid = ~np.isnan(values) & ~np.isnan(times)[:, None]
+    t = times - pd.Series(times).groupby(codes).transform('first').to_numpy()
+    x = values - pd.DataFrame(values).groupby(codes).transform('first').to_numpy()
+    t = np.where(valid, t[:, None], 0)
+    x = np.where(valid, x, 0)
+
+    # A single grouped pass over all the sums of all the features
+    n_feat = values.shape[1]
+    sums = np.hstack([valid.astype(float), t, x, t * x, t * t])
+    cum_sums = pd.DataFrame(sums).groupby(codes).cumsum().to_numpy()
+
+    return [cum_sums[:, i * n_feat:(i + 1) * n_feat] for i in range(5)]
+
+
+def get_window_previous_rows(codes, times, window):
+    """
+    For each row, the position of the patient's last row that precedes the trailing time window (-1 if none).
+    An helper function of add_lr_slope() and summary_statistics_features()
+    """
+    # Rows with missing times are not part of any regression, search them by the last known time
+    times = pd.Series(times).groupby(codes).ffill().fillna(-np.inf).to_numpy()
+    previous = np.empty(len(times), dtype=np.int64)
+    for positions in pd.Series(codes).groupby(codes).indices.values():
+        patient_times = times[positions]
+        first_in_window = np.searchsorted(patient_times, patient_times - window, side='right')
+        previous[positions] = np.where(first_in_window > 0, positions[first_in_window - 1], -1)
+    return previous
+
+
+def get_window_sums(cum_sums, previous):
+    """
+    Converts per-patient cumulative sums to trailing window sums.
+    An helper function of add_lr_slope() and summary_statistics_features()
+    """
+    padded = np.vstack([np.zeros((1, cum_sums.shape[1])), cum_sums])
+    return cum_sums - padded[previous + 1]
+
+
+def get_slope(n, sum_t, sum_x, sum_tx, sum_tt):
+    """
+    Least squares slope from the regression sums (0 if all the times are equal).
+    An helper function of add_lr_slope() and PatientFeatureState
+    """
+    numerator = n * sum_tx - sum_t * sum_x
+    denominator = n * sum_tt - sum_t * sum_t
+    degenerate = denominator <= 1e-10 * n * sum_tt
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = np.where(degenerate, 0, numerator / denominator)
+    slope[n == 0] = np.nan
     return slope
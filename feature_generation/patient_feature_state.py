@@ -0,0 +1,167 @@
+''' Online (streaming) feature generation for a single patient '''
+from collections import deque
+
+import numpy as np
+import pandas as pd
+
+from feature_generation.feature_generation import get_slope
+
+
+class PatientFeatureState:
+    """
+    The PatientFeatureState object keeps the running state of a single patient's features, so a new observation
+    updates the features in O(1) amortized time instead of recomputing the patient's whole history.
+    The produced values are the same as those of summary_statistics_features() and add_lr_slope().
+    """
+
+    def __init__(self, features, horizons=[24, 72], ignore_last=False, full_history=False, slope_features=None,
+                 slope_window=None):
+        """
+        Args:
+            features: Numerical features on which to calculate the summary statistics.
+            horizons: Time windows (hours) during which to calculate the statistics.
+            ignore_last: ignore the current result when calculating the mean
+            full_history: whether to calculate summary statistics based on the entire hospitalization period so far
+            slope_features: Numerical features on which to calculate the linear regression slope (default: none).
+            slope_window: Optional trailing window of the slopes, in time_since_admission units.
+        """
+        self.features = list(features)
+        self.ignore_last = ignore_last
+        self.horizons = [None] if full_history else list(horizons)
+        self.windows = {horizon: {feat_name: WindowStatistics(horizon) for feat_name in self.features}
+                        for horizon in self.horizons}
+
+        # Regression accumulators: n, t, x, t*x and t^2 of every slope feature
+        self.slope_features = list(slope_features) if slope_features is not None else []
+        self.slope_window = slope_window
+        self.slope_sums = np.zeros((5, len(self.slope_features)))
+        self.slope_observations = deque()  # (t, x) pairs, kept only for a trailing window
+        self.time_shift = None
+        self.value_shift = np.full(len(self.slope_features), np.nan)
+
+    def update(self, date_time, values, time_since_admission=None):
+        """
+        Adds a new observation of the patient and returns the current feature row.
+
+        Args:
+            date_time: The observation's time. Observations must arrive in chronological order.
+            values: A dict (or Series) of the observed feature values. Missing features are treated as NaN.
+            time_since_admission: The observation's time since admission, required for the slopes.
+
+        Returns: A Series with the summary statistics and slopes of the observation.
+        """
+        date_time = pd.Timestamp(date_time)
+        row = {}
+        for horizon in self.horizons:
+            suffix = '' if horizon is None else "_" + str(horizon) + 'h'
+            for feat_name in self.features:
+                value = values.get(feat_name, np.nan)
+                value = np.nan if pd.isnull(value) else float(value)
+                stats = self.windows[horizon][feat_name].update(date_time, value, self.ignore_last)
+                for feat_stat, stat in stats.items():
+                    row[feat_name + "_" + feat_stat + suffix] = stat
+
+        if self.slope_features:
+            suffix = "_lr_slope" if self.slope_window is None else "_lr_slope_" + str(self.slope_window) + "h"
+            slopes = self.update_slopes(values, time_since_admission)
+            for feat_name, slope in zip(self.slope_features, slopes):
+                row[feat_name + suffix] = slope
+
+        return pd.Series(row, dtype=float)
+
+    def update_slopes(self, values, time_since_admission):
+        """ Updates the regression accumulators and returns the current slopes. helper function of update() """
+        x = np.array([values.get(feat_name, np.nan) for feat_name in self.slope_features], dtype=float)
+        if time_since_admission is None or pd.isnull(time_since_admission):
+            return np.full(len(self.slope_features), np.nan)
+
+        t = float(time_since_admission)
+        if self.time_shift is None:
+            self.time_shift = t
+        self.value_shift = np.where(np.isnan(self.value_shift), x, self.value_shift)
+
+        valid = ~np.isnan(x)
+        shifted_t = np.where(valid, t - self.time_shift, 0)
+        shifted_x = np.where(valid, x - self.value_shift, 0)
+        observation = np.array([valid, shifted_t, shifted_x, shifted_t * shifted_x, shifted_t * shifted_t])
+        self.slope_sums += observation
+
+        if self.slope_window is not None:
+            self.slope_observations.append((t, observation))
+            while self.slope_observations[0][0] <= t - self.slope_window:
+                self.slope_sums -= self.slope_observations.popleft()[1]
+
+        slopes = get_slope(*self.slope_sums[:, None, :])[0]
+        slopes[~valid] = np.nan  # The slope is calculated only for existing values
+        return slopes
+
+
+class WindowStatistics:
+    """
+    Running mean, min, max and std of a single feature over a trailing time window.
+    Min and max are kept with monotonic deques, and mean and std with windowed sums.
+    """
+
+    def __init__(self, horizon=None):
+        self.horizon = None if horizon is None else pd.Timedelta(hours=horizon)
+        self.observations = deque()  # (time, shifted value)
+        self.min_candidates = deque()  # (time, value), increasing values
+        self.max_candidates = deque()  # (time, value), decreasing values
+        self.shift = None
+        self.count, self.sum, self.squares = 0, 0.0, 0.0
+
+    def update(self, date_time, value, ignore_last=False):
+        """ Adds an observation (NaN values are skipped) and returns the current statistics. """
+        if not np.isnan(value):
+            self.add(date_time, value)
+        if self.horizon is not None:
+            self.evict(date_time - self.horizon)
+
+        if np.isnan(value):  # Remove statistics if feature value is null
+            return {'mean': np.nan, 'delta_mean': np.nan, 'min': np.nan, 'max': np.nan, 'std': np.nan}
+
+        shifted = value - self.shift
+        if ignore_last:
+            mean = (self.sum - shifted) / (self.count - 1) + self.shift if self.count >= 2 else np.nan
+        else:
+            mean = self.sum / self.count + self.shift
+        win_min, win_max = self.min_candidates[0][1], self.max_candidates[0][1]
+        if self.count < 2:
+            std = np.nan
+        elif win_min == win_max:
+            std = 0.0
+        else:
+            std = np.sqrt(max((self.squares - self.sum ** 2 / self.count) / (self.count - 1), 0))
+
+        return {'mean': mean, 'delta_mean': value - mean, 'min': win_min, 'max': win_max, 'std': std}
+
+    def add(self, date_time, value):
+        if self.shift is None:
+            self.shift = value
+        shifted = value - self.shift
+        self.observations.append((date_time, shifted))
+        self.count += 1
+        self.sum += shifted
+        self.squares += shifted * shifted
+
+        while self.min_candidates and self.min_candidates[-1][1] >= value:
+            self.min_candidates.pop()
+        self.min_candidates.append((date_time, value))
+        while self.max_candidates and self.max_candidates[-1][1] <= value:
+            self.max_candidates.pop()
+        self.max_candidates.append((date_time, value))
+
+    def evict(self, window_start):
+        """ Removes the observations that are not later than window_start """
+        while self.observations and self.observations[0][0] <= window_start:
+            shifted = self.observations.popleft()[1]
+            self.count -= 1
+            self.sum -= shifted
+            self.squares -= shifted * shifted
+        if not self.observations:  # Reset the sums, to avoid accumulating rounding errors
+            self.sum, self.squares = 0.0, 0.0
+
+        while self.min_candidates and self.min_candidates[0][0] <= window_start:
+            self.min_candidates.popleft()
+        while self.max_candidates and self.max_candidates[0][0] <= window_start:
+            self.max_candidates.popleft()
@@ -0,0 +1,138 @@
+''' Patient-sharded feature generation - per-patient steps run on balanced shards of patients, in parallel '''
+import heapq
+import multiprocessing
+import os
+
+import numpy as np
+import pandas as pd
+
+# Shared memory blocks attached by a worker process (by name), kept open while the shards' frames may use them
+WORKER_SHARED_MEMORY = {}
+
+
+def sharded_feature_generation(df, steps, n_workers=1, n_shards=None, group_col='patient_id'):
+    """
+    Runs a chain of per-patient steps (e.g. create_time_grid, summary_statistics_features, add_lr_slope,
+    features_ratio) on shards of patients, in a process pool.
+    The patients are assigned to balanced shards by their number of rows (longest first, to the least loaded
+    shard), so long stays don't create stragglers. The shards are written once, as Arrow IPC streams, into a shared
+    memory block that the workers map, and the results are returned as Arrow IPC buffers (no pickled dataframes).
+
+    Args:
+        df: A dataframe in time-series format, containing group_col.
+        steps: The chain of steps, as (function, keyword arguments) pairs, each called as function(df, **kwargs)
+               and returning the new df. The functions must be importable (module level) and per-patient
+               independent (e.g. features_ratio with given pairs, not screened by y; create_time_grid with a
+               time_freq that divides a day, so that the grid doesn't depend on the shard's first day).
+        n_workers: Number of worker processes (-1: one per CPU). With 1, the shards are processed in this process.
+        n_shards: Number of shards (default: n_workers).
+        group_col: The patient column.
+
+    Returns: The concatenated results, with a new index. Patients are in the order of their first appearance in df,
+             and the rows of each patient in the order given by the steps (as when run on the whole df, if the rows
+             of each patient are contiguous in df).
+    """
+    n_workers = os.cpu_count() if n_workers == -1 else n_workers
+    n_shards = n_workers if n_shards is None else n_shards
+    steps = [(function, dict(kwargs or {})) for function, kwargs in steps]
+    codes, patients = pd.factorize(df[group_col])  # patients in the order of their first appearance
+    assert (codes >= 0).all(), f"Error! {group_col} has missing values"
+
+    shard_of_patient = balanced_shards(np.bincount(codes, minlength=len(patients)), n_shards)
+    shard_of_row = shard_of_patient[codes]
+    rows = np.argsort(shard_of_row, kind='stable')
+    shard_rows = [shard for shard in np.split(rows, np.cumsum(np.bincount(shard_of_row, minlength=n_shards))[:-1])
+                  if len(shard)]
+
+    if n_workers == 1:
+        results = [run_steps(df.iloc[shard].reset_index(drop=True), steps) for shard in shard_rows]
+    else:
+        results = run_shards_in_pool(df, shard_rows, steps, n_workers)
+
+    # Restore the patients' order
+    out_df = pd.concat(results, ignore_index=True)
+    order = np.argsort(patients.get_indexer(out_df[group_col]), kind='stable')
+    return out_df.take(order).reset_index(drop=True)
+
+
+def balanced_shards(weights, n_shards):
+    """ The shard of each item: the heaviest items first, each to the currently lightest shard (LPT) """
+    shards = np.zeros(len(weights), dtype=int)
+    loads = [(0, shard) for shard in range(n_shards)]
+    for item in np.argsort(-np.asarray(weights), kind='stable'):
+        load, shard = heapq.heappop(loads)
+        shards[item] = shard
+        heapq.heappush(loads, (load + weights[item], shard))
+    return shards
+
+
+def run_steps(df, steps):
+    """ Applies the chain of steps on df """
+    for function, kwargs in steps:
+        df = function(df, **kwargs)
+    return df
+
+
+def run_shards_in_pool(df, shard_rows, steps, n_workers):
+    """
+    Writes the shards (Arrow IPC streams) into one shared memory block, and runs the steps on each of them in a
+    (spawned) process pool, the largest shards first. Returns the shards' results, in the order of shard_rows.
+    An helper function of sharded_feature_generation()
+    """
+    import pyarrow as pa
+    from multiprocessing import shared_memory
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    shard_tables = [table.take(pa.array(rows)) for rows in shard_rows]
+    sizes = [ipc_stream_size(shard_table) for shard_table in shard_tables]
+    offsets = np.r_[0, np.cumsum(sizes)[:-1]].astype(int)
+
+    memory = shared_memory.SharedMemory(create=True, size=max(1, sum(sizes)))
+    try:
+        for shard_table, offset, size in zip(shard_tables, offsets, sizes):
+            write_ipc_stream(shard_table, memory.buf[offset:offset + size])
+        del shard_tables, table
+
+        tasks = sorted(range(len(shard_rows)), key=lambda shard: -sizes[shard])
+        with multiprocessing.get_context('spawn').Pool(min(n_workers, len(tasks))) as pool:
+            results = pool.starmap(run_shard, [(memory.name, int(offsets[shard]), sizes[shard], steps)
+                                               for shard in tasks], chunksize=1)
+    finally:
+        memory.close()
+        memory.unlink()
+
+    by_shard = dict(zip(tasks, results))
+    return [pa.ipc.open_stream(by_shard[shard]).read_all().to_pandas() for shard in range(len(shard_rows))]
+
+
+def run_shard(memory_name, offset, size, steps):
+    """ Reads a shard from the shared memory block, applies the steps and returns the result as an Arrow IPC buffer """
+    import pyarrow as pa
+    from multiprocessing import shared_memory
+
+    if memory_name not in WORKER_SHARED_MEMORY:
+        WORKER_SHARED_MEMORY[memory_name] = shared_memory.SharedMemory(name=memory_name)
+    buffer = pa.py_buffer(WORKER_SHARED_MEMORY[memory_name].buf)[offset:offset + size]
+    df = run_steps(pa.ipc.open_stream(buffer).read_all().to_pandas(), steps)
+
+    result = pa.Table.from_pandas(df, preserve_index=False)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, result.schema) as writer:
+        writer.write_table(result)
+    return sink.getvalue()
+
+
+def ipc_stream_size(table):
+    import pyarrow as pa
+
+    sink = pa.MockOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.size()
+
+
+def write_ipc_stream(table, memory_view):
+    import pyarrow as pa
+
+    with pa.ipc.new_stream(pa.FixedSizeBufferWriter(pa.py_buffer(memory_view)), table.schema) as writer:
+        writer.write_table(table)
@@ -1,9 +1,15 @@
 ''' feature selection module '''
+import numpy as np
 import pandas as pd
-import xgboost as xgb
+from collections import OrderedDict
+from data_preprocessing.fingerprint import data_fingerprint
 
+# Features importance rankings of feature_selection_xgb, by fingerprint (least recently used first)
+XGB_RANKING_CACHE = OrderedDict()
+XGB_RANKING_CACHE_SIZE = 32
 
-def feature_selection(X_train, y_train, selection_metric='', K=100):
+
+def feature_selection(X_train, y_train, selection_metric='', K=100, profile=None, **selection_params):
     """
     Feature selection according to a given metric.
 
@@ -12,6 +18,9 @@ def feature_selection(X_train, y_train, selection_metric='', K=100):
         y_train: Training labels
         selection_metric: Selection metric: 'Correlation' / 'XGB' / pre-defined list (literature review).
         K: Number of features to select
+        profile: Optional ColumnProfile of X_train, used by the 'Correlation' selection.
+        selection_params: Additional keyword arguments of the selection method
+                          (e.g. absolute, redundancy_threshold of feature_selection_corr).
 
     Returns: A list containing K selected features.
     """
@@ -19,32 +28,174 @@ def feature_selection(X_train, y_train, selection_metric='', K=100):
         return selection_metric
 
     if selection_metric == 'Correlation':
-        return feature_selection_corr(X_train, y_train, K)
+        return feature_selection_corr(X_train, y_train, K, profile=profile, **selection_params)
 
     if selection_metric == 'XGB':
-        return feature_selection_xgb(X_train, y_train, K)
+        return feature_selection_xgb(X_train, y_train, K, **selection_params)
 
     # No selection
     return X_train.columns
 
 
-def feature_selection_corr(X_train, y_train, K):
+def feature_selection_corr(X_train, y_train, K, absolute=False, redundancy_threshold=None, block_size=256,
+                           profile=None):
+    """
+    Returns a list of K features with the highest correlation to labels.
+    The correlations of all the features are computed together by matrix products (NaN-aware).
+
+    Args:
+        X_train: Training set
+        y_train: Training labels
+        K: Number of features to select
+        absolute: Whether to rank the features by their absolute correlation.
+        redundancy_threshold: If given, a feature whose absolute correlation with an already selected feature is
+                              higher than the threshold is skipped. Computed blockwise, without the full
+                              features correlation matrix (missing values are treated as the column mean).
+        block_size: Number of features processed together.
+        profile: Optional ColumnProfile of X_train (e.g. shared with other steps). Its means center the columns,
+                 and columns without spread (constant or fewer than 2 values) are not correlated (never selected).
+    """
+    mean, spread = None, None
+    if profile is not None:
+        mean = profile.mean[list(X_train.columns)].to_numpy(dtype=float)
+        spread = np.flatnonzero(profile.std[list(X_train.columns)].to_numpy(dtype=float) > 0)
+
+    corr = pd.Series(np.nan, index=X_train.columns)
+    corr.iloc[slice(None) if spread is None else spread] = label_correlations(X_train, y_train, block_size, mean,
+                                                                              positions=spread)
+    ranking = (corr.abs() if absolute else corr).nlargest(len(corr))
+    if redundancy_threshold is None:
+        return list(ranking.index[:K])
+
+    return filter_redundant_features(X_train, list(ranking.index), K, redundancy_threshold, block_size,
+                                     None if mean is None else pd.Series(mean, index=X_train.columns))
+
+
+def label_correlations(X_train, y_train, block_size=256, mean=None, positions=None):
+    """
+    Pearson correlation of each column (or of the columns at positions) with the labels, over the rows where both
+    exist (as pandas corr). Computed by one matrix product per block of columns. The columns are centered by mean
+    (e.g. their means in the column profile, for numerical stability only - the correlations don't depend on it),
+    by default by the means over the rows with labels. An helper function of feature_selection_corr()
+    """
+    y = (y_train.reindex(X_train.index) if isinstance(y_train, pd.Series) else pd.Series(y_train)).to_numpy(float)
+    valid_y = ~np.isnan(y)
+    y = np.where(valid_y, y - np.nanmean(y), 0)
+    labels = np.column_stack([valid_y, y, y * y]).astype(float)
+
+    positions = np.arange(X_train.shape[1]) if positions is None else np.asarray(positions)
+    corr = np.empty(len(positions))
+    for start in range(0, len(positions), block_size):
+        block = positions[start:start + block_size]
+        X = X_train.iloc[:, block].to_numpy(dtype=float)
+        valid = ~np.isnan(X) & valid_y[:, None]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            center = np.nanmean(np.where(valid, X, np.nan), axis=0) if mean is None else mean[block]
+            X = np.where(valid, X - center, 0)
+
+            # n, sum(x), sum(x^2) against 1, y, y^2 over the valid pairs, in a single product
+            sums = np.hstack([valid, X, X * X]).T @ labels
+            n_feat = X.shape[1]
+            n, sum_y, sum_yy = sums[:n_feat, 0], sums[:n_feat, 1], sums[:n_feat, 2]
+            sum_x, sum_xy, sum_xx = sums[n_feat:2 * n_feat, 0], sums[n_feat:2 * n_feat, 1], sums[2 * n_feat:, 0]
+            corr[start:start + n_feat] = (n * sum_xy - sum_x * sum_y) / np.sqrt(
+                (n * sum_xx - sum_x ** 2) * (n * sum_yy - sum_y ** 2))
+
+    return corr
+
+
+def filter_redundant_features(X_train, ranked_features, K, threshold, block_size=256, mean=None):
     """
-    Returns a list of K features with the highest correlation to labels
+    Greedily selects up to K features by their ranking, skipping features whose absolute correlation with an
+    already selected feature is above threshold. Candidates are compared with the selected features blockwise.
+    mean: Optional column means (Series), e.g. from the column profile. An helper function of feature_selection_corr()
     """
-    corr = X_train.apply(lambda x: x.corr(y_train))
-    features = list(corr.nlargest(K).index)
+    selected, selected_vectors = [], np.empty((len(X_train), 0))
+    for start in range(0, len(ranked_features), block_size):
+        candidates = ranked_features[start:start + block_size]
+        vectors = normalized_columns(X_train[candidates], None if mean is None else mean[candidates].to_numpy())
+        corr_selected = np.abs(vectors.T @ selected_vectors)  # candidates x selected
+        corr_block = np.abs(vectors.T @ vectors)  # candidates x candidates
+
+        accepted = []
+        for index, feature in enumerate(candidates):
+            if (corr_selected[index] > threshold).any() or (corr_block[index, accepted] > threshold).any():
+                continue
+            accepted.append(index)
+            selected.append(feature)
+            if len(selected) == K:
+                return selected
+        selected_vectors = np.hstack([selected_vectors, vectors[:, accepted]])
+
+    return selected
+
 
-    return features
+def normalized_columns(df, mean=None):
+    """ Centered columns with unit norm (missing values as the mean), whose products are correlations """
+    X = df.to_numpy(dtype=float)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        X = np.nan_to_num(X - (np.nanmean(X, axis=0) if mean is None else mean))
+        norms = np.linalg.norm(X, axis=0)
+        return X / np.where(norms == 0, 1, norms)
 
 
-def feature_selection_xgb(X_train, y_train, K):
+def feature_selection_xgb(X_train, y_train, K, n_estimators=100, tree_method='hist', n_jobs=None, subsample=1.0,
+                          colsample_bytree=1.0, early_stopping_rounds=None, validation_fraction=0.1, random_state=0,
+                          use_cache=True, **xgb_params):
     """
     Returns a list of K features with highest importance score according to XGBoost.
+    The importance ranking is cached, keyed by a fingerprint of (X_train, y_train, screening parameters),
+    so models fitted on the same data (e.g. a sweep over model families on one fold) share one screening model.
+
+    Args:
+        X_train: Training set
+        y_train: Training labels
+        K: Number of features to select
+        n_estimators: Maximal number of boosting rounds of the screening model.
+        tree_method: XGBoost tree method ('hist' is the fastest on large data).
+        n_jobs: Number of XGBoost threads (None: XGBoost's default).
+        subsample: Fraction of the rows sampled for each tree.
+        colsample_bytree: Fraction of the columns sampled for each tree.
+        early_stopping_rounds: If given, boosting stops when the log loss of a stratified validation split
+                               (validation_fraction of the rows) did not improve for this number of rounds.
+        validation_fraction: Size of the early stopping validation split.
+        random_state: Seed of the screening model and of the validation split.
+        use_cache: Whether to reuse (and store) the ranking of an identical screening.
+        xgb_params: Additional keyword arguments of XGBClassifier.
+    """
+    params = dict(n_estimators=n_estimators, tree_method=tree_method, n_jobs=n_jobs, subsample=subsample,
+                  colsample_bytree=colsample_bytree, early_stopping_rounds=early_stopping_rounds,
+                  validation_fraction=validation_fraction, random_state=random_state, **xgb_params)
+    key = data_fingerprint(X_train, y_train, params) if use_cache else None
+    if key in XGB_RANKING_CACHE:
+        XGB_RANKING_CACHE.move_to_end(key)
+        return list(XGB_RANKING_CACHE[key].index[:K])
+
+    ranking = xgb_importance_ranking(X_train, y_train, **params)
+    if use_cache:
+        XGB_RANKING_CACHE[key] = ranking
+        if len(XGB_RANKING_CACHE) > XGB_RANKING_CACHE_SIZE:
+            XGB_RANKING_CACHE.popitem(last=False)
+
+    return list(ranking.index[:K])
+
+
+def xgb_importance_ranking(X_train, y_train, early_stopping_rounds=None, validation_fraction=0.1, random_state=0,
+                           **xgb_params):
     """
-    xgb_clf = xgb.XGBClassifier(n_estimators=100)
-    xgb_clf.fit(X_train, y_train)
+    Trains the screening XGBoost model and returns the features importance, in descending order.
+    An helper function of feature_selection_xgb()
+    """
+    import xgboost as xgb
+    from sklearn.model_selection import train_test_split
+
+    xgb_clf = xgb.XGBClassifier(early_stopping_rounds=early_stopping_rounds, random_state=random_state, **xgb_params)
+    if early_stopping_rounds is None:
+        xgb_clf.fit(X_train, y_train)
+    else:
+        X_fit, X_val, y_fit, y_val = train_test_split(X_train, y_train, test_size=validation_fraction,
+                                                      stratify=y_train, random_state=random_state)
+        xgb_clf.fit(X_fit, y_fit, eval_set=[(X_val, y_val)], verbose=False)
     feature_importance = pd.Series(xgb_clf.feature_importances_, index=X_train.columns)
-    features = list(feature_importance.nlargest(K).index)
 
-    return features
+    return feature_importance.nlargest(len(feature_importance))
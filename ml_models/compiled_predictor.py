@@ -0,0 +1,264 @@
+''' NumPy inference path of a fitted MLModel (imputation, standardization, anomaly scores, selection, prediction) '''
+import warnings
+
+import numpy as np
+import pandas as pd
+from anomaly_scores.anomaly_scores import ANOMALY_METHODS
+from anomaly_scores.lof import score_samples_in_batches
+
+# Up to this number of rows, LOF and Isolation Forest scores are computed here, without sklearn's per-call overhead
+SMALL_BATCH_ROWS = 64
+
+# The fitted (private) sklearn attributes read by the compiled paths. If an estimator doesn't have them (e.g. another
+# sklearn version), its public transform / score_samples / decision_function is used instead.
+ITERATIVE_IMPUTER_ATTRIBUTES = ['_is_empty_feature', '_min_value', '_max_value', 'imputation_sequence_',
+                                'initial_imputer_']
+LOF_ATTRIBUTES = ['_fit_X', '_lrd', '_distances_fit_X_', 'effective_metric_', 'n_neighbors_']
+ISOLATION_FOREST_ATTRIBUTES = ['estimators_', 'estimators_features_', '_max_features', '_max_samples',
+                               '_decision_path_lengths', '_average_path_length_per_tree', 'offset_']
+
+
+class CompiledPredictor:
+    """
+    The CompiledPredictor object applies the preprocessing stage of a fitted MLModel and its classifier on a
+    contiguous float array, with the column order and index arrays computed once, when it is built (lazily, on the
+    first use of the MLModel.predictor property).
+    It gives the same risk scores as MLModel.evaluation, but skips the anomaly detectors whose scores were not
+    selected, and doesn't build intermediate data frames. Not available for per-patient (LOCF) imputation.
+    """
+
+    def __init__(self, model):
+        self.columns = list(model.input_columns)
+        column_index = {col: index for index, col in enumerate(self.columns)}
+        bool_cols = list(model.categorical_mode.index)
+        self.numerical_cols = [col for col in self.columns if col not in set(bool_cols)]
+        self.bool_idx = np.array([column_index[col] for col in bool_cols], dtype=int)
+        self.num_idx = np.array([column_index[col] for col in self.numerical_cols], dtype=int)
+        self.categorical_mode = model.categorical_mode.to_numpy(dtype=float)
+
+        # Imputation (and missing indicators)
+        self.imputer = model.imputer
+        self.linear_imputation = compile_iterative_imputer(model.imputer)
+        self.indicator_idx = np.array([column_index[col] for col in model.imputer.indicator_cols], dtype=int)
+        frame_columns = self.columns + [col + "_missing" for col in model.imputer.indicator_cols]
+
+        # Standardization
+        self.standardizer = model.standardizer if model.standardization else None
+
+        # Anomaly scores - only the detectors whose columns were selected
+        selected = set(model.selected_features)
+        methods = [method for method, run in zip(ANOMALY_METHODS, model.anomaly_vector) if run]
+        self.anomaly_cols = [col_name for col_name, _ in methods]
+        self.detectors = [(position, col_name, model.anomaly_clf[clf_name])
+                          for position, (col_name, clf_name) in enumerate(methods) if col_name in selected]
+        self.anomaly_input = model.std_params_for_anomaly.get("anomaly_input")
+        self.anomaly_scores = model.std_params_for_anomaly.get("anomaly_scores") if model.standardization else None
+        self.lof_batch_size = (model.anomaly_params.get('lof') or {}).get('batch_size')
+        self.compiled_forests = {}
+
+        # Feature selection and prediction
+        all_index = {col: index for index, col in enumerate(frame_columns + self.anomaly_cols)}
+        self.selected_idx = np.array([all_index[col] for col in model.selected_features], dtype=int)
+        self.predict_function = model.predict
+
+    def predict(self, X):
+        """
+        Risk scores of X: a data frame with the training columns, or an array (rows x training columns, or a
+        single row) in the training columns order.
+        """
+        if isinstance(X, pd.DataFrame):
+            values = X[self.columns].to_numpy(dtype=float, copy=True)  # preprocessed in place
+        else:
+            values = np.array(X, dtype=float, ndmin=2)
+
+        with warnings.catch_warnings():
+            # The estimators were fitted on data frames, and are applied here on arrays
+            warnings.filterwarnings('ignore', message='X does not have valid feature names')
+            return self.predict_function(self.preprocess(values))
+
+    def predict_one(self, row):
+        """ Risk score of a single row: a dict / Series (by column name), or an array in the training columns order """
+        if isinstance(row, (dict, pd.Series)):
+            row = [row.get(col, np.nan) for col in self.columns]
+        return self.predict(np.array(row, dtype=float, ndmin=2))[0]
+
+    def preprocess(self, values):
+        """ The preprocessed (rows x selected features) array of the (rows x training columns) array values """
+        # Bool columns mode and missing indicators
+        if len(self.bool_idx):
+            bool_values = values[:, self.bool_idx]
+            values[:, self.bool_idx] = np.where(np.isnan(bool_values), self.categorical_mode, bool_values)
+        indicators = np.isnan(values[:, self.indicator_idx])
+
+        # Imputation and standardization of the numerical columns
+        numerical = values[:, self.num_idx]
+        if np.isnan(numerical).any():
+            numerical = self.impute(numerical)
+        if self.standardizer is not None:
+            numerical = self.standardizer.transform_array(numerical, self.numerical_cols, out=numerical)
+        values[:, self.num_idx] = numerical
+        frame = np.hstack([values, indicators]) if indicators.shape[1] else values
+
+        # Anomaly scores of the selected detectors
+        scores = np.full((len(frame), len(self.anomaly_cols)), np.nan)
+        if self.detectors:
+            detector_input = frame
+            if self.anomaly_input is not None:
+                detector_input = frame.copy()
+                detector_input[:, self.num_idx] = self.anomaly_input.transform_array(
+                    detector_input[:, self.num_idx], self.numerical_cols)
+            for position, col_name, clf in self.detectors:
+                scores[:, position] = self.anomaly_score(col_name, clf, frame, detector_input)
+                if self.anomaly_scores is not None:
+                    scores[:, position] = self.anomaly_scores.transform_array(scores[:, position], [col_name])
+
+        return np.hstack([frame, scores])[:, self.selected_idx]
+
+    def impute(self, numerical):
+        """ Imputes the numerical columns, as Imputer.transform """
+        if self.linear_imputation is not None:
+            return linear_iterative_imputation(numerical, *self.linear_imputation)
+        if self.imputer.method == 'knn':
+            return self.imputer.knn_transform(pd.DataFrame(numerical, columns=self.numerical_cols))
+        return self.imputer.engine.transform(numerical)
+
+    def anomaly_score(self, col_name, clf, frame, detector_input):
+        """ The anomaly scores of one detector, as add_anomaly_scores_unseen """
+        if col_name.startswith("lof"):
+            if type(clf).__name__ == 'LocalOutlierFactor' and len(frame) <= SMALL_BATCH_ROWS:
+                return brute_force_lof_scores(clf, detector_input)
+            return score_samples_in_batches(clf, pd.DataFrame(detector_input), self.lof_batch_size)
+        if col_name.startswith("ocsvm"):
+            return clf.score_samples(detector_input)
+
+        # Isolation forest
+        if len(frame) <= SMALL_BATCH_ROWS:
+            if id(clf) not in self.compiled_forests:
+                self.compiled_forests[id(clf)] = compile_isolation_forest(clf)
+            if self.compiled_forests[id(clf)] is not None:
+                return isolation_forest_scores(self.compiled_forests[id(clf)], frame)
+        return clf.decision_function(frame)
+
+
+def compile_iterative_imputer(imputer):
+    """
+    The arrays of a fitted (iterative) Imputer whose estimators are linear: initial fill values, and for each
+    imputation step the imputed feature, its predictors and their coefficients.
+    Returns None if the imputer can't be applied this way (the engine is then used as is).
+    """
+    engine = imputer.engine
+    if imputer.method == 'iterative_subset':  # CorrelatedSubsetImputer
+        if not all(hasattr(estimator, 'coef_') for _, _, estimator in engine.imputation_sequence):
+            return None
+        steps = [(feat_idx, np.asarray(neighbor_idx), np.ravel(estimator.coef_),
+                  float(np.ravel(estimator.intercept_)[0])) for feat_idx, neighbor_idx, estimator in
+                 engine.imputation_sequence]
+        no_bounds = np.full(len(engine.initial_values), np.inf)
+        return engine.initial_values.astype(float), steps, -no_bounds, no_bounds
+    if imputer.method != 'iterative' or not has_attributes(engine, ITERATIVE_IMPUTER_ATTRIBUTES):
+        return None
+    if engine.sample_posterior or engine._is_empty_feature.any() or not np.isnan(engine.missing_values):
+        return None
+    if not all(hasattr(step.estimator, 'coef_') for step in engine.imputation_sequence_):
+        return None
+
+    steps = [(step.feat_idx, np.asarray(step.neighbor_feat_idx), np.ravel(step.estimator.coef_),
+              float(np.ravel(step.estimator.intercept_)[0])) for step in engine.imputation_sequence_]
+    return engine.initial_imputer_.statistics_.astype(float), steps, engine._min_value, engine._max_value
+
+
+def linear_iterative_imputation(numerical, initial_values, steps, min_value, max_value):
+    """ IterativeImputer.transform, for linear estimators, on an array """
+    missing = np.isnan(numerical)
+    imputed = np.where(missing, initial_values, numerical)
+    if missing.all():
+        return imputed
+
+    for feat_idx, neighbor_idx, coef, intercept in steps:
+        rows = missing[:, feat_idx]
+        if len(imputed) == 1:
+            if rows[0]:
+                imputed[0, feat_idx] = np.clip(imputed[0, neighbor_idx] @ coef + intercept,
+                                               min_value[feat_idx], max_value[feat_idx])
+        elif rows.any():
+            imputed[rows, feat_idx] = np.clip(imputed[np.ix_(rows, neighbor_idx)] @ coef + intercept,
+                                              min_value[feat_idx], max_value[feat_idx])
+
+    return imputed
+
+
+def brute_force_lof_scores(clf, X):
+    """ LocalOutlierFactor.score_samples of a few rows, by a brute force (euclidean) neighbors search """
+    if not has_attributes(clf, LOF_ATTRIBUTES):
+        return clf.score_samples(X)
+    fit_X = clf._fit_X
+    if clf.effective_metric_ != 'euclidean' or not isinstance(fit_X, np.ndarray):
+        return clf.score_samples(X)
+
+    n_neighbors = clf.n_neighbors_
+    distances = np.vstack([np.sqrt(((fit_X - row) ** 2).sum(axis=1)) for row in X])
+    neighbors = np.argpartition(distances, n_neighbors - 1, axis=1)[:, :n_neighbors]
+    neighbor_distances = np.take_along_axis(distances, neighbors, axis=1)
+
+    # Local reachability density (as LocalOutlierFactor._local_reachability_density)
+    reach_distances = np.maximum(neighbor_distances, clf._distances_fit_X_[neighbors, n_neighbors - 1])
+    X_lrd = 1.0 / (np.mean(reach_distances, axis=1) + 1e-10)
+
+    return -np.mean(clf._lrd[neighbors] / X_lrd[:, np.newaxis], axis=1)
+
+
+def compile_isolation_forest(clf):
+    """
+    The nodes of all the trees of a fitted IsolationForest as padded (trees x nodes) arrays, with the path length
+    of every leaf, so that a few rows are scored by walking all the trees together.
+    Returns None if the forest doesn't have the expected attributes (its decision_function is then used).
+    """
+    try:
+        from sklearn.ensemble._iforest import _average_path_length
+    except ImportError:
+        return None
+    if not has_attributes(clf, ISOLATION_FOREST_ATTRIBUTES):
+        return None
+
+    n_trees = len(clf.estimators_)
+    n_nodes = max(tree.tree_.node_count for tree in clf.estimators_)
+    subsample_features = clf._max_features != clf.n_features_in_
+    feature = np.zeros((n_trees, n_nodes), dtype=int)
+    threshold = np.zeros((n_trees, n_nodes))
+    children = np.zeros((n_trees, n_nodes, 2), dtype=int)
+    path_length = np.zeros((n_trees, n_nodes))
+    for index, (tree, features) in enumerate(zip(clf.estimators_, clf.estimators_features_)):
+        nodes = tree.tree_
+        count = nodes.node_count
+        is_leaf = nodes.children_left == -1
+        node_features = np.where(is_leaf, 0, nodes.feature)
+        feature[index, :count] = np.asarray(features)[node_features] if subsample_features else node_features
+        threshold[index, :count] = nodes.threshold
+        # a leaf points to itself
+        children[index, :count, 0] = np.where(is_leaf, np.arange(count), nodes.children_left)
+        children[index, :count, 1] = np.where(is_leaf, np.arange(count), nodes.children_right)
+        path_length[index, :count] = clf._decision_path_lengths[index] + clf._average_path_length_per_tree[index] - 1.0
+
+    max_depth = max(tree.tree_.max_depth for tree in clf.estimators_)
+    denominator = n_trees * _average_path_length([clf._max_samples])[0]
+    return feature, threshold, children, path_length, max_depth, denominator, clf.offset_
+
+
+def isolation_forest_scores(compiled_forest, X):
+    """ IsolationForest.decision_function of a few rows, by the arrays of compile_isolation_forest """
+    feature, threshold, children, path_length, max_depth, denominator, offset = compiled_forest
+    X = X.astype(np.float32).astype(float)  # the trees compare float32 values, as sklearn
+    trees = np.arange(feature.shape[0])
+    nodes = np.zeros((len(X), len(trees)), dtype=int)
+    rows = np.arange(len(X))[:, None]
+    for _ in range(max_depth):
+        go_right = X[rows, feature[trees, nodes]] > threshold[trees, nodes]
+        nodes = children[trees, nodes, go_right.astype(int)]
+
+    depths = path_length[trees, nodes].sum(axis=1)
+    scores = -2 ** (-depths / denominator) if denominator != 0 else -np.ones(len(X))
+    return scores - offset
+
+
+def has_attributes(estimator, attributes):
+    return all(hasattr(estimator, attribute) for attribute in attributes)
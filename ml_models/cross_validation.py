@@ -0,0 +1,156 @@
+''' Patient-grouped cross-validation and comparison of model families, run in parallel '''
+import multiprocessing
+import os
+import queue
+import tempfile
+from contextlib import nullcontext
+
+import numpy as np
+import pandas as pd
+
+from ml_models.preprocessing_cache import PreprocessingCache
+
+# The data of the CV jobs, set once per worker process by init_cv_worker
+CV_DATA = {}
+
+
+def cross_validate(df, target_col, model_specs, n_splits=5, group_col='patient_id', feature_cols=None, n_workers=1,
+                   max_tasks_per_worker=4, cache_dir=None):
+    """
+    Patient-grouped K-fold cross validation of several model classes and hyperparameter sets.
+    Each (fold, model class, hyperparameters) job fits a model on the training patients and evaluates it on the fold's
+    patients. The jobs of a fold share its preprocessing stage through a PreprocessingCache on disk: the first job of
+    each fold is run before the other jobs of the fold are submitted.
+
+    Args:
+        df: Time-series data frame (a row per patient and time step).
+        target_col: Name of the label column.
+        model_specs: A list of (model class, keyword arguments) pairs, e.g. [(XgboostModel, {'n_estimators': 100})].
+        n_splits: Number of folds. A patient's rows are all in the same fold (no leakage between folds).
+        group_col: Name of the patient id column.
+        feature_cols: The feature columns. By default, all the numerical and bool columns except target_col
+                      and group_col.
+        n_workers: Number of worker processes (1: the jobs run serially in this process). The workers are spawned,
+                   so a calling script must be guarded by if __name__ == '__main__'.
+        max_tasks_per_worker: Number of jobs after which a worker process is replaced, to bound its memory.
+        cache_dir: Directory of the shared preprocessing cache (default: a temporary directory).
+
+    Returns: A tidy data frame with a row per (job, test row): fold, model, params, row, patient id,
+             target and risk_score.
+    """
+    from sklearn.model_selection import GroupKFold
+
+    if feature_cols is None:
+        feature_cols = default_feature_cols(df, target_col, group_col)
+    folds = list(GroupKFold(n_splits=n_splits).split(df, groups=df[group_col]))
+
+    # The jobs of each fold, the first of which warms the fold's preprocessing cache
+    fold_jobs = [[(fold, model_class, params) for model_class, params in model_specs] for fold in range(len(folds))]
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        init_args = (df, target_col, group_col, feature_cols, folds, cache_dir or temp_dir)
+        with cv_pool(init_args, n_workers, max_tasks_per_worker) as pool:
+            results = run_job_groups(pool, fold_jobs)
+
+    return pd.concat(results, ignore_index=True)
+
+
+def default_feature_cols(df, target_col, group_col):
+    """ All the numerical and bool columns except the label and the patient id """
+    return [col for col in df.select_dtypes(include=['number', 'bool']).columns if col not in [target_col, group_col]]
+
+
+def cv_pool(init_args, n_workers=1, max_tasks_per_worker=4):
+    """
+    A (spawned) process pool whose workers are initialized with the CV data (init_cv_worker's arguments),
+    or None if n_workers == 1 (the CV data is then set in this process).
+    A multiprocessing Pool is used, since it reliably replaces the workers after max_tasks_per_worker jobs.
+    """
+    n_workers = os.cpu_count() if n_workers == -1 else n_workers
+    if n_workers == 1:
+        init_cv_worker(*init_args)
+        return nullcontext()
+
+    return multiprocessing.get_context('spawn').Pool(n_workers, initializer=init_cv_worker, initargs=init_args,
+                                                     maxtasksperchild=max_tasks_per_worker)
+
+
+def run_job_groups(pool, job_groups):
+    """
+    Runs the jobs (run_cv_job's arguments) of each group sharing a preprocessing stage: the first job of each group,
+    then the rest of the group's jobs once it is done (and cached). Serially if pool is None.
+    Returns the jobs results, in the order of job_groups.
+    """
+    if pool is None:
+        return [run_cv_job(*job) for jobs in job_groups for job in jobs]
+
+    completed = queue.Queue()
+
+    def submit(group, index):
+        pool.apply_async(run_cv_job, job_groups[group][index],
+                         callback=lambda result: completed.put((group, index, result, None)),
+                         error_callback=lambda error: completed.put((group, index, None, error)))
+
+    results = {}
+    n_pending = 0
+    for group, jobs in enumerate(job_groups):
+        if jobs:
+            submit(group, 0)
+            n_pending += 1
+    while n_pending:
+        group, index, result, error = completed.get()
+        n_pending -= 1
+        if error is not None:
+            raise error
+        results[group, index] = result
+        if index == 0:
+            for job_index in range(1, len(job_groups[group])):
+                submit(group, job_index)
+                n_pending += 1
+
+    return [results[key] for key in sorted(results)]
+
+
+def init_cv_worker(df, target_col, group_col, feature_cols, folds, cache_dir):
+    """ Sets the data of the CV jobs (once per worker process) """
+    CV_DATA.update(df=df, target_col=target_col, group_col=group_col, feature_cols=feature_cols, folds=folds,
+                   cache=PreprocessingCache(max_entries=1, cache_dir=cache_dir))
+
+
+def run_cv_job(fold, model_class, params, train_fraction=1.0):
+    """
+    Fits model_class(**params) on the training rows of the fold, and returns its tidy evaluation on the fold.
+    If train_fraction < 1, the model is fitted on the rows of a (fixed, per fold) random fraction of the training
+    patients, so that the subsets of increasing fractions are nested.
+    """
+    df, target_col, group_col = CV_DATA['df'], CV_DATA['target_col'], CV_DATA['group_col']
+    train_rows, test_rows = CV_DATA['folds'][fold]
+    train, test = df.iloc[train_rows], df.iloc[test_rows]
+    if train_fraction < 1:
+        patients = np.random.default_rng(fold).permutation(train[group_col].unique())
+        patients = patients[:max(int(np.ceil(train_fraction * len(patients))), 1)]
+        train = train[train[group_col].isin(patients)]
+
+    model = model_class(**params)
+    model.fit(train[CV_DATA['feature_cols']].copy(), train[target_col], groups=train[group_col],
+              cache=CV_DATA['cache'])
+    risk_scores = model.evaluation(test[CV_DATA['feature_cols']].copy(), test[target_col], groups=test[group_col])
+
+    return pd.DataFrame({'fold': fold,
+                         'model': model.model_name,
+                         'params': repr(params),
+                         'row': test.index,
+                         group_col: test[group_col].to_numpy(),
+                         'target': risk_scores['target'].to_numpy(),
+                         'risk_score': risk_scores[model.model_name].to_numpy()})
+
+
+def summarize_cv_results(results):
+    """ AUROC of each (model, params, fold) of the cross_validate results, with its mean and SD over the folds """
+    from sklearn.metrics import roc_auc_score
+
+    fold_auroc = results.groupby(['model', 'params', 'fold']).apply(
+        lambda rows: roc_auc_score(rows['target'], rows['risk_score']) if rows['target'].nunique() > 1 else np.nan)
+    fold_auroc = fold_auroc.rename('auroc').reset_index()
+
+    return fold_auroc.groupby(['model', 'params'])['auroc'].agg(['mean', 'std']).sort_values('mean', ascending=False)
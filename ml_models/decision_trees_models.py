@@ -1,14 +1,16 @@
 from ml_models.ml_models import MLModel
-from sklearn.ensemble import GradientBoostingClassifier, RandomForestClassifier
-from catboost import CatBoostClassifier
-import xgboost as xgb
+
+# The classifiers' backends are imported by the model classes that use them (catboost and xgboost are slow to import)
 
 
 class CatboostModel(MLModel):
 
     def __init__(self, selection_metric='XGB', n_features=100, standardization=False, anomaly_vector=[0, 0, 0, 0, 0],
-                 n_estimators=None, depth=None, learning_rate=None, l2_leaf_reg=None):
-        MLModel.__init__(self, selection_metric, n_features, standardization, anomaly_vector)
+                 n_estimators=None, depth=None, learning_rate=None, l2_leaf_reg=None,
+                 *, anomaly_params=None, imputation_params=None, selection_params=None):
+        MLModel.__init__(self, selection_metric, n_features, standardization, anomaly_vector,
+                         anomaly_params=anomaly_params, imputation_params=imputation_params,
+                         selection_params=selection_params)
 
         # Hyperparameters
         self.n_estimators = n_estimators
@@ -17,6 +19,7 @@ class CatboostModel(MLModel):
         self.l2_leaf_reg = l2_leaf_reg
 
         # Model
+        from catboost import CatBoostClassifier
         self.model_name = 'CTB'
         self.clf = CatBoostClassifier(verbose=False,
                                       n_estimators=self.n_estimators,
@@ -29,8 +32,11 @@ class CatboostModel(MLModel):
 class XgboostModel(MLModel):
 
     def __init__(self, selection_metric='XGB', n_features=100, standardization=False, anomaly_vector=[0, 0, 0, 0, 0],
-                 n_estimators=None, max_depth=None, learning_rate=None, colsample_bytree=None):
-        MLModel.__init__(self, selection_metric, n_features, standardization, anomaly_vector)
+                 n_estimators=None, max_depth=None, learning_rate=None, colsample_bytree=None,
+                 *, anomaly_params=None, imputation_params=None, selection_params=None):
+        MLModel.__init__(self, selection_metric, n_features, standardization, anomaly_vector,
+                         anomaly_params=anomaly_params, imputation_params=imputation_params,
+                         selection_params=selection_params)
 
         # Hyperparameters
         self.n_estimators = n_estimators
@@ -39,6 +45,7 @@ class XgboostModel(MLModel):
         self.colsample_bytree = colsample_bytree
 
         # Model
+        import xgboost as xgb
         self.model_name = 'XGB'
         self.clf = xgb.XGBClassifier(n_estimators=n_estimators,
                                      learning_rate=learning_rate,
@@ -50,8 +57,11 @@ class XgboostModel(MLModel):
 class GbtModel(MLModel):
 
     def __init__(self, selection_metric='XGB', n_features=100, standardization=False, anomaly_vector=[0, 0, 0, 0, 0],
-                 n_estimators=None, learning_rate=None, max_depth=None):
-        MLModel.__init__(self, selection_metric, n_features, standardization, anomaly_vector)
+                 n_estimators=None, learning_rate=None, max_depth=None,
+                 *, anomaly_params=None, imputation_params=None, selection_params=None):
+        MLModel.__init__(self, selection_metric, n_features, standardization, anomaly_vector,
+                         anomaly_params=anomaly_params, imputation_params=imputation_params,
+                         selection_params=selection_params)
 
         # Hyperparameters
         self.n_estimators = n_estimators
@@ -59,6 +69,7 @@ class GbtModel(MLModel):
         self.learning_rate = learning_rate
 
         # Model
+        from sklearn.ensemble import GradientBoostingClassifier
         self.model_name = 'GBT'
         self.clf = GradientBoostingClassifier(n_estimators=n_estimators,
                                               learning_rate=learning_rate,
@@ -69,14 +80,18 @@ class GbtModel(MLModel):
 class RFModel(MLModel):
 
     def __init__(self, selection_metric='XGB', n_features=100, standardization=False, anomaly_vector=[0, 0, 0, 0, 0],
-                 n_estimators=None, max_depth=None):
-        MLModel.__init__(self, selection_metric, n_features, standardization, anomaly_vector)
+                 n_estimators=None, max_depth=None,
+                 *, anomaly_params=None, imputation_params=None, selection_params=None):
+        MLModel.__init__(self, selection_metric, n_features, standardization, anomaly_vector,
+                         anomaly_params=anomaly_params, imputation_params=imputation_params,
+                         selection_params=selection_params)
 
         # Hyperparameters
         self.n_estimators = n_estimators
         self.max_depth = max_depth
 
         # Model
+        from sklearn.ensemble import RandomForestClassifier
         self.model_name = 'RF'
         self.clf = RandomForestClassifier(n_estimators=n_estimators,
                                           max_depth=max_depth)
@@ -0,0 +1,113 @@
+''' Successive halving hyperparameter search over the model classes, on patient-grouped CV folds '''
+import inspect
+import math
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from ml_models.cross_validation import cv_pool, default_feature_cols, run_job_groups
+
+
+def successive_halving_search(df, target_col, search_space, resource='rows', max_resource=1.0, min_resource=None,
+                              eta=3, n_splits=3, group_col='patient_id', feature_cols=None, n_workers=1,
+                              max_tasks_per_worker=4, cache_dir=None):
+    """
+    Successive halving search: all the candidates (model class, hyperparameters) are evaluated with a small resource,
+    and only the best 1/eta of them (by mean fold AUROC) are evaluated again with eta times more resource, until
+    a single candidate is left or the resource reaches max_resource.
+    The trials of each round run in parallel, on patient-grouped folds (see cross_validate).
+
+    Args:
+        df: Time-series data frame (a row per patient and time step).
+        target_col: Name of the label column.
+        search_space: A list of (model class, parameter grid) pairs. A parameter grid maps each keyword argument of
+                      the class to a list of values, e.g. [(XgboostModel, {'n_estimators': [100], 'max_depth': [3, 6]}),
+                      (LogRegModel, {'penalty': ['l1', 'l2'], 'standardization': [False, True]})].
+        resource: 'rows' - the fraction of the training patients of each fold.
+                  Otherwise, an integer keyword argument of the model classes (e.g. 'n_estimators'), set to the round's
+                  resource (at least 1) for the classes that accept it (the other classes are evaluated with their own
+                  parameters).
+        max_resource: The resource of the last round (1.0 for 'rows').
+        min_resource: The resource of the first round. By default, max_resource / eta^(number of rounds - 1).
+        eta: The factor by which the candidates are reduced, and the resource increased, in every round.
+        n_splits: Number of (patient-grouped) folds.
+        group_col: Name of the patient id column.
+        feature_cols: The feature columns. By default, all the numerical and bool columns except target_col
+                      and group_col.
+        n_workers: Number of worker processes (1: serially in this process). See cross_validate.
+        max_tasks_per_worker: Number of trials after which a worker process is replaced, to bound its memory.
+        cache_dir: Directory of the shared preprocessing cache (default: a temporary directory).
+
+    Returns:
+        best: The (model class, parameters) of the best candidate in the last round (with the resource parameter).
+        history: A data frame with the mean and SD fold AUROC of every candidate in every round.
+    """
+    from sklearn.model_selection import GroupKFold, ParameterGrid
+
+    candidates = [(model_class, params) for model_class, grid in search_space for params in ParameterGrid(grid)]
+    assert candidates, "Error! The search space is empty"
+    n_rounds = int(math.log(len(candidates), eta) + 1e-9) + 1
+    if min_resource is None:
+        min_resource = max_resource / eta ** (n_rounds - 1)
+
+    if feature_cols is None:
+        feature_cols = default_feature_cols(df, target_col, group_col)
+    folds = list(GroupKFold(n_splits=n_splits).split(df, groups=df[group_col]))
+
+    history = []
+    alive = list(range(len(candidates)))
+    with tempfile.TemporaryDirectory() as temp_dir:
+        init_args = (df, target_col, group_col, feature_cols, folds, cache_dir or temp_dir)
+        with cv_pool(init_args, n_workers, max_tasks_per_worker) as pool:
+            for round_index in range(n_rounds):
+                amount = min(min_resource * eta ** round_index, max_resource)
+                if resource != 'rows':
+                    amount = max(int(round(amount)), 1)
+                auroc = evaluate_candidates(pool, [candidates[index] for index in alive], len(folds), resource,
+                                            amount)
+
+                n_kept = 1 if round_index == n_rounds - 1 else max(math.ceil(len(alive) / eta), 1)
+                ranking = np.argsort(-np.nan_to_num(np.nanmean(auroc, axis=1), nan=-np.inf), kind='stable')
+                for rank, position in enumerate(ranking):
+                    model_class, params = candidates[alive[position]]
+                    params = with_resource(model_class, params, resource, amount)
+                    history.append({'round': round_index, 'resource': amount, 'model': model_class.__name__,
+                                    'params': repr(params), 'mean_auroc': np.nanmean(auroc[position]),
+                                    'std_auroc': np.nanstd(auroc[position]), 'promoted': rank < n_kept})
+                alive = [alive[position] for position in ranking[:n_kept]]
+                print(f"Successive halving round {round_index}: {len(ranking)} candidates, resource={amount}")
+
+    model_class, params = candidates[alive[0]]
+    return (model_class, with_resource(model_class, params, resource, amount)), pd.DataFrame(history)
+
+
+def evaluate_candidates(pool, candidates, n_folds, resource, amount):
+    """
+    Evaluates the candidates on all the folds with the given resource amount.
+    Returns a (candidates x folds) array of AUROC. An helper function of successive_halving_search()
+    """
+    from sklearn.metrics import roc_auc_score
+
+    train_fraction = amount if resource == 'rows' else 1.0
+    trials = [(model_class, with_resource(model_class, params, resource, amount)) for model_class, params in candidates]
+
+    # The trials of a fold share its preprocessing stage (when their preprocessing parameters are equal)
+    job_groups = [[(fold, model_class, params, train_fraction) for model_class, params in trials]
+                  for fold in range(n_folds)]
+    results = run_job_groups(pool, job_groups)
+
+    auroc = np.full((len(candidates), n_folds), np.nan)
+    for index, result in enumerate(results):
+        fold, position = divmod(index, len(candidates))
+        if result['target'].nunique() > 1:
+            auroc[position, fold] = roc_auc_score(result['target'], result['risk_score'])
+
+    return auroc
+
+
+def with_resource(model_class, params, resource, amount):
+    """ params with the resource keyword argument set to amount, if model_class accepts it """
+    if resource != 'rows' and resource in inspect.signature(model_class.__init__).parameters:
+        return {**params, resource: amount}
+    return params
@@ -0,0 +1,155 @@
+''' Stage instrumentation - wall / CPU time, RSS and data shapes of the steps of MLModel.fit and evaluation '''
+import json
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+
+class StageProfiler:
+    """
+    The StageProfiler object records a span for every stage run inside its stage() context manager:
+    wall time, CPU time (process-wide, so concurrent spans - e.g. anomaly detectors with n_jobs > 1 - overlap),
+    the change of the RSS and of the peak RSS, and the shapes of the stage's input and output.
+    Nested stages are named by their path (e.g. "fit/anomaly_scores/lof_all").
+    The records are kept in memory (report()), and appended to a JSON lines file if json_path is given.
+    """
+
+    def __init__(self, json_path=None, context=None, enabled=True):
+        self.json_path = json_path
+        self.context = context if context is not None else {}  # added to every record (e.g. cohort, fold)
+        self.enabled = enabled
+        self.records = []
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def stage(self, name, data=None):
+        """ A context manager recording a span of the stage name. data is the stage's input (for its shape). """
+        if not self.enabled:
+            return NULL_SPAN
+        path = self.path()
+        return Span(self, path[-1] + '/' + name if path else name, data)
+
+    def wrap(self, name, function, data=None):
+        """ function (without arguments) that runs in a span of the stage name - created now, run later """
+        if not self.enabled:
+            return function
+        span = self.stage(name, data)
+
+        def run():
+            with span:
+                output = function()
+                span.output(output[0] if isinstance(output, tuple) else output)
+            return output
+        return run
+
+    def path(self):
+        """ The (full) names of the open spans of the current thread """
+        if not hasattr(self.local, 'path'):
+            self.local.path = []
+        return self.local.path
+
+    def add(self, record):
+        record = {**self.context, **record}
+        with self.lock:
+            self.records.append(record)
+            if self.json_path is not None:
+                with open(self.json_path, 'a') as f:
+                    f.write(json.dumps({key: None if isinstance(value, float) and np.isnan(value) else value
+                                        for key, value in record.items()}, default=str) + '\n')
+
+    def report(self):
+        """ The recorded spans as a dataframe (one row per span, in the order they ended) """
+        return pd.DataFrame(self.records)
+
+    def clear(self):
+        self.records = []
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['local'], state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+
+class Span:
+    """ A single stage span. An helper class of StageProfiler.stage() """
+
+    def __init__(self, profiler, name, data=None):
+        self.profiler = profiler
+        self.name = name
+        self.input_shape = data_shape(data)
+        self.output_shape = None
+
+    def output(self, data):
+        """ Records the shape of the stage's output """
+        self.output_shape = data_shape(data)
+
+    def __enter__(self):
+        self.profiler.path().append(self.name)
+        self.rss, self.peak_rss = current_rss_mb(), peak_rss_mb()
+        self.start, self.start_cpu = time.perf_counter(), time.process_time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        wall_sec, cpu_sec = time.perf_counter() - self.start, time.process_time() - self.start_cpu
+        self.profiler.path().pop()
+        self.profiler.add({'stage': self.name, 'wall_sec': wall_sec, 'cpu_sec': cpu_sec,
+                           'rss_delta_mb': current_rss_mb() - self.rss,
+                           'peak_rss_delta_mb': peak_rss_mb() - self.peak_rss,
+                           'input_shape': self.input_shape, 'output_shape': self.output_shape,
+                           'error': None if exc_type is None else exc_type.__name__, 'time': time.time()})
+        return False
+
+
+class NullSpan:
+    """ The span of a disabled (or missing) profiler - does nothing """
+
+    def output(self, data):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+def stage(profiler, name, data=None):
+    """ profiler.stage(name, data), or a span that does nothing if profiler is None """
+    return NULL_SPAN if profiler is None else profiler.stage(name, data)
+
+
+def data_shape(data):
+    if data is None or not hasattr(data, '__len__'):
+        return None
+    return list(np.shape(data)) if hasattr(data, 'shape') else [len(data)]
+
+
+def current_rss_mb():
+    """ The resident set size of the process (Linux), NaN if not available """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError, IndexError):
+        return np.nan
+
+
+def peak_rss_mb():
+    """ The peak resident set size of the process, NaN if not available """
+    try:
+        import resource
+    except ImportError:
+        return np.nan
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10  # bytes on macOS, KB on Linux
@@ -1,6 +1,12 @@
 from data_preprocessing.multivariate_imputation import *
 from anomaly_scores.anomaly_scores import *
 from feature_selection.feature_selection import *
+from data_preprocessing.column_profile import column_profile
+from data_preprocessing.standardization import Standardizer
+from ml_models.compiled_predictor import CompiledPredictor
+from ml_models.instrumentation import StageProfiler, stage
+from ml_models.model_artifact import save_artifact, load_artifact
+from ml_models.preprocessing_cache import PREPROCESSING_ATTRIBUTES
 
 
 class MLModel:
@@ -10,91 +16,219 @@ class MLModel:
     Usually used after performing CV.
     """
 
-    def __init__(self, selection_metric='XGB', n_features=100, standardization=False, anomaly_vector=[0, 0, 0, 0, 0]):
+    # StageProfiler of fit / evaluation (see instrument()), None when not instrumented
+    profiler = None
+    # CompiledPredictor of the fitted model, built on first use of the predictor property
+    compiled_predictor = None
+
+    def __init__(self, selection_metric='XGB', n_features=100, standardization=False, anomaly_vector=[0, 0, 0, 0, 0],
+                 *, anomaly_params=None, imputation_params=None, selection_params=None):
         # Pre-processing parameters
         self.selection_metric = selection_metric
         self.n_features = n_features
+        # e.g. {'absolute': True, 'redundancy_threshold': 0.9} (Correlation), {'n_jobs': 8, 'subsample': 0.5} (XGB)
+        self.selection_params = selection_params if selection_params is not None else {}
         self.standardization = standardization
-        self.standard_params = []
+        self.standardizer = None
 
         # Imputer (learned)
+        # e.g. {'method': 'locf', 'add_indicator': True}, see multivariate_imputation_seen
+        self.imputation_params = imputation_params if imputation_params is not None else {}
         self.categorical_mode = 0
         self.imputer = 0
 
         # Anomaly Parameters
         self.anomaly_vector = anomaly_vector
+        # e.g. {'n_jobs': 4, 'lof': {'max_samples': 50000, 'batch_size': 10000}, 'ocsvm': {'engine': 'linear'}}
+        self.anomaly_params = anomaly_params if anomaly_params is not None else {}
         self.std_params_for_anomaly = []
         self.anomaly_clf = {}
         self.anomaly_new_cols = []
 
         # Model parameters
+        self.input_columns = []
         self.clf = None
         self.model_name = ''
         self.selected_features = []
 
 
-    def fit(self, X_train, y_train):
-        """ Train model """
+    def fit(self, X_train, y_train, groups=None, cache=None):
+        """
+        Train model. groups (patient ids) are required only by per-patient imputation methods.
+        If a PreprocessingCache is given, the preprocessing stage is reused from it when the same data was already
+        preprocessed with the same configuration (e.g. by another model family on the same fold).
+        """
         print(f"Train {self.model_name}.\nTraining set size: {len(X_train)}")
 
+        with stage(self.profiler, 'fit', X_train):
+            self.compiled_predictor = None
+            if cache is None:
+                X_train = self.preprocess_seen(X_train, y_train, groups)
+            else:
+                key = cache.key(X_train, y_train, groups, self.preprocessing_config())
+                entry = cache.get(key)
+                if entry is None:
+                    X_train = self.preprocess_seen(X_train, y_train, groups)
+                    cache.put(key, X_train, {attr: getattr(self, attr) for attr in PREPROCESSING_ATTRIBUTES})
+                else:
+                    print("Preprocessing was loaded from the cache")
+                    with stage(self.profiler, 'preprocessing_cache') as span:
+                        X_train, attributes = entry
+                        X_train = X_train.copy()
+                        for attr, value in attributes.items():
+                            setattr(self, attr, value)
+                        span.output(X_train)
+
+            # Train XGB
+            with stage(self.profiler, 'classifier', X_train):
+                self.clf.fit(X_train, y_train)
+
+
+    @property
+    def predictor(self):
+        """
+        The NumPy inference path of the fitted model (CompiledPredictor: predictor.predict / predict_one), built on
+        first use. None before fit, and for per-patient (LOCF) imputation.
+        """
+        if self.compiled_predictor is None and self.imputer != 0 and self.imputer.method != 'locf':
+            with stage(self.profiler, 'compile_predictor'):
+                self.compiled_predictor = CompiledPredictor(self)
+        return self.compiled_predictor
+
+
+    def instrument(self, json_path=None, context=None, enabled=True):
+        """
+        Records the time, CPU, RSS and data shapes of every stage of fit and evaluation (see StageProfiler),
+        reported by stage_report() and appended to json_path (JSON lines) if given. Returns the model.
+        """
+        self.profiler = StageProfiler(json_path=json_path, context={'model': self.model_name, **(context or {})},
+                                      enabled=enabled)
+        return self
+
+
+    def stage_report(self):
+        """ The recorded stages of fit and evaluation, as a dataframe (empty if the model is not instrumented) """
+        return self.profiler.report() if self.profiler is not None else pd.DataFrame()
+
+
+    def preprocessing_config(self):
+        """ The parameters that determine the preprocessing stage (the cache key, with the data) """
+        return dict(standardization=self.standardization, anomaly_vector=list(self.anomaly_vector),
+                    selection_metric=self.selection_metric, n_features=self.n_features,
+                    anomaly_params=self.anomaly_params, imputation_params=self.imputation_params,
+                    selection_params=self.selection_params)
+
+
+    def preprocess_seen(self, X_train, y_train, groups=None):
+        """
+        Fits the preprocessing stage on the training set. Returns the preprocessed training set.
+        X_train itself is not modified (the steps work in place on a copy), so it can be shared by several models.
+        """
+        X_train = X_train.copy()
+        self.input_columns = list(X_train.columns)
         bool_cols = list(X_train.columns[X_train.dtypes == 'bool'])
         numerical_cols = [col for col in X_train.columns if col not in bool_cols]
 
         # Data imputation
         # Linear interpolation/ffill can be performed earlier to data partition
-        self.categorical_mode = X_train[bool_cols].mode().iloc[0]
-        X_train[bool_cols] = X_train[bool_cols].fillna(self.categorical_mode)
-        X_train, self.imputer = multivariate_imputation_seen(X_train, numerical_cols)
+        with stage(self.profiler, 'imputation', X_train) as span:
+            X_train, self.imputer = multivariate_imputation_seen(X_train, numerical_cols, groups=groups,
+                                                                 **self.imputation_params)
+            # One column profile of the imputed training set, shared by the following steps
+            profile = column_profile(X_train, distinct=bool_cols)
+            self.categorical_mode = profile.mode[bool_cols].astype(bool)
+            X_train[bool_cols] = X_train[bool_cols].fillna(self.categorical_mode)
+            span.output(X_train)
 
         # Standardization
+        self.standardizer = None
         if self.standardization:
-            X_train, self.standard_params = standardize_data(X_train, numerical_cols)
+            with stage(self.profiler, 'standardization', X_train):
+                self.standardizer = Standardizer()
+                X_train = self.standardizer.fit_transform(X_train, numerical_cols, inplace=True, profile=profile)
+                profile = profile.standardized(self.standardizer)
 
         # Anomaly scores
-        X_train, self.std_params_for_anomaly, self.anomaly_clf = add_anomaly_scores_seen(
-            X_train, y_train, numerical_cols, self.anomaly_vector, standardization=self.standardization)
-        self.anomaly_new_cols = list(self.anomaly_clf.keys())
+        with stage(self.profiler, 'anomaly_scores', X_train) as span:
+            X_train, self.std_params_for_anomaly, self.anomaly_clf = add_anomaly_scores_seen(
+                X_train, y_train, numerical_cols, self.anomaly_vector, standardization=self.standardization,
+                standardizer=self.standardizer, n_jobs=self.anomaly_params.get('n_jobs', 1),
+                lof_params=self.anomaly_params.get('lof'), ocsvm_params=self.anomaly_params.get('ocsvm'),
+                profiler=self.profiler, profile=profile)
+            self.anomaly_new_cols = list(self.anomaly_clf.keys())
+            span.output(X_train)
 
         # Feature selection
-        self.selected_features = feature_selection(X_train, y_train, selection_metric=self.selection_metric, K=self.n_features)
-        X_train = X_train[self.selected_features]
+        with stage(self.profiler, 'feature_selection', X_train) as span:
+            anomaly_cols = [col for col in X_train.columns if col not in profile.count.index]
+            if anomaly_cols:
+                profile = profile.with_columns(column_profile(X_train, anomaly_cols, distinct=False))
+            self.selected_features = feature_selection(X_train, y_train, selection_metric=self.selection_metric,
+                                                       K=self.n_features, profile=profile, **self.selection_params)
+            span.output(self.selected_features)
+        return X_train[self.selected_features]
+
+
+    def save(self, path):
+        """ Writes the fitted model to a single file (see model_artifact.save_artifact) """
+        save_artifact(self, path)
 
-        # Train XGB
-        self.clf.fit(X_train, y_train)
+
+    @staticmethod
+    def load(path, mmap=True):
+        """ Loads a model written by save(). With mmap=True, its arrays are mapped from the file (read-only). """
+        return load_artifact(path, mmap=mmap)
 
 
     def predict(self, X_test):
         return self.clf.predict_proba(X_test)[:, 1]
 
 
-    def evaluation(self, X_test, y_test):
+    def evaluation(self, X_test, y_test, groups=None):
         """ Predict and evaluate model """
         print(f"Evaluate {self.model_name}.\nTest set size: {len(X_test)}")
 
+        with stage(self.profiler, 'evaluation', X_test):
+            X_test = self.preprocess_unseen(X_test, groups)
+
+            # Predict
+            with stage(self.profiler, 'predict', X_test) as span:
+                predict_proba = self.predict(X_test)
+                span.output(predict_proba)
+            model_results = {}
+            model_results[self.model_name] = predict_proba
+            model_results["target"] = y_test
+            risk_scores_df = pd.DataFrame.from_dict(model_results)
+
+        return risk_scores_df
+
+
+    def preprocess_unseen(self, X_test, groups=None):
+        """ Applies the fitted preprocessing stage on (a copy of) the test set. Returns the preprocessed test set. """
+        X_test = X_test.copy()
         bool_cols = list(X_test.columns[X_test.dtypes == 'bool'])
         numerical_cols = [col for col in X_test.columns if col not in bool_cols]
 
         # Data imputation
         # Linear interpolation/ffill can be performed earlier to data partition
-        X_test[bool_cols] = X_test[bool_cols].fillna(self.categorical_mode)
-        X_test = multivariate_imputation_unseen(X_test, numerical_cols, self.imputer)
+        with stage(self.profiler, 'imputation', X_test) as span:
+            X_test[bool_cols] = X_test[bool_cols].fillna(self.categorical_mode)
+            X_test = multivariate_imputation_unseen(X_test, numerical_cols, self.imputer, groups=groups)
+            span.output(X_test)
 
         # Standartization
         if self.standardization:
-            X_test = standardize_unseen_data(X_test, numerical_cols, self.standard_params)
+            with stage(self.profiler, 'standardization', X_test):
+                X_test = self.standardizer.transform(X_test, numerical_cols, inplace=True)
 
         # Anomaly scores
-        X_test = add_anomaly_scores_unseen(X_test, numerical_cols, self.anomaly_vector, self.std_params_for_anomaly,
-                                           self.anomaly_clf, standardization=self.standardization)
+        with stage(self.profiler, 'anomaly_scores', X_test) as span:
+            X_test = add_anomaly_scores_unseen(X_test, numerical_cols, self.anomaly_vector,
+                                               self.std_params_for_anomaly, self.anomaly_clf,
+                                               standardization=self.standardization,
+                                               n_jobs=self.anomaly_params.get('n_jobs', 1),
+                                               lof_params=self.anomaly_params.get('lof'), profiler=self.profiler)
+            span.output(X_test)
 
         # Feature selection
-        X_test = X_test[self.selected_features]
-
-        # Predict
-        predict_proba = self.predict(X_test)
-        model_results = {}
-        model_results[self.model_name] = predict_proba
-        model_results["target"] = y_test
-        risk_scores_df = pd.DataFrame.from_dict(model_results)
-
-        return risk_scores_df
+        return X_test[self.selected_features]
@@ -0,0 +1,136 @@
+''' Single-file, versioned artifact of a fitted MLModel, loaded lazily by memory mapping '''
+import json
+import os
+import pickle
+import struct
+import tempfile
+
+import numpy as np
+
+ARTIFACT_MAGIC = b'MLMODEL\x00'
+ARTIFACT_VERSION = 1
+# Sections (pickle, arrays, booster) start on this alignment, so that the arrays are mapped aligned
+ALIGNMENT = 64
+# Arrays of at least this size are stored out of the pickle stream, as raw (memory mappable) sections
+MIN_MAPPED_BYTES = 1024
+
+
+def save_artifact(model, path):
+    """
+    Writes a fitted MLModel to a single file:
+    magic, version, header length, JSON header, then aligned sections - the pickled model (protocol 5), the raw
+    bytes of its numerical arrays (scaler vectors, LOF training data, trees nodes, imputer coefficients, ...) and
+    the classifier's booster in its native format (XGBoost UBJSON / CatBoost binary model), if any.
+    """
+    state = dict(model.__dict__)
+    state.pop('compiled_predictor', None)  # rebuilt on first use
+    state.pop('profiler', None)  # not part of the fitted model
+    booster = None
+    if is_xgboost(model.clf):
+        booster = {'format': 'xgboost', 'class': class_path(model.clf), 'params': model.clf.get_params()}
+        booster_bytes = bytes(model.clf.get_booster().save_raw(raw_format='ubj'))
+        state['clf'] = None
+    elif is_catboost(model.clf):
+        booster = {'format': 'catboost', 'class': class_path(model.clf)}
+        booster_bytes = catboost_model_bytes(model.clf)
+        state['clf'] = None
+
+    buffers = []
+
+    def out_of_band(buffer):
+        """ Keeps a large buffer as a raw section (returns False), smaller ones stay in the pickle stream """
+        if buffer.raw().nbytes >= MIN_MAPPED_BYTES:
+            buffers.append(buffer)
+            return False
+        return True
+
+    pickled = pickle.dumps((type(model), state), protocol=5, buffer_callback=out_of_band)
+    sections = [pickled] + [buffer.raw() for buffer in buffers]
+    if booster is not None:
+        sections.append(booster_bytes)
+
+    # Section offsets are relative to the (aligned) end of the header
+    offsets, position = [], 0
+    for section in sections:
+        offsets.append([position, memoryview(section).nbytes])
+        position = aligned(position + memoryview(section).nbytes)
+    header = {'version': ARTIFACT_VERSION, 'model_class': class_path(model), 'pickle': offsets[0],
+              'buffers': offsets[1:1 + len(buffers)], 'booster': booster}
+    if booster is not None:
+        booster['section'] = offsets[-1]
+        booster['params'] = {key: value for key, value in booster.get('params', {}).items()
+                             if isinstance(value, (int, float, str, bool, type(None)))}
+    header_bytes = json.dumps(header).encode()
+
+    with open(path, 'wb') as f:
+        f.write(ARTIFACT_MAGIC + struct.pack('<IQ', ARTIFACT_VERSION, len(header_bytes)) + header_bytes)
+        data_start = aligned(f.tell())
+        for section, (offset, _) in zip(sections, offsets):
+            f.write(b'\x00' * (data_start + offset - f.tell()))
+            f.write(section)
+
+
+def load_artifact(path, mmap=True):
+    """
+    Loads a model written by save_artifact. With mmap=True the arrays are read-only views of the memory mapped file,
+    so loading is near-instant and processes loading the same file share its pages.
+    """
+    with open(path, 'rb') as f:
+        prefix = f.read(len(ARTIFACT_MAGIC) + 12)
+        assert prefix[:len(ARTIFACT_MAGIC)] == ARTIFACT_MAGIC, f"Error! {path} is not a model artifact"
+        version, header_length = struct.unpack('<IQ', prefix[len(ARTIFACT_MAGIC):])
+        assert version <= ARTIFACT_VERSION, f"Error! Unsupported model artifact version {version}"
+        header = json.loads(f.read(header_length))
+        data_start = aligned(f.tell())
+
+    data = np.memmap(path, dtype=np.uint8, mode='r') if mmap else np.fromfile(path, dtype=np.uint8)
+
+    def section(offset, length):
+        return memoryview(data[data_start + offset:data_start + offset + length])
+
+    model_class, state = pickle.loads(section(*header['pickle']),
+                                      buffers=[section(*offsets) for offsets in header['buffers']])
+    model = model_class.__new__(model_class)
+    model.__dict__.update(state)
+
+    booster = header['booster']
+    if booster is not None:
+        blob = bytes(section(*booster['section']))
+        if booster['format'] == 'xgboost':
+            model.clf = import_class(booster['class'])(**booster['params'])
+            model.clf.load_model(bytearray(blob))
+        else:
+            model.clf = import_class(booster['class'])()
+            model.clf.load_model(blob=blob)
+    return model
+
+
+def catboost_model_bytes(clf):
+    """ The native binary model (cbm) of a fitted CatBoost classifier, saved by its public save_model """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path = os.path.join(temp_dir, 'model.cbm')
+        clf.save_model(path, format='cbm')
+        with open(path, 'rb') as f:
+            return f.read()
+
+
+def is_xgboost(clf):
+    return type(clf).__module__.startswith('xgboost')
+
+
+def is_catboost(clf):
+    return type(clf).__module__.startswith('catboost')
+
+
+def class_path(obj):
+    return f"{type(obj).__module__}.{type(obj).__qualname__}"
+
+
+def import_class(path):
+    module_name, class_name = path.rsplit('.', 1)
+    module = __import__(module_name, fromlist=[class_name])
+    return getattr(module, class_name)
+
+
+def aligned(position):
+    return -(-position // ALIGNMENT) * ALIGNMENT
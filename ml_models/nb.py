@@ -1,12 +1,15 @@
 from ml_models.ml_models import MLModel
-from sklearn.naive_bayes import GaussianNB
 
 
 class NBModel(MLModel):
 
-    def __init__(self, selection_metric='XGB', n_features=100, anomaly_vector=[0, 0, 0, 0, 0]):
-        MLModel.__init__(self, selection_metric, n_features, anomaly_vector)
+    def __init__(self, selection_metric='XGB', n_features=100, anomaly_vector=[0, 0, 0, 0, 0],
+                 *, anomaly_params=None, imputation_params=None, selection_params=None):
+        MLModel.__init__(self, selection_metric, n_features, anomaly_vector=anomaly_vector,
+                         anomaly_params=anomaly_params, imputation_params=imputation_params,
+                         selection_params=selection_params)
 
         # Model
+        from sklearn.naive_bayes import GaussianNB
         self.model_name = 'NB'
         self.clf = GaussianNB()
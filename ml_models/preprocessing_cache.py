@@ -0,0 +1,113 @@
+''' Content-addressed cache of the MLModel preprocessing stage (imputation to feature selection) '''
+import os
+import pickle
+from collections import OrderedDict
+
+from data_preprocessing.fingerprint import data_fingerprint
+
+# The MLModel attributes learned by the preprocessing stage
+PREPROCESSING_ATTRIBUTES = ['input_columns', 'categorical_mode', 'imputer', 'standardizer', 'std_params_for_anomaly',
+                            'anomaly_clf', 'anomaly_new_cols', 'selected_features']
+
+
+class PreprocessingCache:
+    """
+    The PreprocessingCache object holds the results of MLModel.preprocess_seen (the preprocessed training set and the
+    fitted preprocessing attributes), keyed by a fingerprint of the input data and of the preprocessing configuration.
+    Models of different families fitted on the same data with the same preprocessing settings share one entry.
+    Entries are kept in memory (least recently used are evicted), and optionally pickled to cache_dir.
+    """
+
+    def __init__(self, max_entries=4, cache_dir=None, max_disk_entries=16):
+        """
+        Args:
+            max_entries: Maximal number of entries kept in memory.
+            cache_dir: If given, entries are also stored in this directory, and loaded from it on a memory miss.
+            max_disk_entries: Maximal number of entries kept in cache_dir.
+        """
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.max_disk_entries = max_disk_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(X_train, y_train, groups, config):
+        """ The cache key of preprocessing X_train, y_train (and groups) with the given configuration """
+        return data_fingerprint(X_train, y_train, groups, config)
+
+    def get(self, key):
+        """ Returns the cached entry (X_train, attributes) of key, or None """
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+
+        path = self.entry_path(key)
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path, 'rb') as f:
+                    entry = pickle.load(f)
+                os.utime(path)  # mark as recently used
+            except FileNotFoundError:  # evicted by another process
+                entry = None
+            if entry is not None:
+                self.add_to_memory(key, entry)
+                self.hits += 1
+                return entry
+
+        self.misses += 1
+        return None
+
+    def put(self, key, X_train, attributes):
+        """ Stores the preprocessed training set and the fitted preprocessing attributes """
+        entry = (X_train, attributes)
+        self.add_to_memory(key, entry)
+
+        if self.cache_dir is not None:
+            # Written to a temporary file and renamed, so processes sharing cache_dir never read a partial entry
+            path = self.entry_path(key)
+            temp_path = f"{path}.{os.getpid()}.tmp"
+            with open(temp_path, 'wb') as f:
+                pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, path)
+            self.evict_disk_entries()
+
+    def clear(self):
+        """ Removes all the entries, from memory and from cache_dir """
+        self.entries.clear()
+        if self.cache_dir is not None:
+            for path in self.disk_entries():
+                os.remove(path)
+
+    def add_to_memory(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def entry_path(self, key):
+        return None if self.cache_dir is None else os.path.join(self.cache_dir, f"preprocessing_{key}.pkl")
+
+    def disk_entries(self):
+        """ The entries' files in cache_dir, least recently used first """
+        paths = [os.path.join(self.cache_dir, name) for name in os.listdir(self.cache_dir)
+                 if name.startswith("preprocessing_") and name.endswith(".pkl")]
+        mtimes = {}
+        for path in paths:
+            try:
+                mtimes[path] = os.path.getmtime(path)
+            except FileNotFoundError:  # removed by another process
+                pass
+        return sorted(mtimes, key=mtimes.get)
+
+    def evict_disk_entries(self):
+        paths = self.disk_entries()
+        for path in paths[:max(len(paths) - self.max_disk_entries, 0)]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:  # removed by another process
+                pass
@@ -1,17 +1,22 @@
 from ml_models.ml_models import MLModel
-from sklearn.linear_model import LogisticRegression, Ridge, Lasso, SGDClassifier
+
+# The classifiers' backends are imported by the model classes that use them
 
 
 class LogRegModel(MLModel):
 
     def __init__(self, selection_metric='XGB', n_features=100, standardization=False, anomaly_vector=[0, 0, 0, 0, 0],
-                 penalty=None):
-        MLModel.__init__(self, selection_metric, n_features, standardization, anomaly_vector)
+                 penalty=None,
+                 *, anomaly_params=None, imputation_params=None, selection_params=None):
+        MLModel.__init__(self, selection_metric, n_features, standardization, anomaly_vector,
+                         anomaly_params=anomaly_params, imputation_params=imputation_params,
+                         selection_params=selection_params)
 
         # Hyperparameters
         self.penalty = penalty
 
         # Model
+        from sklearn.linear_model import LogisticRegression
         self.model_name = f'{penalty} LogReg'
         self.clf = LogisticRegression(penalty=penalty, solver="saga")
         print(f"Hyperparameters: {self.clf.get_params()}")
@@ -19,13 +24,17 @@ class LogRegModel(MLModel):
 
 class LassoModel(MLModel):
 
-    def __init__(self, selection_metric='XGB', n_features=100, standardization=True, anomaly_vector=[0, 0, 0, 0, 0]):
+    def __init__(self, selection_metric='XGB', n_features=100, standardization=True, anomaly_vector=[0, 0, 0, 0, 0],
+                 *, anomaly_params=None, imputation_params=None, selection_params=None):
         if not standardization:
             print("Note! Lasso requires data standardization. Hence standardization is switched to True.")
             standardization = True
-        MLModel.__init__(self, selection_metric, n_features, standardization, anomaly_vector)
+        MLModel.__init__(self, selection_metric, n_features, standardization, anomaly_vector,
+                         anomaly_params=anomaly_params, imputation_params=imputation_params,
+                         selection_params=selection_params)
 
         # Model
+        from sklearn.linear_model import Lasso
         self.model_name = 'Lasso'
         self.clf = Lasso()
 
@@ -35,13 +44,17 @@ class LassoModel(MLModel):
 
 class RidgeModel(MLModel):
 
-    def __init__(self, selection_metric='XGB', n_features=100, standardization=True, anomaly_vector=[0, 0, 0, 0, 0]):
+    def __init__(self, selection_metric='XGB', n_features=100, standardization=True, anomaly_vector=[0, 0, 0, 0, 0],
+                 *, anomaly_params=None, imputation_params=None, selection_params=None):
         if not standardization:
             print("Note! Lasso requires data standardization. Hence standardization is switched to True.")
             standardization = True
-        MLModel.__init__(self, selection_metric, n_features, standardization, anomaly_vector)
+        MLModel.__init__(self, selection_metric, n_features, standardization, anomaly_vector,
+                         anomaly_params=anomaly_params, imputation_params=imputation_params,
+                         selection_params=selection_params)
 
         # Model
+        from sklearn.linear_model import Ridge
         self.model_name = 'Ridge'
         self.clf = Ridge()
 
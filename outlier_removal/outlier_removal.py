@@ -1,33 +1,74 @@
 import json
+import os
+from functools import lru_cache
 
+import numpy as np
+import pandas as pd
 
-def remove_out_of_range_values(df, ranges_path):
+
+def remove_out_of_range_values(df, ranges_path, long_format=False):
     """
     Remove values that exceed the pre-defined clinical range of possible values.
+    The ranges are compared with all the values at once (aligned min / max vectors, compiled once per ranges file).
 
     Args:
-        df: Dataframe in time-series format (feature are represented in columns)
+        df: Dataframe in time-series format (feature are represented in columns), masked in place.
+            With long_format, a longitudinal dataframe (vital signs / lab tests, containing "Feature" and "Value"),
+            whose out-of-range rows are filtered out before the pivot (create_time_series_data).
         ranges_path: path to json file, defining the possible ranges.
+        long_format: Whether df is a longitudinal dataframe.
+            Note: after the pivot, a (patient, datetime) whose values were all removed has no row, and for duplicated
+            measurements the first valid value is kept.
 
-    Returns: The dataframe with the masked values.
-
+    Returns:
+        df: The dataframe with the masked values (or without the out-of-range rows, with long_format).
+        removed: The number of removed values of each feature that has a range (features without a range are ignored).
     """
-    ranges = load_ranges_json(ranges_path)
-    null_before = df.isnull().sum().sum()  # num of values before masking
+    features, min_values, max_values = compiled_ranges(ranges_path)
+
+    if long_format:
+        codes = pd.Categorical(df['Feature'], categories=features).codes
+        values = df['Value'].to_numpy(dtype=float)
+        has_range = codes >= 0
+        invalid = np.zeros(len(df), dtype=bool)
+        row_codes = codes[has_range]
+        invalid[has_range] = (values[has_range] < min_values[row_codes]) | (values[has_range] > max_values[row_codes])
+        removed = np.bincount(codes[invalid], minlength=len(features))
+        present = np.bincount(codes[has_range], minlength=len(features)) > 0
+        return df[~invalid], pd.Series(removed[present], index=features[present], name='removed')
+
+    numerical_cols = df.select_dtypes(include=np.number).columns
+    ranged_cols = [col for col in numerical_cols if col in features]
+    positions = features.get_indexer(ranged_cols)
+    values = df[ranged_cols].to_numpy(dtype=float)
+    invalid = (values < min_values[positions]) | (values > max_values[positions])  # NaN compares False
+    removed = pd.Series(invalid.sum(axis=0), index=pd.Index(ranged_cols), name='removed')
 
-    features, missing_features = [], []
-    for x in df.columns:
-        features.append(x) if x in ranges.keys() else missing_features.append(x)
+    changed = removed.index[removed > 0]
+    if len(changed):
+        df[changed] = df[changed].mask(invalid[:, removed.to_numpy() > 0])
 
-    df[features] = df[features].apply(lambda c: c.mask(~c.between(ranges[c.name]['min'], ranges[c.name]['max'])))
+    return df, removed
+
+
+def compiled_ranges(path_for_ranges):
+    """
+    The ranges of the json as aligned arrays: features (pd.Index), min values and max values.
+    Parsed once per file (and again if it was modified).
+    """
+    path = os.path.abspath(path_for_ranges)
+    return load_compiled_ranges(path, os.path.getmtime(path))
 
-    if missing_features:
-        print("The following features doesn't have ranges in the ranges path specified, and therefore ignored:\n"
-              , missing_features)
-    null_after = df.isnull().sum().sum()  # num of values after masking
-    print(f"In total, {str(null_after - null_before)} invalid values were removed.")
 
-    return df
+@lru_cache(maxsize=8)
+def load_compiled_ranges(path, modified_time):
+    """ An helper function of compiled_ranges(). modified_time is part of the cache key. """
+    ranges = load_ranges_json(path)
+    features = pd.Index(list(ranges))
+    min_values = np.array([ranges[feature]['min'] for feature in features], dtype=float)
+    max_values = np.array([ranges[feature]['max'] for feature in features], dtype=float)
+    min_values.flags.writeable = max_values.flags.writeable = False  # shared by all the callers
+    return features, min_values, max_values
 
 
 def load_ranges_json(path_for_ranges):
@@ -0,0 +1,60 @@
+''' The compiled inference path gives the risk scores of MLModel.evaluation '''
+import numpy as np
+import pandas as pd
+import pytest
+
+from ml_models import compiled_predictor
+from ml_models.decision_trees_models import RFModel
+from ml_models.regression_models import LogRegModel
+
+
+def make_data(n_rows, rng):
+    X = pd.DataFrame(rng.normal(size=(n_rows, 8)), columns=[f'x{i}' for i in range(8)])
+    y = pd.Series(((X['x0'] + 2 * X['x1'] + rng.normal(size=n_rows)) > 1.5).astype(int))
+    X = X.mask(rng.random(X.shape) < 0.1)
+    X['b'] = rng.random(n_rows) < 0.5
+    return X, y
+
+
+@pytest.fixture(scope='module')
+def data():
+    rng = np.random.default_rng(0)
+    return make_data(1000, rng), make_data(200, rng)
+
+
+MODELS = [(LogRegModel, {'standardization': True, 'penalty': 'l2'}),
+          (RFModel, {'n_estimators': 20, 'imputation_params': {'add_indicator': True}})]
+
+
+def fitted_model(model_class, params, X_train, y_train):
+    model = model_class(selection_metric='Correlation', n_features=30, anomaly_vector=[1, 1, 1, 1, 1], **params)
+    model.fit(X_train, y_train)
+    return model
+
+
+@pytest.mark.parametrize('model_class, params', MODELS)
+def test_predictor_matches_evaluation(data, model_class, params):
+    (X_train, y_train), (X_test, y_test) = data
+    model = fitted_model(model_class, params, X_train, y_train)
+    assert model.compiled_predictor is None  # built on first use
+    expected = model.evaluation(X_test, y_test)[model.model_name].to_numpy()
+
+    np.testing.assert_allclose(model.predictor.predict(X_test), expected, atol=1e-9)
+    # A few rows - the compiled LOF / Isolation Forest paths
+    np.testing.assert_allclose(model.predictor.predict(X_test.iloc[:10]), expected[:10], atol=1e-9)
+    row = X_test.iloc[3].to_dict()
+    assert model.predictor.predict_one(row) == pytest.approx(expected[3], abs=1e-9)
+
+
+@pytest.mark.parametrize('model_class, params', MODELS)
+def test_predictor_without_private_attributes(data, model_class, params, monkeypatch):
+    """ Estimators without the expected sklearn internals are applied by their public methods """
+    for attributes in ['ITERATIVE_IMPUTER_ATTRIBUTES', 'LOF_ATTRIBUTES', 'ISOLATION_FOREST_ATTRIBUTES']:
+        monkeypatch.setattr(compiled_predictor, attributes, ['missing_attribute'])
+    (X_train, y_train), (X_test, y_test) = data
+    model = fitted_model(model_class, params, X_train, y_train)
+    expected = model.evaluation(X_test, y_test)[model.model_name].to_numpy()
+
+    assert model.predictor.linear_imputation is None
+    np.testing.assert_allclose(model.predictor.predict(X_test), expected, atol=1e-9)
+    np.testing.assert_allclose(model.predictor.predict(X_test.iloc[:10]), expected[:10], atol=1e-9)
@@ -0,0 +1,94 @@
+''' The vectorized feature generation gives the values of straightforward per-patient computations '''
+import numpy as np
+import pandas as pd
+import pytest
+
+from feature_generation.feature_generation import add_lr_slope, summary_statistics_features
+
+FEATURES = ['heart_rate', 'creatinine']
+
+
+def make_patients(n_patients, rng):
+    """ Irregularly sampled patients (contiguous rows, in chronological order), with missing values and equal times """
+    patients = []
+    for patient_id in range(n_patients):
+        n_rows = rng.integers(1, 40)
+        hours = np.sort(rng.choice(np.arange(0, 200, 0.5), size=n_rows))
+        hours[rng.random(n_rows) < 0.1] = hours[0]  # a few observations at the admission time
+        hours = np.sort(hours)
+        patient = pd.DataFrame({'patient_id': patient_id, 'time_since_admission': hours,
+                                'DateTime': pd.Timestamp('2020-01-01') + pd.to_timedelta(hours, unit='h')})
+        for feat_index, feat_name in enumerate(FEATURES):
+            patient[feat_name] = 50 * (feat_index + 1) + rng.normal(size=n_rows).cumsum()
+            patient.loc[rng.random(n_rows) < 0.2, feat_name] = np.nan
+        patients.append(patient)
+    return pd.concat(patients, ignore_index=True)
+
+
+@pytest.fixture(scope='module')
+def df():
+    return make_patients(30, np.random.default_rng(0))
+
+
+def reference_slopes(df, feat_name, window=None):
+    """ The least squares slope of every row, fitted separately on the patient's observations up to that row """
+    slopes = []
+    for _, patient in df.groupby('patient_id', sort=False):
+        times = patient['time_since_admission'].to_numpy()
+        values = patient[feat_name].to_numpy()
+        for row in range(len(patient)):
+            in_fit = (np.arange(len(patient)) <= row) & ~np.isnan(values)
+            if window is not None:
+                in_fit &= times > times[row] - window
+            if np.isnan(values[row]):
+                slopes.append(np.nan)
+            elif np.ptp(times[in_fit]) == 0:
+                slopes.append(0.0)  # a single time, as LinearRegression
+            else:
+                slopes.append(np.polyfit(times[in_fit], values[in_fit], 1)[0])
+    return np.array(slopes)
+
+
+@pytest.mark.parametrize('window', [None, 24])
+def test_lr_slope_matches_reference(df, window):
+    out = add_lr_slope(df.copy(), FEATURES, window=window)
+    suffix = "_lr_slope" if window is None else "_lr_slope_" + str(window) + "h"
+    for feat_name in FEATURES:
+        np.testing.assert_allclose(out[feat_name + suffix].to_numpy(), reference_slopes(df, feat_name, window),
+                                   rtol=1e-7, atol=1e-9)
+
+
+def reference_statistics(df, feat_name, horizon=None, ignore_last=False):
+    """ Per-patient pandas rolling statistics over the trailing horizon (hours), or over the whole history so far """
+    series = df.set_index('DateTime').groupby('patient_id', sort=False)[feat_name]
+    window = (lambda x: x.expanding()) if horizon is None else (lambda x: x.rolling(str(horizon) + 'h'))
+    stats = {stat: series.transform(lambda x: getattr(window(x), stat)()).to_numpy(copy=True)
+             for stat in ['mean', 'min', 'max', 'std', 'count']}
+    values = df[feat_name].to_numpy()
+    count = stats.pop('count')
+    if ignore_last:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            stats['mean'] = np.where(count >= 2, (stats['mean'] * count - values) / (count - 1), np.nan)
+    stats['delta_mean'] = values - stats['mean']
+    for stat in stats.values():
+        stat[np.isnan(values)] = np.nan
+    return stats
+
+
+@pytest.mark.parametrize('full_history, ignore_last', [(False, False), (False, True), (True, False), (True, True)])
+def test_summary_statistics_match_reference(df, full_history, ignore_last):
+    horizons = [6, 24]
+    # Shuffled rows: the statistics are computed in time order, and returned in the input order
+    shuffled = df.sample(frac=1, random_state=0).reset_index(drop=True)
+    out = summary_statistics_features(shuffled.copy(), FEATURES, ignore_last=ignore_last, full_history=full_history,
+                                      horizons=horizons)
+    pd.testing.assert_frame_equal(out[shuffled.columns], shuffled)
+
+    order = np.lexsort((shuffled['DateTime'], shuffled['patient_id']))  # equal times stay in the input order
+    out, shuffled = out.iloc[order].reset_index(drop=True), shuffled.iloc[order].reset_index(drop=True)
+    for horizon in [None] if full_history else horizons:
+        suffix = '' if horizon is None else "_" + str(horizon) + 'h'
+        for feat_name in FEATURES:
+            for feat_stat, expected in reference_statistics(shuffled, feat_name, horizon, ignore_last).items():
+                np.testing.assert_allclose(out[feat_name + "_" + feat_stat + suffix].to_numpy(), expected,
+                                           rtol=1e-7, atol=1e-9, err_msg=feat_name + "_" + feat_stat + suffix)
@@ -0,0 +1,64 @@
+''' Streaming the observations through PatientFeatureState gives the batch features of the same patients '''
+import numpy as np
+import pandas as pd
+import pytest
+
+from feature_generation.feature_generation import add_lr_slope, summary_statistics_features
+from feature_generation.patient_feature_state import PatientFeatureState, WindowStatistics
+
+FEATURES = ['heart_rate', 'creatinine']
+
+
+@pytest.fixture(scope='module')
+def df():
+    """ Irregularly sampled patients (in chronological order), with missing values and equal times """
+    rng = np.random.default_rng(1)
+    patients = []
+    for patient_id in range(20):
+        n_rows = rng.integers(1, 50)
+        hours = np.sort(rng.choice(np.arange(0, 150, 0.5), size=n_rows))
+        hours[1:][rng.random(n_rows - 1) < 0.1] = hours[0]
+        hours = np.sort(hours)
+        patient = pd.DataFrame({'patient_id': patient_id, 'time_since_admission': hours,
+                                'DateTime': pd.Timestamp('2020-01-01') + pd.to_timedelta(hours, unit='h')})
+        for feat_index, feat_name in enumerate(FEATURES):
+            patient[feat_name] = 50 * (feat_index + 1) + rng.normal(size=n_rows).cumsum()
+            patient.loc[rng.random(n_rows) < 0.2, feat_name] = np.nan
+        patients.append(patient)
+    return pd.concat(patients, ignore_index=True)
+
+
+def stream(df, **params):
+    """ The feature rows of all the patients, each observation added to its patient's state in turn """
+    states, rows = {}, []
+    for _, row in df.iterrows():
+        if row['patient_id'] not in states:
+            states[row['patient_id']] = PatientFeatureState(FEATURES, **params)
+        rows.append(states[row['patient_id']].update(row['DateTime'], row, row['time_since_admission']))
+    return pd.DataFrame(rows)
+
+
+@pytest.mark.parametrize('params', [{'horizons': [6, 24]},
+                                    {'horizons': [12], 'ignore_last': True},
+                                    {'full_history': True},
+                                    {'full_history': True, 'ignore_last': True, 'slope_window': 24}])
+def test_streaming_matches_batch(df, params):
+    batch = summary_statistics_features(df.copy(), FEATURES, ignore_last=params.get('ignore_last', False),
+                                        full_history=params.get('full_history', False),
+                                        horizons=params.get('horizons', [24, 72]))
+    batch = add_lr_slope(batch, FEATURES, window=params.get('slope_window'))
+    streamed = stream(df, slope_features=FEATURES, **params)
+
+    assert set(streamed.columns) == set(batch.columns) - set(df.columns)
+    for col in streamed.columns:
+        np.testing.assert_allclose(streamed[col].to_numpy(), batch[col].to_numpy(), rtol=1e-7, atol=1e-9,
+                                   err_msg=col)
+
+
+def test_window_statistics_eviction():
+    window = WindowStatistics(horizon=3)
+    start = pd.Timestamp('2020-01-01')
+    for hour, value in enumerate([5.0, 1.0, 3.0, np.nan, 4.0]):
+        stats = window.update(start + pd.Timedelta(hours=hour), value)
+    # The window (1h, 4h] holds 3.0 and 4.0 (the missing value is skipped)
+    assert stats == pytest.approx({'mean': 3.5, 'delta_mean': 0.5, 'min': 3.0, 'max': 4.0, 'std': np.sqrt(0.5)})
@@ -0,0 +1,41 @@
+''' Patient-sharded feature generation gives the features of the unsharded run '''
+import numpy as np
+import pandas as pd
+import pytest
+
+from feature_generation.feature_generation import add_lr_slope, features_ratio, summary_statistics_features
+from feature_generation.sharding import balanced_shards, run_steps, sharded_feature_generation
+
+FEATURES = ['heart_rate', 'creatinine', 'sodium']
+STEPS = [(summary_statistics_features, {'features': FEATURES, 'horizons': [12, 48]}),
+         (add_lr_slope, {'feat_list': FEATURES, 'window': 24}),
+         (features_ratio, {'features': FEATURES, 'pairs': [('heart_rate', 'sodium')]})]
+
+
+@pytest.fixture(scope='module')
+def df():
+    """ Patients of different lengths (contiguous rows, in chronological order), with unordered patient ids """
+    rng = np.random.default_rng(2)
+    patients = []
+    for patient_id in rng.permutation(25):
+        n_rows = rng.integers(1, 80)
+        hours = np.sort(rng.choice(np.arange(0, 300, 0.5), size=n_rows, replace=False))
+        patient = pd.DataFrame({'patient_id': f'p{patient_id}', 'time_since_admission': hours,
+                                'DateTime': pd.Timestamp('2020-01-01') + pd.to_timedelta(hours, unit='h')})
+        for feat_index, feat_name in enumerate(FEATURES):
+            patient[feat_name] = 50 * (feat_index + 1) + rng.normal(size=n_rows).cumsum()
+            patient.loc[rng.random(n_rows) < 0.2, feat_name] = np.nan
+        patients.append(patient)
+    return pd.concat(patients, ignore_index=True)
+
+
+@pytest.mark.parametrize('n_workers, n_shards', [(1, None), (1, 4), (2, 3)])
+def test_sharded_matches_unsharded(df, n_workers, n_shards):
+    expected = run_steps(df.copy(), STEPS)
+    out = sharded_feature_generation(df, STEPS, n_workers=n_workers, n_shards=n_shards)
+    pd.testing.assert_frame_equal(out, expected, rtol=1e-9)
+
+
+def test_balanced_shards():
+    shards = balanced_shards(np.array([10, 1, 7, 3, 3, 2]), 2)
+    assert np.bincount(shards, weights=[10, 1, 7, 3, 3, 2]).tolist() == [13, 13]